@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-CERN-sync offline benchmarks.
+
+Run them with `python -m benchmarks.run`, see `python -m benchmarks.run --help`.
+"""
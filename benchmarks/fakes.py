@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Synthetic CERN Keycloak, AuthZ and LDAP services.
+
+Records are generated on the fly from their index, so that large datasets do not
+need to be kept in memory. `revision` simulates the changes in the CERN database
+between two syncs: at each new revision, the first `churn` ratio of the records
+is modified.
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+PERSON_ID_OFFSET = 100000
+
+
+class Dataset:
+    """Synthetic CERN identities and groups."""
+
+    def __init__(self, size, churn=0.01, revision=0):
+        """Constructor.
+
+        :param size: number of identities and of groups.
+        :param churn: ratio of the records modified at each revision.
+        """
+        self.size = size
+        self.churn = churn
+        self.revision = revision
+
+    def _revision_of(self, index):
+        """Return the revision of the record at the given index."""
+        return self.revision if index < self.size * self.churn else 0
+
+    def identity(self, index):
+        """Return the AuthZ identity at the given index."""
+        rev = self._revision_of(index)
+        person_id = PERSON_ID_OFFSET + index
+        return {
+            "upn": f"user{index}",
+            "displayName": f"User {index} rev{rev}",
+            "firstName": "User",
+            "lastName": f"{index} rev{rev}",
+            "personId": str(person_id),
+            "uid": person_id,
+            "gid": 1000 + index % 100,
+            "cernDepartment": "IT",
+            "cernGroup": f"G{index % 50}",
+            "cernSection": "IR",
+            "instituteName": "CERN",
+            "postOfficeBox": f"M{index}",
+            "preferredCernLanguage": "EN",
+            "orcid": f"0000-0000-{index // 10000:04d}-{index % 10000:04d}",
+            "primaryAccountEmail": f"user{index}@cern.ch",
+        }
+
+    def ldap_user(self, index):
+        """Return the LDAP entry of the identity at the given index."""
+        identity = self.identity(index)
+        values = {
+            "cernAccountType": "Primary",
+            "cernActiveStatus": "Active",
+            "cernGroup": identity["cernGroup"],
+            "cernInstituteName": identity["instituteName"],
+            "cernSection": identity["cernSection"],
+            "cn": identity["upn"],
+            "department": f"IT/{identity['cernGroup']}",
+            "displayName": identity["displayName"],
+            "division": "IT",
+            "employeeID": identity["personId"],
+            "givenName": identity["firstName"],
+            "mail": identity["primaryAccountEmail"],
+            "postOfficeBox": identity["postOfficeBox"],
+            "preferredLanguage": "EN",
+            "sn": identity["lastName"],
+            "uidNumber": str(identity["uid"]),
+        }
+        return {key: [value.encode("utf-8")] for key, value in values.items()}
+
+    def group(self, index):
+        """Return the AuthZ group at the given index."""
+        rev = self._revision_of(index)
+        return {
+            "groupIdentifier": f"group-{index}",
+            "displayName": f"Group {index}",
+            "description": f"Group {index} rev{rev}",
+        }
+
+
+###################################################################################
+# Keycloak and AuthZ
+
+
+def _filter_indexes(size, filters):
+    """Return the indexes of the identities matching the `personId` filters."""
+    for _filter in filters:
+        if _filter.startswith("personId:endswith:"):
+            suffix = _filter.rsplit(":", 1)[1]
+            if len(suffix) == 1:
+                # the ids end with the last digit of the index: no need to scan
+                return range(int(suffix), size, 10)
+            return [
+                i for i in range(size) if str(PERSON_ID_OFFSET + i).endswith(suffix)
+            ]
+    return range(size)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Serve the Keycloak token and the AuthZ Identity and Group endpoints."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        """Do not log requests."""
+
+    def _send_json(self, data, status=200):
+        """Send a JSON response."""
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        """Return a new token."""
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        self.server.stats["token"] += 1
+        self._send_json({"access_token": "benchmark-token", "expires_in": 300})
+
+    def do_GET(self):
+        """Return a page of identities or groups, with token-based pagination."""
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        dataset = self.server.dataset
+        if url.path.endswith("/Identity"):
+            indexes = _filter_indexes(dataset.size, query.get("filter", []))
+            record_fn = dataset.identity
+        elif url.path.endswith("/Group"):
+            indexes = range(dataset.size)
+            record_fn = dataset.group
+        else:
+            return self._send_json({"message": "Not found"}, status=404)
+
+        self.server.stats["pages"] += 1
+        # network and service time, not spent in this process
+        time.sleep(self.server.latency)
+        # the last `limit` param wins, as the client appends it to the url
+        limit = int(query["limit"][-1])
+        offset = int(query.get("token", ["0"])[-1])
+        page = indexes[offset : offset + limit]
+        next_offset = offset + limit
+        token = str(next_offset) if next_offset < len(indexes) else None
+        self._send_json(
+            {
+                "data": [record_fn(i) for i in page],
+                "pagination": {"token": token},
+            }
+        )
+
+
+class FakeCERNServer:
+    """Local HTTP server, standing in for both Keycloak and AuthZ."""
+
+    def __init__(self, dataset, latency=0):
+        """Constructor.
+
+        :param latency: seconds waited before responding with each page.
+        """
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.dataset = dataset
+        self.httpd.latency = latency
+        self.httpd.stats = dict(token=0, pages=0)
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        """Return the base url of the server."""
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def stats(self):
+        """Return the number of token and page requests served."""
+        return self.httpd.stats
+
+    def __enter__(self):
+        """Start serving in a background thread."""
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        """Stop serving."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+###################################################################################
+# LDAP
+
+
+class _SimplePagedResultsControl:
+    """Stand-in for `ldap.controls.SimplePagedResultsControl`."""
+
+    controlType = "1.2.840.113556.1.4.319"
+
+    def __init__(self, criticality=True, size=10, cookie=""):
+        """Constructor."""
+        self.criticality = criticality
+        self.size = size
+        self.cookie = cookie
+
+
+class FakeLdapConnection:
+    """Paged search over the identities of a dataset."""
+
+    def __init__(self, dataset):
+        """Constructor."""
+        self.dataset = dataset
+        self._searches = dict()
+        self.stats = dict(pages=0)
+
+    def search_ext(self, base, scope, filter, fields, serverctrls=None):
+        """Start a search and return its message id."""
+        msgid = len(self._searches) + 1
+        self._searches[msgid] = serverctrls[0]
+        return msgid
+
+    def result3(self, msgid):
+        """Return the page of entries requested by the given search."""
+        control = self._searches.pop(msgid)
+        offset = int(control.cookie or 0)
+        end = min(offset + control.size, self.dataset.size)
+        rdata = [
+            (f"CN=user{i},OU=Users", self.dataset.ldap_user(i))
+            for i in range(offset, end)
+        ]
+        cookie = str(end).encode("utf-8") if end < self.dataset.size else b""
+        self.stats["pages"] += 1
+        return 101, rdata, msgid, [_SimplePagedResultsControl(cookie=cookie)]
+
+
+def fake_ldap_module(connection):
+    """Return a stand-in for the `ldap` module, connecting to the given backend."""
+    return SimpleNamespace(
+        SCOPE_ONELEVEL=1,
+        initialize=lambda url: connection,
+        controls=SimpleNamespace(SimplePagedResultsControl=_SimplePagedResultsControl),
+    )
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Time the users and groups syncs end to end, against synthetic CERN services.
+
+Each scenario runs in a new process, so that its peak RSS is measured alone.
+It syncs the dataset twice: `initial`, where all records are new, then `resync`,
+where only the `--churn` ratio of the records changed. The `serialize-*`
+scenarios only time the serialization of the fetched records. Example:
+
+    python -m benchmarks.run --sizes 1000 10000 --scenarios users-authz groups
+
+By default, each scenario uses a new SQLite DB. When `--db` is given, e.g. a
+PostgreSQL url, all the tables of that DB are dropped and created again.
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+from unittest.mock import patch
+
+from invenio_app.factory import create_app
+from invenio_db import db
+from sqlalchemy import event
+
+from invenio_cern_sync.authz.serializer import serialize_cern_identities
+from invenio_cern_sync.groups.sync import sync as groups_sync
+from invenio_cern_sync.ldap.serializer import serialize_ldap_users
+from invenio_cern_sync.users.profile import CERNUserProfileSchema
+from invenio_cern_sync.users.sync import sync as users_sync
+
+from .fakes import Dataset, FakeCERNServer, FakeLdapConnection, fake_ldap_module
+
+SCENARIOS = [
+    "users-authz",
+    "users-ldap",
+    "users-staging",
+    "users-pipeline",
+    "groups",
+    "groups-pipeline",
+    "serialize-authz",
+    "serialize-ldap",
+]
+
+SCENARIOS_CONFIG = {
+    "users-staging": dict(CERN_SYNC_USERS_STAGING=True),
+    "users-pipeline": dict(CERN_SYNC_PIPELINE=True),
+    "groups-pipeline": dict(CERN_SYNC_PIPELINE=True),
+}
+"""Config of the scenarios, e.g. `users-staging` which requires a PostgreSQL `--db`."""
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+
+def create_benchmark_app(db_uri, instance_path, **config):
+    """Create the Invenio app used to run the syncs."""
+    return create_app(
+        instance_path=instance_path,
+        SQLALCHEMY_DATABASE_URI=db_uri,
+        SECRET_KEY="benchmark",
+        CELERY_TASK_ALWAYS_EAGER=True,
+        CELERY_BROKER_URL="memory://",
+        CELERY_RESULT_BACKEND="cache",
+        CELERY_CACHE_BACKEND="memory",
+        CERN_APP_CREDENTIALS=dict(consumer_key="benchmark", consumer_secret="secret"),
+        ACCOUNTS_USER_PROFILE_SCHEMA=CERNUserProfileSchema(),
+        THEME_FRONTPAGE=False,
+        **config,
+    )
+
+
+def _sync_fn(scenario, dataset):
+    """Return the function running the sync of the given scenario."""
+    if scenario in ("users-authz", "users-staging", "users-pipeline"):
+        return lambda: users_sync(method="AuthZ")
+    if scenario == "users-ldap":
+        ldap_module = fake_ldap_module(FakeLdapConnection(dataset))
+
+        def _sync():
+            with patch("invenio_cern_sync.ldap.client.ldap", ldap_module):
+                return users_sync(method="LDAP", ldap=dict(ldap_url="ldap://fake"))
+
+        return _sync
+    if scenario in ("groups", "groups-pipeline"):
+        return groups_sync
+    if scenario in ("serialize-authz", "serialize-ldap"):
+        # only the serialization is timed, not the generation of the records
+        if scenario == "serialize-authz":
+            records, serializer_fn = dataset.identity, serialize_cern_identities
+        else:
+            records, serializer_fn = dataset.ldap_user, serialize_ldap_users
+        records = [records(i) for i in range(dataset.size)]
+        return lambda: deque(serializer_fn(records), maxlen=0)
+    raise ValueError(f"Unknown scenario {scenario}. Possible values: {SCENARIOS}.")
+
+
+def run_scenario(scenario, size, churn, db_uri=None, latency=0):
+    """Run the scenario in the current process, and return the result of each sync.
+
+    :param latency: seconds waited by the fake AuthZ service for each page.
+    """
+    instance_path = tempfile.mkdtemp(prefix="cern-sync-benchmark-")
+    db_uri = db_uri or f"sqlite:///{instance_path}/benchmark.db"
+    dataset = Dataset(size, churn=churn)
+
+    with FakeCERNServer(dataset, latency=latency) as server:
+        app = create_benchmark_app(
+            db_uri,
+            instance_path,
+            CERN_SYNC_KEYCLOAK_BASE_URL=server.url,
+            CERN_SYNC_AUTHZ_BASE_URL=server.url,
+            **SCENARIOS_CONFIG.get(scenario, {}),
+        )
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            statements = dict(count=0)
+
+            @event.listens_for(db.engine, "before_cursor_execute")
+            def _count(*args, **kwargs):
+                statements["count"] += 1
+
+            sync_fn = _sync_fn(scenario, dataset)
+            results = []
+            for phase, revision in (("initial", 0), ("resync", 1)):
+                dataset.revision = revision
+                statements["count"] = 0
+                start = time.perf_counter()
+                sync_fn()
+                elapsed = time.perf_counter() - start
+                results.append(
+                    dict(
+                        scenario=scenario,
+                        phase=phase,
+                        size=size,
+                        seconds=round(elapsed, 3),
+                        records_per_second=round(size / elapsed, 1),
+                        sql_statements=statements["count"],
+                    )
+                )
+
+    # kilobytes on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    for result in results:
+        result["peak_rss_mb"] = round(peak_rss_mb, 1)
+    return results
+
+
+def _run_in_subprocess(scenario, size, churn, db_uri, latency):
+    """Run the scenario in a new process and return its results."""
+    cmd = [sys.executable, "-m", "benchmarks.run", "--child"]
+    cmd += ["--scenarios", scenario, "--sizes", str(size), "--churn", str(churn)]
+    cmd += ["--latency", str(latency)]
+    if db_uri:
+        cmd += ["--db", db_uri]
+    output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+    # the results are printed last, after the logs of the app
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def _print_table(results):
+    """Print the results as a table."""
+    columns = [
+        "scenario",
+        "phase",
+        "size",
+        "seconds",
+        "records_per_second",
+        "sql_statements",
+        "peak_rss_mb",
+    ]
+    rows = [columns] + [[str(result[c]) for c in columns] for result in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def main(argv=None):
+    """Run the benchmarks."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES)
+    parser.add_argument(
+        "--churn", type=float, default=0.01, help="ratio of records changed"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="seconds waited by the fake AuthZ service for each page",
+    )
+    parser.add_argument("--db", help="DB url. All its tables are dropped.")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        results = run_scenario(
+            args.scenarios[0], args.sizes[0], args.churn, args.db, args.latency
+        )
+        print(json.dumps(results))
+        return
+
+    results = []
+    for scenario in args.scenarios:
+        for size in args.sizes:
+            results += _run_in_subprocess(
+                scenario, size, args.churn, args.db, args.latency
+            )
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        _print_table(results)
+
+
+if __name__ == "__main__":
+    main()
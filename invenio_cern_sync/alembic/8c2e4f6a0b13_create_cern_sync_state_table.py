@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Create cern sync state table."""
+
+import sqlalchemy as sa
+from alembic import op
+from invenio_db.shared import UTCDateTime
+
+# revision identifiers, used by Alembic.
+revision = "8c2e4f6a0b13"
+down_revision = "5a1b3c7d9e21"
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    """Upgrade database."""
+    op.create_table(
+        "cern_sync_state",
+        sa.Column("created", UTCDateTime(), nullable=False),
+        sa.Column("updated", UTCDateTime(), nullable=False),
+        sa.Column("kind", sa.String(length=64), nullable=False),
+        sa.Column("watermark", sa.DateTime(), nullable=True),
+        sa.Column("last_full_sync", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("kind", name=op.f("pk_cern_sync_state")),
+    )
+
+
+def downgrade():
+    """Downgrade database."""
+    op.drop_table("cern_sync_state")
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Create cern sync user change table."""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "d5e8a1f3b720"
+down_revision = "b41e7a9d2c63"
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    """Upgrade database."""
+    op.create_table(
+        "cern_sync_user_change",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("created", sa.DateTime(), nullable=False),
+        sa.Column("identity_id", sa.String(length=255), nullable=True),
+        sa.Column("user_id", sa.Integer(), nullable=True),
+        sa.Column("action", sa.String(length=32), nullable=False),
+        sa.Column("log_uuid", sa.String(length=36), nullable=True),
+        sa.Column("data", sa.JSON(), nullable=False),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_cern_sync_user_change")),
+    )
+    op.create_index(
+        op.f("ix_cern_sync_user_change_identity_id"),
+        "cern_sync_user_change",
+        ["identity_id"],
+        unique=False,
+    )
+    op.create_index(
+        op.f("ix_cern_sync_user_change_user_id"),
+        "cern_sync_user_change",
+        ["user_id"],
+        unique=False,
+    )
+
+
+def downgrade():
+    """Downgrade database."""
+    op.drop_index(
+        op.f("ix_cern_sync_user_change_user_id"), table_name="cern_sync_user_change"
+    )
+    op.drop_index(
+        op.f("ix_cern_sync_user_change_identity_id"),
+        table_name="cern_sync_user_change",
+    )
+    op.drop_table("cern_sync_user_change")
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-CERN-sync asyncio CERN Authorization Service client.
+
+It requires the `async` extra dependency: `pip install invenio-cern-sync[async]`.
+"""
+
+import asyncio
+import queue
+import threading
+import time
+from urllib.parse import urlencode
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+from flask import current_app
+
+from ..errors import CircuitOpenError, RequestError
+from ..logging import log_info, log_warning
+from ..metrics import NULL_METRICS
+from .client import (
+    AUTHZ_AUDIENCE,
+    GROUPS_FIELDS,
+    IDENTITY_FIELDS,
+    _tokens,
+    _tokens_lock,
+    build_groups_url,
+    build_identities_url,
+)
+from .retry import get_retry_policy
+
+_SHARD_DONE = object()
+_ITER_DONE = object()
+
+
+def create_async_http_client(pool_size=None, keep_alive=None, timeout=None):
+    """Create a new pooled async HTTP client.
+
+    Params not provided are taken from the `CERN_SYNC_HTTP_*` config.
+    """
+    config = current_app.config
+    pool_size = pool_size or config["CERN_SYNC_HTTP_POOL_SIZE"]
+    if keep_alive is None:
+        keep_alive = config["CERN_SYNC_HTTP_KEEP_ALIVE"]
+    timeout = timeout or config["CERN_SYNC_HTTP_TIMEOUT"]
+    if isinstance(timeout, (tuple, list)):
+        connect_timeout, read_timeout = timeout
+        timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+
+    limits = httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size if keep_alive else 0,
+    )
+    return httpx.AsyncClient(limits=limits, timeout=timeout)
+
+
+async def async_request_with_retries(
+    client, url, method="GET", payload=None, headers=None, policy=None
+):
+    """Make an async HTTP request with retries.
+
+    :param client: the async HTTP client to use.
+    :param policy: the RetryPolicy deciding if and when to retry. Defaults to the
+        policy shared by all requests of the app.
+    """
+    policy = policy or get_retry_policy()
+    for attempt in range(policy.max_attempts):
+        if policy.is_open(url):
+            raise CircuitOpenError(url)
+        try:
+            if method.upper() == "GET":
+                response = await client.get(url, headers=headers)
+            elif method.upper() == "POST":
+                response = await client.post(url, data=payload, headers=headers)
+            else:
+                raise ValueError("Unsupported HTTP method")
+            response.raise_for_status()  # Raise an error for bad status codes (4xx/5xx)
+            policy.record_success(url)
+            return response
+        except httpx.HTTPError as e:
+            response = getattr(e, "response", None)
+            status_code = getattr(response, "status_code", None)
+            policy.record_failure(url, status_code)
+            if (
+                not policy.is_retryable(status_code)
+                or attempt == policy.max_attempts - 1
+            ):
+                raise RequestError(url, str(e), status_code=status_code)
+
+            wait = policy.get_delay(attempt, response=response)
+            log_warning(
+                "authz-client",
+                dict(
+                    action="retrying-request",
+                    url=url,
+                    attempt=attempt + 1,
+                    status_code=status_code,
+                    delay=wait,
+                ),
+            )
+            policy.record_retry(wait)
+            await asyncio.sleep(wait)
+
+
+class AsyncKeycloakService:
+    """Connect to the CERN Keycloak service, with asyncio."""
+
+    def __init__(self, base_url=None, client_id=None, client_secret=None, client=None):
+        """Constructor.
+
+        :param client: the async HTTP client to use, which can be shared with the
+            AsyncAuthZService. A new pooled client is created when not provided.
+        """
+        self.base_url = base_url or current_app.config["CERN_SYNC_KEYCLOAK_BASE_URL"]
+        self.client_id = (
+            client_id or current_app.config["CERN_APP_CREDENTIALS"]["consumer_key"]
+        )
+        self.client_secret = (
+            client_secret
+            or current_app.config["CERN_APP_CREDENTIALS"]["consumer_secret"]
+        )
+        self.client = client or create_async_http_client()
+        self.token_leeway = current_app.config["CERN_SYNC_KEYCLOAK_TOKEN_LEEWAY"]
+        self._lock = None
+
+    async def get_authz_token(self, force_refresh=False):
+        """Get a token to authenticate to the Authz service.
+
+        Tokens are shared with the KeycloakService cache. Concurrent requests of an
+        expired token wait for the same refresh.
+        """
+        key = (self.base_url, self.client_id, AUTHZ_AUDIENCE)
+        with _tokens_lock:
+            token, expires_at = _tokens.get(key, (None, 0))
+        if token and not force_refresh and time.time() < expires_at:
+            return token
+
+        # created here, to be bound to the running loop
+        self._lock = self._lock or asyncio.Lock()
+        async with self._lock:
+            with _tokens_lock:
+                cached_token, expires_at = _tokens.get(key, (None, 0))
+            if cached_token != token and time.time() < expires_at:
+                # refreshed meanwhile by another request
+                return cached_token
+
+            token_url = f"{self.base_url}/auth/realms/cern/api-access/token"
+            token_data = {
+                "grant_type": "client_credentials",
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+                "audience": AUTHZ_AUDIENCE,
+            }
+            resp = await async_request_with_retries(
+                self.client, url=token_url, method="POST", payload=token_data
+            )
+            data = resp.json()
+            token = data["access_token"]
+            expires_in = data.get("expires_in") or 0
+            with _tokens_lock:
+                _tokens[key] = (token, time.time() + expires_in - self.token_leeway)
+            return token
+
+    async def aclose(self):
+        """Close the connections of the HTTP client."""
+        await self.client.aclose()
+
+
+class AsyncAuthZService:
+    """Query CERN Authz service, with asyncio."""
+
+    def __init__(
+        self,
+        keycloak_service,
+        base_url=None,
+        limit=1000,
+        max_concurrency=None,
+        client=None,
+        metrics=None,
+    ):
+        """Constructor.
+
+        :param max_concurrency: max number of requests in flight. Defaults to
+            `CERN_SYNC_HTTP_POOL_SIZE`.
+        :param client: the async HTTP client to use. Defaults to the client of the
+            Keycloak service, so that both share the same connection pool.
+        :param metrics: the SyncMetrics of the run, where the pages are counted.
+        """
+        self.keycloak_service = keycloak_service
+        self.base_url = base_url or current_app.config["CERN_SYNC_AUTHZ_BASE_URL"]
+        self.limit = limit
+        self.max_concurrency = (
+            max_concurrency or current_app.config["CERN_SYNC_HTTP_POOL_SIZE"]
+        )
+        self.client = (
+            client
+            or getattr(keycloak_service, "client", None)
+            or create_async_http_client()
+        )
+        self.metrics = metrics or NULL_METRICS
+        self._semaphore = None
+
+    async def _request(self, url, headers):
+        """Request a page of results, with a valid token.
+
+        As in AuthZService, the request is replayed once with a new token on 401.
+        """
+        # created here, to be bound to the running loop
+        self._semaphore = self._semaphore or asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            token = await self.keycloak_service.get_authz_token()
+            _headers = {**headers, "Authorization": f"Bearer {token}"}
+            try:
+                return await async_request_with_retries(
+                    self.client, url=url, method="GET", headers=_headers
+                )
+            except RequestError as e:
+                if e.status_code != 401:
+                    raise
+            token = await self.keycloak_service.get_authz_token(force_refresh=True)
+            _headers = {**headers, "Authorization": f"Bearer {token}"}
+            return await async_request_with_retries(
+                self.client, url=url, method="GET", headers=_headers
+            )
+
+    async def _fetch_pages(self, url, headers):
+        """Fetch pages of results using token-based pagination."""
+        next_token = None
+
+        while True:
+            _url = f"{url}&limit={self.limit}"
+            if next_token:
+                _url += f"&token={next_token}"
+
+            with self.metrics.timer("authz_page_seconds"):
+                resp = await self._request(_url, headers)
+                data = resp.json()
+            self.metrics.incr("authz_pages")
+            yield data["data"]
+
+            next_token = data.get("pagination", {}).get("token")
+            if not next_token:
+                break
+
+    async def _fetch_all(self, url, headers):
+        """Fetch results page by page using token-based pagination."""
+        async for page in self._fetch_pages(url, headers):
+            for record in page:
+                yield record
+
+    async def _fetch_all_concurrently(self, url, headers, shards):
+        """Fetch the results of each shard concurrently.
+
+        At most `max_concurrency` requests are in flight at the same time. Results
+        are yielded as soon as each page is fetched, in no specific order.
+        """
+        # bounded, so that shards do not fetch faster than results are consumed
+        pages = asyncio.Queue(maxsize=self.max_concurrency * 2)
+
+        async def _fetch_shard(shard):
+            shard_url = url + "&" + urlencode([("filter", f) for f in shard])
+            try:
+                async for page in self._fetch_pages(shard_url, headers):
+                    await pages.put(page)
+            except Exception as e:
+                await pages.put(e)
+            finally:
+                await pages.put(_SHARD_DONE)
+
+        tasks = [asyncio.ensure_future(_fetch_shard(shard)) for shard in shards]
+        try:
+            pending = len(tasks)
+            while pending:
+                page = await pages.get()
+                if page is _SHARD_DONE:
+                    pending -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    for record in page:
+                        yield record
+        finally:
+            # stop the other shards on errors or when the consumer stops iterating
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def get_identities(
+        self, fields=IDENTITY_FIELDS, since=None, shards=None, filters=None
+    ):
+        """Return an async generator of all identities.
+
+        See `AuthZService.get_identities`.
+        """
+        headers = {"accept": "application/json"}
+        url_without_offset = build_identities_url(
+            self.base_url, self.limit, fields=fields, since=since, filters=filters
+        )
+        log_info(
+            "authz-client",
+            dict(
+                action="get_identities", params=f"since: {since}, limit: {self.limit}"
+            ),
+        )
+        shards = shards or current_app.config["CERN_SYNC_AUTHZ_IDENTITIES_SHARDS"]
+        if shards:
+            return self._fetch_all_concurrently(url_without_offset, headers, shards)
+        return self._fetch_all(url_without_offset, headers)
+
+    def get_groups(self, fields=GROUPS_FIELDS, since=None):
+        """Return an async generator of all groups.
+
+        See `AuthZService.get_groups`.
+        """
+        headers = {"accept": "application/json"}
+        url_without_offset = build_groups_url(
+            self.base_url, self.limit, fields=fields, since=since
+        )
+        log_info(
+            "authz-client",
+            dict(action="get_groups", params=f"since: {since}, limit: {self.limit}"),
+        )
+        return self._fetch_all(url_without_offset, headers)
+
+    async def aclose(self):
+        """Close the connections of the HTTP clients."""
+        await self.client.aclose()
+        if self.keycloak_service.client is not self.client:
+            await self.keycloak_service.aclose()
+
+
+def iter_sync(async_iterable, aclose=None, queue_size=None):
+    """Iterate an async iterable from synchronous code, e.g. a Celery task.
+
+    The iterable runs in a new event loop, in a background thread with the app
+    context of the caller, so that its requests overlap with the work of the
+    consumer, e.g. the DB writes. Up to `queue_size` items are fetched ahead: the
+    loop waits while the queue is full. Exceptions of the iterable are raised by
+    the consumer. When the consumer stops iterating, the iterable is closed and the
+    thread waited for.
+
+    :param aclose: coroutine function called when the iteration ends, e.g. to
+        close the HTTP clients.
+    :param queue_size: max number of items fetched ahead. Defaults to
+        `CERN_SYNC_PIPELINE_QUEUE_SIZE`.
+    """
+    app = current_app._get_current_object()
+    queue_size = queue_size or app.config["CERN_SYNC_PIPELINE_QUEUE_SIZE"]
+    items = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    async def _aput(item):
+        # without blocking the loop, e.g. the other shards fetched concurrently
+        while not stop.is_set():
+            try:
+                items.put_nowait(item)
+                return True
+            except queue.Full:
+                await asyncio.sleep(0.01)
+        return False
+
+    async def _produce():
+        iterator = async_iterable.__aiter__()
+        try:
+            while True:
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+                if not await _aput(item):
+                    return
+        finally:
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+
+    def _run():
+        result = _ITER_DONE
+        with app.app_context():
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(_produce())
+            except Exception as e:
+                result = e
+            finally:
+                try:
+                    if aclose:
+                        loop.run_until_complete(aclose())
+                finally:
+                    loop.close()
+        while not stop.is_set():
+            try:
+                items.put(result, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    thread = threading.Thread(target=_run, name="cern-sync-aio", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _ITER_DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # stop the loop at the next item, and wait for the clients to be closed
+        stop.set()
+        thread.join()
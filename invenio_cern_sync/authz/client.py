@@ -7,43 +7,136 @@
 
 """Invenio-CERN-sync CERN Authorization Service client."""
 
+import queue
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from urllib.parse import urlencode
 
 import requests
 from flask import current_app
+from requests.adapters import HTTPAdapter
 
-from ..errors import RequestError
-from ..logging import log_info
+from ..errors import CircuitOpenError, RequestError
+from ..logging import log_info, log_warning
+from ..metrics import NULL_METRICS
+from .retry import get_retry_policy
+
+
+class HTTPSession(requests.Session):
+    """Pooled HTTP session, applying a default timeout to each request."""
+
+    def __init__(self, timeout=None):
+        """Constructor."""
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        """Make a request, with the default timeout if not provided."""
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(*args, **kwargs)
+
+
+def create_http_session(pool_size=None, keep_alive=None, timeout=None):
+    """Create a new pooled HTTP session.
+
+    The session keeps the connections to the CERN services open, so that the
+    TCP and TLS handshakes are not repeated for each request.
+    Params not provided are taken from the `CERN_SYNC_HTTP_*` config.
+    """
+    config = current_app.config
+    pool_size = pool_size or config["CERN_SYNC_HTTP_POOL_SIZE"]
+    if keep_alive is None:
+        keep_alive = config["CERN_SYNC_HTTP_KEEP_ALIVE"]
+    timeout = timeout or config["CERN_SYNC_HTTP_TIMEOUT"]
+
+    session = HTTPSession(timeout=timeout)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if not keep_alive:
+        session.headers["Connection"] = "close"
+    return session
 
 
 def request_with_retries(
-    url, method="GET", payload=None, headers=None, retries=3, delay=5
+    url,
+    method="GET",
+    payload=None,
+    headers=None,
+    retries=None,
+    delay=None,
+    session=None,
+    policy=None,
 ):
-    """Make an HTTP request with retries."""
+    """Make an HTTP request with retries.
+
+    :param retries: max number of attempts. Defaults to the retry policy one.
+    :param delay: base backoff, in seconds. Defaults to the retry policy one.
+    :param session: the HTTP session to use. When not provided, a new connection
+        is opened for each request.
+    :param policy: the RetryPolicy deciding if and when to retry. Defaults to the
+        policy shared by all requests of the app.
+    """
+    http = session or requests
+    policy = policy or get_retry_policy()
+    retries = retries or policy.max_attempts
     for attempt in range(retries):
+        if policy.is_open(url):
+            raise CircuitOpenError(url)
         try:
             if method.upper() == "GET":
-                response = requests.get(url, headers=headers)
+                response = http.get(url, headers=headers)
             elif method.upper() == "POST":
-                response = requests.post(url, data=payload, headers=headers)
+                response = http.post(url, data=payload, headers=headers)
             else:
                 raise ValueError("Unsupported HTTP method")
             response.raise_for_status()  # Raise an error for bad status codes (4xx/5xx)
+            policy.record_success(url)
             return response
         except requests.exceptions.RequestException as e:
-            if attempt < retries - 1:
-                time.sleep(delay)
-            else:
-                raise RequestError(url, str(e))
+            status_code = getattr(e.response, "status_code", None)
+            policy.record_failure(url, status_code)
+            if not policy.is_retryable(status_code) or attempt == retries - 1:
+                raise RequestError(url, str(e), status_code=status_code)
+
+            wait = policy.get_delay(attempt, response=e.response, backoff=delay)
+            log_warning(
+                "authz-client",
+                dict(
+                    action="retrying-request",
+                    url=url,
+                    attempt=attempt + 1,
+                    status_code=status_code,
+                    delay=wait,
+                ),
+            )
+            policy.sleep(wait)
+
+
+AUTHZ_AUDIENCE = "authorization-service-api"
+"""Audience of the Keycloak tokens to authenticate to the Authz service."""
+
+_tokens = dict()
+_tokens_lock = threading.Lock()
+
+
+def clear_tokens_cache():
+    """Clear the cached Keycloak tokens."""
+    with _tokens_lock:
+        _tokens.clear()
 
 
 class KeycloakService:
     """Connect to the CERN Keycloak service."""
 
-    def __init__(self, base_url=None, client_id=None, client_secret=None):
-        """Constructor."""
+    def __init__(self, base_url=None, client_id=None, client_secret=None, session=None):
+        """Constructor.
+
+        :param session: the HTTP session to use, which can be shared with the
+            AuthZService. A new pooled session is created when not provided.
+        """
         self.base_url = base_url or current_app.config["CERN_SYNC_KEYCLOAK_BASE_URL"]
         self.client_id = (
             client_id or current_app.config["CERN_APP_CREDENTIALS"]["consumer_key"]
@@ -52,18 +145,39 @@ class KeycloakService:
             client_secret
             or current_app.config["CERN_APP_CREDENTIALS"]["consumer_secret"]
         )
+        self.session = session or create_http_session()
+        self.token_leeway = current_app.config["CERN_SYNC_KEYCLOAK_TOKEN_LEEWAY"]
 
-    def get_authz_token(self):
-        """Get a token to authenticate to the Authz service."""
-        token_url = f"{self.base_url}/auth/realms/cern/api-access/token"
-        token_data = {
-            "grant_type": "client_credentials",
-            "client_id": self.client_id,
-            "client_secret": self.client_secret,
-            "audience": "authorization-service-api",
-        }
-        resp = request_with_retries(url=token_url, method="POST", payload=token_data)
-        return resp.json()["access_token"]
+    def get_authz_token(self, force_refresh=False):
+        """Get a token to authenticate to the Authz service.
+
+        Tokens are cached per client id and audience, and shared by all instances
+        in the same process. A new token is requested when the cached one is about
+        to expire, or when `force_refresh` is True.
+        """
+        audience = AUTHZ_AUDIENCE
+        key = (self.base_url, self.client_id, audience)
+        with _tokens_lock:
+            token, expires_at = _tokens.get(key, (None, 0))
+            if token and not force_refresh and time.time() < expires_at:
+                return token
+
+            token_url = f"{self.base_url}/auth/realms/cern/api-access/token"
+            token_data = {
+                "grant_type": "client_credentials",
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+                "audience": audience,
+            }
+            resp = request_with_retries(
+                url=token_url, method="POST", payload=token_data, session=self.session
+            )
+            data = resp.json()
+            token = data["access_token"]
+            # refresh the token before it expires, to not fail mid-request
+            expires_in = data.get("expires_in") or 0
+            _tokens[key] = (token, time.time() + expires_in - self.token_leeway)
+            return token
 
 
 IDENTITY_FIELDS = [
@@ -92,34 +206,224 @@ GROUPS_FIELDS = [
 ]
 
 
+def _since_filter(since):
+    """Return the AuthZ filter of the records modified since the given ISO date."""
+    dt = datetime.fromisoformat(since)
+    str_dt = dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+    return ("filter", f"modificationTime:gt:{str_dt}")
+
+
+def build_identities_url(
+    base_url, limit, fields=IDENTITY_FIELDS, since=None, filters=None
+):
+    """Return the url of the query of the active CERN identities.
+
+    :param filters: extra AuthZ filters, e.g. one of `PERSON_ID_SHARDS`.
+    """
+    query_params = [
+        ("limit", limit),
+        ("filter", "type:Person"),
+        ("filter", "source:cern"),
+        ("filter", "activeUser:true"),
+    ]
+    query_params += [("filter", value) for value in filters or []]
+    query_params += [("field", value) for value in fields]
+    if since:
+        query_params.append(_since_filter(since))
+    query_string = urlencode(query_params)
+    return f"{base_url}/api/v1.0/Identity?{query_string}"
+
+
+def build_groups_url(base_url, limit, fields=GROUPS_FIELDS, since=None):
+    """Return the url of the query of the CERN groups."""
+    query_params = [
+        ("limit", limit),
+    ]
+    query_params += [("field", value) for value in fields]
+    if since:
+        query_params.append(_since_filter(since))
+    query_string = urlencode(query_params)
+    return f"{base_url}/api/v1.0/Group?{query_string}"
+
+
+PERSON_ID_SHARDS = [[f"personId:endswith:{digit}"] for digit in range(10)]
+"""Disjoint filters, partitioning the identities by the last digit of `personId`.
+
+The `personId` of the CERN persons is numeric: its last digit is one of 0-9, so
+each identity matches exactly one of the filters. They use the `endswith` suffix
+match of the AuthZ `field:operator:value` filters, as `modificationTime:gt`. The
+shards check that the fetched identities match their filters, see `in_shard`.
+"""
+
+
+def in_shard(identity, shard):
+    """Return True if the identity matches the `endswith` filters of the shard.
+
+    The other filters are not checked.
+    """
+    for value in shard:
+        parts = value.split(":", 2)
+        if len(parts) == 3 and parts[1] == "endswith":
+            field, _, suffix = parts
+            if not str(identity.get(field, "")).endswith(suffix):
+                return False
+    return True
+
+
+_SHARD_DONE = object()
+
+
 class AuthZService:
     """Query CERN Authz service."""
 
-    def __init__(self, keycloak_service, base_url=None, limit=1000, max_threads=3):
-        """Constructor."""
+    def __init__(
+        self,
+        keycloak_service,
+        base_url=None,
+        limit=1000,
+        max_threads=3,
+        session=None,
+        metrics=None,
+    ):
+        """Constructor.
+
+        :param session: the HTTP session to use. Defaults to the session of the
+            Keycloak service, so that both share the same connection pool.
+        :param metrics: the SyncMetrics of the run, where the pages are counted.
+        """
         self.keycloak_service = keycloak_service
         self.base_url = base_url or current_app.config["CERN_SYNC_AUTHZ_BASE_URL"]
         self.limit = limit
         self.max_threads = max_threads
+        self.metrics = metrics or NULL_METRICS
+        self.session = (
+            session
+            or getattr(keycloak_service, "session", None)
+            or create_http_session()
+        )
+
+    def _request(self, url, headers):
+        """Request a page of results, with a valid token.
+
+        The token is refreshed before it expires and, if it is rejected anyway,
+        refreshed and the request replayed once.
+        """
+        token = self.keycloak_service.get_authz_token()
+        headers = {**headers, "Authorization": f"Bearer {token}"}
+        try:
+            return request_with_retries(
+                url=url, method="GET", headers=headers, session=self.session
+            )
+        except RequestError as e:
+            if e.status_code != 401:
+                raise
+        token = self.keycloak_service.get_authz_token(force_refresh=True)
+        headers = {**headers, "Authorization": f"Bearer {token}"}
+        return request_with_retries(
+            url=url, method="GET", headers=headers, session=self.session
+        )
 
-    def _fetch_all(self, url, headers):
-        """Fetch results page by page using token-based pagination."""
-        next_token = None
+    def _fetch_pages(self, url, headers, position=None):
+        """Fetch pages of results using token-based pagination.
+
+        :param position: when given, the pagination starts from its `token`, and
+            the dict is updated with the token of each page before yielding it.
+        """
+        next_token = position.get("token") if position else None
 
         while True:
             _url = f"{url}&limit={self.limit}"
             if next_token:
                 _url += f"&token={next_token}"
 
-            resp = request_with_retries(url=_url, method="GET", headers=headers)
-            data = resp.json()
-            yield from data["data"]
+            with self.metrics.timer("authz_page_seconds"):
+                resp = self._request(_url, headers)
+                data = resp.json()
+            self.metrics.incr("authz_pages")
+            if position is not None:
+                position.update(token=next_token, offset=0)
+            yield data["data"]
 
             next_token = data.get("pagination", {}).get("token")
             if not next_token:
                 break
 
-    def get_identities(self, fields=IDENTITY_FIELDS, since=None):
+    def _fetch_all(self, url, headers, position=None):
+        """Fetch results page by page using token-based pagination.
+
+        :param position: dict updated with the `token` of the current page and the
+            `offset` in it of the last yielded result. When not empty, results are
+            fetched from this position, e.g. to resume an interrupted sync.
+        """
+        offset = position.get("offset", 0) if position else 0
+        for page in self._fetch_pages(url, headers, position=position):
+            for result in page[offset:]:
+                offset += 1
+                if position is not None:
+                    position["offset"] = offset
+                yield result
+            offset = 0
+
+    def _fetch_all_concurrently(self, url, headers, shards):
+        """Fetch the results of each shard in parallel, in `max_threads` threads.
+
+        Each shard is a list of extra filters, added to the query. Shards must be
+        disjoint and, together, cover all the results of the query.
+        Results are yielded as soon as each page is fetched, in no specific order.
+        """
+        app = current_app._get_current_object()
+        # bounded, so that threads do not fetch faster than results are consumed
+        pages = queue.Queue(maxsize=self.max_threads * 2)
+        stop = threading.Event()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def _fetch_shard(shard):
+            shard_url = url + "&" + urlencode([("filter", f) for f in shard])
+            try:
+                with app.app_context():
+                    for page in self._fetch_pages(shard_url, headers):
+                        if stop.is_set():
+                            return
+                        _put(page)
+            except Exception as e:
+                _put(e)
+            finally:
+                _put(_SHARD_DONE)
+
+        executor = ThreadPoolExecutor(max_workers=self.max_threads)
+        try:
+            for shard in shards:
+                executor.submit(_fetch_shard, shard)
+
+            pending = len(shards)
+            while pending:
+                page = pages.get()
+                if page is _SHARD_DONE:
+                    pending -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield from page
+        finally:
+            # stop the other threads on errors or when the consumer stops iterating
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_identities(
+        self,
+        fields=IDENTITY_FIELDS,
+        since=None,
+        shards=None,
+        position=None,
+        filters=None,
+    ):
         """Get all identities.
 
         It will retrieve all user identities (type:Person), with a primary account
@@ -131,6 +435,13 @@ class AuthZService:
             Defaults to IDENTITY_FIELDS.
         :param since (string, ISO format, optional): If provided, filters identities
             modified since this date (includes the ones created since this date).
+        :param shards (list, optional): List of disjoint filters, to fetch
+            identities in parallel. Defaults to `CERN_SYNC_AUTHZ_IDENTITIES_SHARDS`.
+        :param position (dict, optional): The pagination position, kept up to date
+            and resumed from when not empty. See `_fetch_all`. It is not tracked
+            when fetching shards in parallel.
+        :param filters (list, optional): Extra filters of the identities, e.g. to
+            fetch only one of `PERSON_ID_SHARDS`.
         :return list: A list of user identities matching the criteria.
         """
         token = self.keycloak_service.get_authz_token()
@@ -139,27 +450,19 @@ class AuthZService:
             "accept": "application/json",
         }
 
-        query_params = [
-            ("limit", self.limit),
-            ("filter", "type:Person"),
-            ("filter", "source:cern"),
-            ("filter", "activeUser:true"),
-        ]
-        query_params += [("field", value) for value in fields]
-        if since:
-            dt = datetime.fromisoformat(since)
-            str_dt = dt.strftime("%Y-%m-%dT%H:%M:%SZ")
-            query_params.append(("filter", f"modificationTime:gt:{str_dt}"))
-        query_string = urlencode(query_params)
-
-        url_without_offset = f"{self.base_url}/api/v1.0/Identity?{query_string}"
+        url_without_offset = build_identities_url(
+            self.base_url, self.limit, fields=fields, since=since, filters=filters
+        )
         log_info(
             "authz-client",
             dict(
                 action="get_identities", params=f"since: {since}, limit: {self.limit}"
             ),
         )
-        return self._fetch_all(url_without_offset, headers)
+        shards = shards or current_app.config["CERN_SYNC_AUTHZ_IDENTITIES_SHARDS"]
+        if shards and self.max_threads > 1:
+            return self._fetch_all_concurrently(url_without_offset, headers, shards)
+        return self._fetch_all(url_without_offset, headers, position=position)
 
     def get_groups(self, fields=GROUPS_FIELDS, since=None):
         """Get all groups.
@@ -176,17 +479,9 @@ class AuthZService:
             "accept": "application/json",
         }
 
-        query_params = [
-            ("limit", self.limit),
-        ]
-        query_params += [("field", value) for value in fields]
-        if since:
-            dt = datetime.fromisoformat(since)
-            str_dt = dt.strftime("%Y-%m-%dT%H:%M:%SZ")
-            query_params.append(("filter", f"modificationTime:gt:{str_dt}"))
-        query_string = urlencode(query_params)
-
-        url_without_offset = f"{self.base_url}/api/v1.0/Group?{query_string}"
+        url_without_offset = build_groups_url(
+            self.base_url, self.limit, fields=fields, since=since
+        )
         log_info(
             "authz-client",
             dict(action="get_groups", params=f"since: {since}, limit: {self.limit}"),
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-CERN-sync retry policy of the requests to the CERN services."""
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+from flask import current_app
+
+
+def _endpoint(url):
+    """Return the endpoint of the url, without the query string."""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}{parts.path}"
+
+
+def _parse_retry_after(value):
+    """Return the seconds to wait from a `Retry-After` header value, or None."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """Retry failed requests with exponential backoff and jitter.
+
+    Only connection errors, timeouts and the `retry_statuses` are retried: any
+    other error status fails immediately. The `Retry-After` header of 429 and
+    503 responses is honored, up to `max_backoff` seconds.
+
+    Each endpoint has a circuit breaker: after `failure_threshold` consecutive
+    failed requests, the circuit opens and requests to that endpoint fail
+    immediately for `reset_timeout` seconds. After that, the circuit is half-open:
+    a single probe request is let through while the others are still rejected.
+    The circuit closes if the probe succeeds, and opens again for `reset_timeout`
+    seconds if it fails. A probe not recorded within `reset_timeout` seconds is
+    considered lost, and another one is let through.
+
+    The `stats` dict counts retries, seconds spent sleeping and failures.
+    """
+
+    def __init__(
+        self,
+        max_attempts=None,
+        backoff=None,
+        max_backoff=None,
+        retry_statuses=None,
+        failure_threshold=None,
+        reset_timeout=None,
+    ):
+        """Constructor.
+
+        Params not provided are taken from the `CERN_SYNC_HTTP_RETRY_*` and
+        `CERN_SYNC_HTTP_CIRCUIT_BREAKER_*` config.
+        """
+        config = current_app.config
+        self.max_attempts = max_attempts or config["CERN_SYNC_HTTP_RETRY_ATTEMPTS"]
+        self.backoff = backoff or config["CERN_SYNC_HTTP_RETRY_BACKOFF"]
+        self.max_backoff = max_backoff or config["CERN_SYNC_HTTP_RETRY_MAX_BACKOFF"]
+        self.retry_statuses = set(
+            retry_statuses or config["CERN_SYNC_HTTP_RETRY_STATUSES"]
+        )
+        self.failure_threshold = (
+            failure_threshold or config["CERN_SYNC_HTTP_CIRCUIT_BREAKER_THRESHOLD"]
+        )
+        self.reset_timeout = (
+            reset_timeout or config["CERN_SYNC_HTTP_CIRCUIT_BREAKER_TIMEOUT"]
+        )
+        self.stats = dict(requests=0, retries=0, failures=0, rejected=0, sleep_time=0)
+        self._failures = dict()  # endpoint -> consecutive failures
+        self._opened_at = dict()  # endpoint -> time when the circuit opened
+        self._probing = dict()  # endpoint -> time when the probe was let through
+        self._lock = threading.Lock()
+
+    def is_retryable(self, status_code):
+        """Return True if a request failed with the given status can be retried.
+
+        :param status_code: the response status, None for connection errors.
+        """
+        return status_code is None or status_code in self.retry_statuses
+
+    def get_delay(self, attempt, response=None, backoff=None):
+        """Return the seconds to wait before the next attempt.
+
+        :param attempt: the number of the failed attempt, starting from 0.
+        :param response: the failed response, if any.
+        :param backoff: override the base backoff, in seconds.
+        """
+        status_code = getattr(response, "status_code", None)
+        if status_code in (429, 503):
+            retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                return min(retry_after, self.max_backoff)
+
+        delay = min((backoff or self.backoff) * 2**attempt, self.max_backoff)
+        # equal jitter: avoid synchronized retries of concurrent requests
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def is_open(self, url):
+        """Return True if the requests to the url must fail immediately."""
+        endpoint = _endpoint(url)
+        with self._lock:
+            opened_at = self._opened_at.get(endpoint)
+            if opened_at is None:
+                return False
+            now = time.monotonic()
+            if now - opened_at >= self.reset_timeout:
+                probing = self._probing.get(endpoint)
+                if probing is None or now - probing >= self.reset_timeout:
+                    # half-open: let a single probe through
+                    self._probing[endpoint] = now
+                    return False
+            self.stats["rejected"] += 1
+            return True
+
+    def record_success(self, url):
+        """Record a successful request, closing the circuit of its endpoint."""
+        endpoint = _endpoint(url)
+        with self._lock:
+            self.stats["requests"] += 1
+            self._close(endpoint)
+
+    def record_failure(self, url, status_code=None):
+        """Record a failed request, opening the circuit after too many failures."""
+        endpoint = _endpoint(url)
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["failures"] += 1
+            if not self.is_retryable(status_code):
+                # the endpoint answered: it is not unavailable
+                if endpoint in self._probing:
+                    self._close(endpoint)
+                return
+            # a failed probe opens the circuit again
+            self._probing.pop(endpoint, None)
+            failures = self._failures.get(endpoint, 0) + 1
+            self._failures[endpoint] = failures
+            if failures >= self.failure_threshold:
+                self._opened_at[endpoint] = time.monotonic()
+
+    def _close(self, endpoint):
+        """Close the circuit of the endpoint. Must be called with the lock held."""
+        self._failures.pop(endpoint, None)
+        self._opened_at.pop(endpoint, None)
+        self._probing.pop(endpoint, None)
+
+    def record_retry(self, delay):
+        """Record a retry and the seconds spent waiting for it."""
+        with self._lock:
+            self.stats["retries"] += 1
+            self.stats["sleep_time"] += delay
+
+    def sleep(self, delay):
+        """Wait before retrying."""
+        self.record_retry(delay)
+        time.sleep(delay)
+
+
+def get_retry_policy():
+    """Return the retry policy shared by the requests of the current app."""
+    ext = current_app.extensions["invenio-cern-sync"]
+    if ext.retry_policy is None:
+        ext.retry_policy = current_app.config["CERN_SYNC_HTTP_RETRY_POLICY"]()
+    return ext.retry_policy
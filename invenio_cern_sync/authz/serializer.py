@@ -12,10 +12,16 @@ from flask import current_app
 from ..errors import InvalidCERNIdentity
 
 
-def serialize_cern_identity(cern_identity):
+def serialize_cern_identity(
+    cern_identity, userprofile_mapper=None, extra_data_mapper=None
+):
     """Serialize CERN identity to Invenio user."""
-    userprofile_mapper = current_app.config["CERN_SYNC_AUTHZ_USERPROFILE_MAPPER"]
-    extra_data_mapper = current_app.config["CERN_SYNC_AUTHZ_USER_EXTRADATA_MAPPER"]
+    userprofile_mapper = (
+        userprofile_mapper or current_app.config["CERN_SYNC_AUTHZ_USERPROFILE_MAPPER"]
+    )
+    extra_data_mapper = (
+        extra_data_mapper or current_app.config["CERN_SYNC_AUTHZ_USER_EXTRADATA_MAPPER"]
+    )
     try:
         # The assumption here is that we only sync CERN primary accounts.
         # The personId does not exist for external accounts (EduGain, social logins or guest accounts)
@@ -41,10 +47,17 @@ def serialize_cern_identity(cern_identity):
 
 
 def serialize_cern_identities(cern_identities):
-    """Serialize CERN identities to Invenio users."""
+    """Serialize CERN identities to Invenio users.
+
+    The mappers are resolved from the config once, and not for each identity.
+    """
+    userprofile_mapper = current_app.config["CERN_SYNC_AUTHZ_USERPROFILE_MAPPER"]
+    extra_data_mapper = current_app.config["CERN_SYNC_AUTHZ_USER_EXTRADATA_MAPPER"]
     for cern_identity in cern_identities:
         try:
-            yield serialize_cern_identity(cern_identity)
+            yield serialize_cern_identity(
+                cern_identity, userprofile_mapper, extra_data_mapper
+            )
         except InvalidCERNIdentity as e:
             current_app.logger.warning(str(e) + " Skipping this identity...")
             continue
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-CERN-sync checkpoints, to resume interrupted sync runs.
+
+The checkpoint of a run is saved in the same transaction as each chunk of
+updated users, with the pagination position of the last record of the chunk and
+the users to insert at the end of the run. When the run fails, e.g. on a
+`RequestError` or because the worker was killed, the next run with the same
+params resumes from it, instead of fetching and reconciling all users again.
+"""
+
+from datetime import datetime, timezone
+
+from flask import current_app
+from invenio_db import db
+
+from .logging import log_info, log_warning
+from .models import CERNSyncCheckpoint
+from .state import utcnow
+from .utils import fingerprint
+
+
+def _get_valid(kind):
+    """Return the checkpoint of the given kind, if saved within the validity."""
+    checkpoint = db.session.get(CERNSyncCheckpoint, kind)
+    validity = current_app.config["CERN_SYNC_USERS_CHECKPOINT_VALIDITY"]
+    now = datetime.now(tz=timezone.utc)
+    if checkpoint and now - checkpoint.updated <= validity:
+        return checkpoint
+    return None
+
+
+def get_resumed_started_at(kind):
+    """Return the start time of the run that the next run of this kind resumes.
+
+    The next successful run must save it as watermark, instead of its own start
+    time, as the records fetched before the checkpoint were not fetched again.
+    """
+    checkpoint = _get_valid(kind)
+    return checkpoint.started_at if checkpoint else None
+
+
+class SyncCheckpoint:
+    """Checkpoints of a sync run."""
+
+    def __init__(self, kind, params, log_uuid):
+        """Constructor.
+
+        :param kind: the kind of sync, e.g. `users-AuthZ`.
+        :param params: the params of the run, which must be the same to resume it.
+        :param log_uuid: the uuid of the logs of the run.
+        """
+        self.kind = kind
+        self.params_hash = fingerprint(params)
+        self.log_uuid = log_uuid
+        self.started_at = utcnow()
+        self.position = dict()
+        self.missing = []
+        self._run_missing = []
+        self.processed = 0
+        self.resumed = False
+        self.saved = False
+        self.enabled = current_app.config["CERN_SYNC_USERS_CHECKPOINTS"]
+
+    def resume(self):
+        """Load the checkpoint of a previous run with the same params, if any.
+
+        :return: True if the run resumes from the checkpoint.
+        """
+        if not self.enabled:
+            return False
+        checkpoint = _get_valid(self.kind)
+        if not checkpoint or checkpoint.params_hash != self.params_hash:
+            return False
+        self.log_uuid = checkpoint.log_uuid
+        self.started_at = checkpoint.started_at
+        self.position = dict(checkpoint.position)
+        self.missing = list(checkpoint.missing)
+        self.processed = checkpoint.processed
+        self.resumed = True
+        log_info(
+            "sync-checkpoint",
+            dict(
+                action="resuming",
+                kind=self.kind,
+                processed=self.processed,
+                missing=len(self.missing),
+            ),
+            log_uuid=self.log_uuid,
+        )
+        return True
+
+    def save(self, missing, processed):
+        """Add the checkpoint to the session, to be committed with the chunk.
+
+        Nothing is saved when the fetching does not track its position, e.g. when
+        fetching in parallel. Checkpoints stop when the users to insert exceed
+        `CERN_SYNC_USERS_CHECKPOINT_MAX_MISSING`, e.g. in the first sync.
+
+        :param missing: the users to insert of the chunk being committed.
+        :param processed: the number of users committed by this run so far.
+        """
+        if not self.enabled:
+            return
+        # kept apart from the users buffered by the run, to not read them back
+        self._run_missing.extend(missing)
+        count = len(self.missing) + len(self._run_missing)
+        if count > current_app.config["CERN_SYNC_USERS_CHECKPOINT_MAX_MISSING"]:
+            log_warning(
+                "sync-checkpoint",
+                dict(action="disabled", kind=self.kind, missing=count),
+                log_uuid=self.log_uuid,
+            )
+            self.enabled = False
+            self._run_missing = []
+            self.delete()
+            return
+        if not self.position:
+            return
+
+        checkpoint = db.session.get(CERNSyncCheckpoint, self.kind)
+        if not checkpoint:
+            checkpoint = CERNSyncCheckpoint(kind=self.kind)
+            db.session.add(checkpoint)
+        checkpoint.log_uuid = self.log_uuid
+        checkpoint.params_hash = self.params_hash
+        checkpoint.started_at = self.started_at
+        checkpoint.position = dict(self.position)
+        checkpoint.missing = self.missing + self._run_missing
+        checkpoint.processed = self.processed + processed
+        self.saved = True
+
+    def delete(self):
+        """Delete the checkpoint of this kind, without committing."""
+        db.session.query(CERNSyncCheckpoint).filter_by(kind=self.kind).delete()
+
+    def discard_if_unusable(self):
+        """Delete the resumed checkpoint, when the run failed before saving a new one.
+
+        The position might not be valid anymore, e.g. an expired AuthZ token or an
+        LDAP cookie of another connection: the next run then starts over, instead
+        of failing again at the same position.
+        """
+        if not self.resumed or self.saved:
+            return
+        db.session.rollback()
+        self.delete()
+        db.session.commit()
+        log_warning(
+            "sync-checkpoint",
+            dict(action="discarded", kind=self.kind),
+            log_uuid=self.log_uuid,
+        )
@@ -7,10 +7,16 @@
 
 """Integrates CERN databases with Invenio."""
 
+from datetime import timedelta
+
 from .authz.mapper import remoteaccount_extradata_mapper as authz_extradata_mapper
 from .authz.mapper import userprofile_mapper as authz_userprofile_mapper
+from .authz.retry import RetryPolicy
 from .ldap.mapper import remoteaccount_extradata_mapper as ldap_extradata_mapper
 from .ldap.mapper import userprofile_mapper as ldap_userprofile_mapper
+from .locks import DBSyncLock
+from .metrics import LogMetricsSink
+from .state import DBSyncStateStore
 
 ###################################################################################
 # CERN AuthZ
@@ -19,6 +25,9 @@ from .ldap.mapper import userprofile_mapper as ldap_userprofile_mapper
 CERN_SYNC_KEYCLOAK_BASE_URL = "https://keycloak-qa.cern.ch/"
 """Base URL of the CERN SSO Keycloak endpoint."""
 
+CERN_SYNC_KEYCLOAK_TOKEN_LEEWAY = 60
+"""Seconds before its expiration when the cached Keycloak token is refreshed."""
+
 CERN_SYNC_AUTHZ_BASE_URL = "https://authorization-service-api-qa.web.cern.ch/"
 """Base URL of the Authorization Service API endpoint."""
 
@@ -31,6 +40,63 @@ The user profile schema is defined via ACCOUNTS_USER_PROFILE_SCHEMA.
 CERN_SYNC_AUTHZ_USER_EXTRADATA_MAPPER = authz_extradata_mapper
 """Map the AuthZ response to the Invenio RemoteAccount `extra_data` db col."""
 
+CERN_SYNC_AUTHZ_IDENTITIES_SHARDS = None
+"""List of disjoint filters used to fetch identities in parallel.
+
+Each shard is a list of AuthZ filters, and all shards together must cover all
+identities. Shards are fetched in parallel with `max_threads` threads, for example:
+
+.. code-block:: python
+
+    from invenio_cern_sync.authz.client import PERSON_ID_SHARDS
+    CERN_SYNC_AUTHZ_IDENTITIES_SHARDS = PERSON_ID_SHARDS
+
+When not set, identities are fetched one page at a time.
+"""
+
+CERN_SYNC_AUTHZ_ASYNC = False
+"""Fetch users and groups with the asyncio client.
+
+It requires the `async` extra dependency. Requests are sent concurrently, up to
+`CERN_SYNC_HTTP_POOL_SIZE` at once, without a thread per request, in one event
+loop running in a background thread while the records are written to the DB, see
+`iter_sync`. When set, the `authz_service` and `keycloak_service` params of the
+sync functions are passed to `AsyncAuthZService` and `AsyncKeycloakService`.
+"""
+
+CERN_SYNC_HTTP_POOL_SIZE = 10
+"""Max number of connections kept open to the Keycloak and AuthZ services."""
+
+CERN_SYNC_HTTP_KEEP_ALIVE = True
+"""Reuse the connections to the Keycloak and AuthZ services between requests."""
+
+CERN_SYNC_HTTP_TIMEOUT = 60
+"""Timeout, in seconds, of each request to the Keycloak and AuthZ services.
+
+It can also be a `(connect timeout, read timeout)` tuple.
+"""
+
+CERN_SYNC_HTTP_RETRY_POLICY = RetryPolicy
+"""Factory of the retry policy of the requests to the Keycloak and AuthZ services."""
+
+CERN_SYNC_HTTP_RETRY_ATTEMPTS = 3
+"""Max number of attempts of each request."""
+
+CERN_SYNC_HTTP_RETRY_BACKOFF = 1
+"""Base delay, in seconds, before retrying. It doubles after each attempt."""
+
+CERN_SYNC_HTTP_RETRY_MAX_BACKOFF = 60
+"""Max delay, in seconds, before retrying, including `Retry-After` delays."""
+
+CERN_SYNC_HTTP_RETRY_STATUSES = [429, 500, 502, 503, 504]
+"""Response statuses that are retried. Other error statuses fail immediately."""
+
+CERN_SYNC_HTTP_CIRCUIT_BREAKER_THRESHOLD = 5
+"""Consecutive failed requests after which an endpoint is considered unavailable."""
+
+CERN_SYNC_HTTP_CIRCUIT_BREAKER_TIMEOUT = 60
+"""Seconds during which requests to an unavailable endpoint fail immediately."""
+
 
 ###################################################################################
 # CERN LDAP
@@ -47,3 +113,255 @@ The user profile schema is defined via ACCOUNTS_USER_PROFILE_SCHEMA.
 
 CERN_SYNC_LDAP_USER_EXTRADATA_MAPPER = ldap_extradata_mapper
 """Map the LDAP response to the Invenio RemoteAccount `extra_data` db col."""
+
+CERN_SYNC_LDAP_PAGE_SIZE = 1000
+"""Number of LDAP entries fetched per page, and kept in memory, when syncing."""
+
+CERN_SYNC_LDAP_INCREMENTAL = False
+"""Fetch only the LDAP entries modified since the previous successful sync task.
+
+The `whenChanged` attribute is compared with the watermark of the previous run,
+as with AuthZ, and a full sync is done every `CERN_SYNC_FULL_SYNC_INTERVAL`. As
+`whenChanged` is not replicated, the entries modified during the replication
+delay before the watermark might be missed until the next full sync.
+"""
+
+CERN_SYNC_LDAP_PARTITIONS = None
+"""List of disjoint filters used to search the LDAP entries in parallel.
+
+All partitions together must cover all entries. They are searched in parallel,
+on up to `CERN_SYNC_LDAP_MAX_CONNECTIONS` connections, and the entries are read
+as they arrive, for example:
+
+.. code-block:: python
+
+    from invenio_cern_sync.ldap.client import CN_PARTITIONS
+    CERN_SYNC_LDAP_PARTITIONS = CN_PARTITIONS
+
+When not set, entries are fetched one page at a time, on one connection.
+"""
+
+CERN_SYNC_LDAP_MAX_CONNECTIONS = 4
+"""Max number of LDAP connections, when searching partitions in parallel."""
+
+
+###################################################################################
+# Fetching pipeline
+
+CERN_SYNC_PIPELINE = False
+"""Fetch and serialize the records in background threads, while syncing them.
+
+The users and groups are fetched and serialized ahead of the DB writes, in two
+threads, so that the network and the DB are used at the same time. A users run
+resuming from a checkpoint is not pipelined, and the position of a pipelined run
+is not checkpointed.
+"""
+
+CERN_SYNC_PIPELINE_QUEUE_SIZE = 5000
+"""Max number of records fetched or serialized ahead of the next stage."""
+
+
+###################################################################################
+# Users sync
+
+CERN_SYNC_USERS_BULK_LOOKUP = True
+"""Fetch the local users of each batch with one query per table.
+
+When disabled, the local `User`, `UserIdentity` and `RemoteAccount` of each CERN
+user are fetched one by one.
+"""
+
+CERN_SYNC_USERS_BULK_INSERT = True
+"""Create the new users of each batch with batched INSERTs.
+
+When a batch fails, for example because of a duplicated e-mail, its users are
+created again one by one, skipping the invalid ones. When disabled, users are
+always created one by one.
+"""
+
+CERN_SYNC_USERS_STAGING = False
+"""Reconcile all the CERN users at once, with set-based statements, on PostgreSQL.
+
+All the fetched users are copied to a temporary table, then the changed local
+users are updated with a few `UPDATE ... FROM` statements, in one transaction.
+When they cannot be updated at once, e.g. because of a conflicting e-mail, they
+are updated in batches. Runs are not checkpointed. Ignored on other databases.
+"""
+
+CERN_SYNC_USERS_SKIP_UNCHANGED = True
+"""Skip the users that did not change in the CERN database since the last sync.
+
+A hash of each synced user is stored in the `RemoteAccount.extra_data`, and the
+user tables are compared and updated only when the hash changes. Local changes
+to the synced fields are then not reverted until the CERN data changes.
+"""
+
+CERN_SYNC_USERS_MISSING_MAX_MEMORY = 4 * 1024 * 1024
+"""Max size, in bytes, of the new users kept in memory by a users sync.
+
+New users are inserted once all the existing ones are updated. Beyond this size,
+they are written to a temporary file until then.
+"""
+
+CERN_SYNC_USERS_MAX_RSS_MB = None
+"""Max resident memory, in MB, of the process running a users sync.
+
+It is checked after each chunk of users, once the DB objects of the chunk are
+released from the session. When exceeded, the run fails with
+`MemoryLimitExceeded`: the next run resumes from its last checkpoint, see
+`CERN_SYNC_USERS_CHECKPOINTS`, e.g. in a new Celery worker process.
+"""
+
+CERN_SYNC_USERS_SHARDS = None
+"""Disjoint filters of the users updated in parallel, per method, in the sharded sync.
+
+Each shard is fetched and updated by its own Celery task, and all shards together
+must cover all users. When not set, AuthZ users are sharded by the last digit of
+their `personId` and LDAP users by the initial of their `cn`, as with:
+
+.. code-block:: python
+
+    from invenio_cern_sync.authz.client import PERSON_ID_SHARDS
+    from invenio_cern_sync.ldap.client import CN_PARTITIONS
+    CERN_SYNC_USERS_SHARDS = dict(AuthZ=PERSON_ID_SHARDS, LDAP=CN_PARTITIONS)
+
+See `invenio_cern_sync.tasks.sync_users_sharded`.
+"""
+
+CERN_SYNC_USERS_DEACTIVATE_DEPARTED = False
+"""Deactivate the local CERN users not returned by a full sync, e.g. who left CERN.
+
+Users are never deactivated by delta syncs. Deactivated users are not reactivated
+if they are returned again by a later sync.
+"""
+
+CERN_SYNC_USERS_DEPARTED_MAX_RATIO = 0.05
+"""Max ratio of the local CERN users deactivated by a sync.
+
+When more users would be deactivated, for example because of a partial response
+of the CERN database, none is deactivated and an error is logged.
+"""
+
+CERN_SYNC_USERS_CHANGES_RETENTION = None
+"""Time after which the recorded e-mail/username and identity id changes are deleted.
+
+The changes are stored in the `cern_sync_user_change` table, and the ones older
+than this timedelta deleted at the end of each sync. When None, they are kept.
+"""
+
+CERN_SYNC_SNAPSHOTS_DIR = None
+"""Directory of the snapshots of the users fetched by the previous full sync.
+
+When set, each full sync, e.g. via LDAP, only reconciles the users added or
+changed since the previous one, compared with the hash of each user in the
+snapshot. See `invenio_cern_sync.snapshots`. The directory must be persistent
+and not shared by different instances.
+"""
+
+CERN_SYNC_SNAPSHOT_MAX_AGE = timedelta(days=30)
+"""Max age of the snapshot of the previous full sync.
+
+When older, all users are reconciled again, e.g. to revert local changes of the
+synced fields. It must be longer than `CERN_SYNC_FULL_SYNC_INTERVAL`, otherwise
+the snapshot has expired when the next full sync reads it.
+"""
+
+CERN_SYNC_USERS_CHECKPOINTS = True
+"""Resume a failed users sync from the last chunk of users committed.
+
+A checkpoint, with the AuthZ pagination token or the LDAP paged results cookie
+of the last committed user, is saved with each chunk. The next run with the same
+params resumes from it. Fetching the AuthZ identities in parallel or with the
+async client is not checkpointed.
+"""
+
+CERN_SYNC_USERS_CHECKPOINT_VALIDITY = timedelta(hours=6)
+"""Max age of the last checkpoint of a failed run, to resume it."""
+
+CERN_SYNC_USERS_CHECKPOINT_MAX_MISSING = 10000
+"""Max number of new users kept in a checkpoint, to insert at the end of the run.
+
+Beyond, e.g. in the first sync, the run is not checkpointed anymore.
+"""
+
+
+###################################################################################
+# Groups sync
+
+CERN_SYNC_GROUPS_BULK_UPSERT = True
+"""Create or update the roles of each chunk of groups with batched statements.
+
+On PostgreSQL, roles are written with `INSERT ... ON CONFLICT DO UPDATE`. When
+disabled, groups are synced one by one with `create_or_update_roles`.
+"""
+
+CERN_SYNC_GROUPS_CHUNK_SIZE = 1000
+"""Number of groups fetched, written and committed at once."""
+
+
+###################################################################################
+# Sync tasks
+
+CERN_SYNC_STATE_STORE = DBSyncStateStore
+"""Factory of the store of the high-water mark of each successful sync run."""
+
+CERN_SYNC_FULL_SYNC_INTERVAL = timedelta(days=7)
+"""Max interval between full syncs.
+
+The sync tasks only fetch the users and groups modified since the previous
+successful run, and run a full sync when the last one is older than this interval.
+Users synced via LDAP are always fully synced, unless `CERN_SYNC_LDAP_INCREMENTAL`
+is enabled.
+"""
+
+CERN_SYNC_LOCK = DBSyncLock
+"""Factory of the lock preventing overlapping runs of the users or groups syncs.
+
+`invenio_cern_sync.locks.CacheSyncLock` stores the lock in the Invenio cache,
+e.g. Redis, instead of the DB. It requires the `cache` extra dependency, and its
+lease is not refreshed while the sync runs.
+"""
+
+CERN_SYNC_LOCK_TTL = timedelta(minutes=15)
+"""Duration of the lock lease, refreshed while the sync runs.
+
+The lock of a crashed run is released after this duration. With `CacheSyncLock`,
+it must exceed the duration of the longest run.
+"""
+
+CERN_SYNC_LOCK_CONTENTION = "skip"
+"""What a sync task does when the same sync is already running.
+
+`skip` logs the contention and returns. `retry` logs it and retries the task after
+`CERN_SYNC_LOCK_RETRY_DELAY` seconds, up to the max retries of the task.
+"""
+
+CERN_SYNC_LOCK_RETRY_DELAY = 600
+"""Seconds before retrying a sync task that found the same sync running."""
+
+
+###################################################################################
+# Metrics
+
+CERN_SYNC_METRICS_SINKS = [LogMetricsSink]
+"""Factories of the sinks of the metrics of each sync run.
+
+Available sinks, in `invenio_cern_sync.metrics`: `LogMetricsSink`,
+`PrometheusFileSink` and `StatsdMetricsSink`.
+"""
+
+CERN_SYNC_METRICS_PREFIX = "cern_sync"
+"""Prefix of the names of the metrics sent to Prometheus or statsd."""
+
+CERN_SYNC_METRICS_PROMETHEUS_DIR = None
+"""Directory of the `<sync name>.prom` files written by `PrometheusFileSink`.
+
+The sharded users sync writes one file per shard, `users-sync-shard-<n>.prom`,
+and one for the merge of the shards, `users-sync-merge.prom`.
+"""
+
+CERN_SYNC_METRICS_STATSD_HOST = "localhost"
+"""Host of the statsd collector of `StatsdMetricsSink`."""
+
+CERN_SYNC_METRICS_STATSD_PORT = 8125
+"""UDP port of the statsd collector of `StatsdMetricsSink`."""
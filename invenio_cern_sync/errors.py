@@ -29,7 +29,40 @@ class InvalidCERNIdentity(Exception):
 class RequestError(Exception):
     """Failed CERN Auth request."""
 
-    def __init__(self, url, error_details):
+    def __init__(self, url, error_details, status_code=None):
         """Initialise error."""
         msg = f"Request error on {url}.\n Error details: {error_details}"
         super().__init__(msg)
+        self.status_code = status_code
+
+
+class CircuitOpenError(RequestError):
+    """Too many failed requests to a CERN service, requests are not sent."""
+
+    def __init__(self, url):
+        """Initialise error."""
+        super().__init__(url, "Too many failures, the circuit breaker is open.")
+
+
+class SyncLocked(Exception):
+    """A sync of the same kind is already running."""
+
+    def __init__(self, name, holder):
+        """Initialise error."""
+        super().__init__(f"The `{name}` sync is already running, by `{holder}`.")
+        self.holder = holder
+
+
+class MemoryLimitExceeded(Exception):
+    """The memory of the sync process exceeds the configured ceiling."""
+
+    def __init__(self, rss_mb, max_rss_mb):
+        """Initialise error."""
+        super().__init__(
+            f"The sync process uses {rss_mb:.0f} MB, more than the max {max_rss_mb} MB."
+        )
+        self.rss_mb = rss_mb
+
+
+class StagingConflict(Exception):
+    """The staged users cannot be reconciled with the local users at once."""
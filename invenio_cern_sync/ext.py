@@ -15,6 +15,7 @@ class InvenioCERNSync(object):
 
     def __init__(self, app=None):
         """Extension initialization."""
+        self.retry_policy = None
         if app:
             self.init_app(app)
 
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-CERN-sync groups importer API."""
+
+from datetime import datetime, timezone
+
+from flask import current_app
+from invenio_accounts.models import Role
+from invenio_accounts.proxies import current_datastore, current_db_change_history
+from invenio_db import db
+from invenio_oauthclient.handlers.utils import create_or_update_roles
+from sqlalchemy import bindparam, or_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from ..metrics import NULL_METRICS
+from ..utils import chunked
+
+
+def _fetch_roles(groups):
+    """Return the existing roles matching the ids or names of the groups."""
+    ids = [group["id"] for group in groups]
+    names = [group["name"] for group in groups]
+    table = Role.__table__
+    rows = db.session.execute(
+        select(table.c.id, table.c.name, table.c.description, table.c.is_managed).where(
+            or_(table.c.id.in_(ids), table.c.name.in_(names))
+        )
+    ).all()
+    by_id = {row.id: row for row in rows}
+    managed_names = {row.name for row in rows if row.is_managed}
+    return by_id, managed_names
+
+
+def _upsert_postgresql(rows):
+    """Insert or update the roles with one `INSERT ... ON CONFLICT` statement."""
+    stmt = pg_insert(Role.__table__).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Role.__table__.c.id],
+        set_=dict(
+            name=stmt.excluded.name,
+            description=stmt.excluded.description,
+            updated=stmt.excluded.updated,
+            version_id=Role.__table__.c.version_id + 1,
+        ),
+    )
+    db.session.execute(stmt)
+
+
+def _insert_update(new_rows, changed_rows):
+    """Insert the new roles and update the changed ones, with executemany."""
+    table = Role.__table__
+    if new_rows:
+        db.session.execute(table.insert(), new_rows)
+    if changed_rows:
+        stmt = (
+            table.update()
+            .where(table.c.id == bindparam("_id"))
+            .values(
+                name=bindparam("name"),
+                description=bindparam("description"),
+                updated=bindparam("updated"),
+                version_id=table.c.version_id + 1,
+            )
+        )
+        db.session.execute(stmt, [dict(row, _id=row["id"]) for row in changed_rows])
+
+
+def _upsert_chunk(groups, stats):
+    """Create or update the roles of a chunk of groups, and return their ids."""
+    # the last occurrence of a group wins, as when processed one by one
+    groups = list({group["id"]: group for group in groups}.values())
+    existing, managed_names = _fetch_roles(groups)
+
+    roles_ids = set()
+    new_rows, changed_rows = [], []
+    now = datetime.now(tz=timezone.utc)
+    for group in groups:
+        role = existing.get(group["id"])
+        if (role and role.is_managed) or group["name"] in managed_names:
+            current_app.logger.error(
+                f"Error while syncing roles: A managed role with id `{group['id']}` "
+                f"or name `{group['name']}` already exists."
+            )
+            stats["skipped"] += 1
+            continue
+
+        row = dict(
+            id=group["id"],
+            name=group["name"],
+            description=group.get("description"),
+            updated=now,
+        )
+        if not role:
+            new_rows.append(dict(row, created=now, is_managed=False, version_id=1))
+        elif role.name != row["name"] or role.description != row["description"]:
+            changed_rows.append(row)
+        else:
+            stats["unchanged"] += 1
+        roles_ids.add(group["id"])
+
+    if db.engine.dialect.name == "postgresql":
+        # changed rows need all columns, as they could be inserted meanwhile
+        rows = new_rows + [
+            dict(row, created=now, is_managed=False, version_id=1)
+            for row in changed_rows
+        ]
+        if rows:
+            _upsert_postgresql(rows)
+    else:
+        _insert_update(new_rows, changed_rows)
+
+    # let the listeners of the datastore, e.g. the indexers, know what changed
+    session_id = id(db.session)
+    for row in new_rows + changed_rows:
+        current_db_change_history.add_updated_role(session_id, row["id"])
+    stats["created"] += len(new_rows)
+    stats["updated"] += len(changed_rows)
+    return roles_ids
+
+
+def upsert_roles(groups, chunk_size=None, metrics=NULL_METRICS):
+    """Create or update DB roles for the given groups, in bulk.
+
+    For each chunk of `chunk_size` groups, the existing roles are fetched with one
+    query, and only the new or changed roles are written, with one batched
+    statement, then committed. When a chunk fails, for example because of a name
+    conflict, its groups are synced one by one with `create_or_update_roles`.
+
+    :param groups: iterable of dicts with the `id`, `name` and `description` keys.
+    :param chunk_size: number of groups per chunk. Defaults to
+        `CERN_SYNC_GROUPS_CHUNK_SIZE`.
+    :param metrics: the SyncMetrics of the run.
+    :return: a tuple with the set of synced role ids, and a dict counting the
+        `created`, `updated`, `unchanged` and `skipped` roles, and the roles of
+        the failed chunks, `synced_one_by_one`.
+    """
+    chunk_size = chunk_size or current_app.config["CERN_SYNC_GROUPS_CHUNK_SIZE"]
+    roles_ids = set()
+    stats = dict(created=0, updated=0, unchanged=0, skipped=0, synced_one_by_one=0)
+
+    for chunk in chunked(groups, chunk_size):
+        chunk_stats = dict(created=0, updated=0, unchanged=0, skipped=0)
+        with metrics.timer("db_upsert_seconds"):
+            try:
+                with db.session.begin_nested():
+                    chunk_ids = _upsert_chunk(chunk, chunk_stats)
+            except Exception as e:
+                current_app.logger.warning(
+                    f"Error while syncing roles in bulk: {e}. Syncing them one by one..."
+                )
+                chunk_ids = create_or_update_roles(chunk)
+                chunk_stats = dict(synced_one_by_one=len(chunk_ids))
+
+        roles_ids.update(chunk_ids)
+        for key, value in chunk_stats.items():
+            stats[key] += value
+        with metrics.timer("db_commit_seconds"):
+            current_datastore.commit()
+        metrics.incr("db_commits")
+
+    return roles_ids, stats
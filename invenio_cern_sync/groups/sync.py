@@ -10,10 +10,16 @@
 import time
 import uuid
 
+from flask import current_app
 from invenio_oauthclient.handlers.utils import create_or_update_roles
 
+from ..authz.aio import AsyncAuthZService, AsyncKeycloakService, iter_sync
 from ..authz.client import AuthZService, KeycloakService
+from ..authz.retry import get_retry_policy
 from ..logging import log_info
+from ..metrics import SyncMetrics
+from ..pipeline import iter_pipelined
+from .api import upsert_roles
 
 
 def _truncate_string(input_string, max_length=255):
@@ -35,45 +41,87 @@ def _serialize_groups(groups):
         }
 
 
-def sync(**kwargs):
-    """Sync CERN groups with local db."""
-    log_uuid = str(uuid.uuid4())
-    log_name = "groups-sync"
-    log_info(
-        log_name,
-        dict(action="fetching-cern-groups", status="started"),
-        log_uuid=log_uuid,
-    )
-    start_time = time.time()
+def _get_groups(metrics, **kwargs):
+    """Return the iterable of the CERN groups to sync."""
+    if current_app.config["CERN_SYNC_AUTHZ_ASYNC"]:
+        overridden_params = kwargs.get("keycloak_service", dict())
+        keycloak_service = AsyncKeycloakService(**overridden_params)
+
+        overridden_params = kwargs.get("authz_service", dict())
+        authz_client = AsyncAuthZService(
+            keycloak_service, metrics=metrics, **overridden_params
+        )
+
+        overridden_params = kwargs.get("groups", dict())
+        return iter_sync(
+            authz_client.get_groups(**overridden_params), aclose=authz_client.aclose
+        )
 
     overridden_params = kwargs.get("keycloak_service", dict())
     keycloak_service = KeycloakService(**overridden_params)
 
     overridden_params = kwargs.get("authz_service", dict())
-    authz_client = AuthZService(keycloak_service, **overridden_params)
+    authz_client = AuthZService(keycloak_service, metrics=metrics, **overridden_params)
 
     overridden_params = kwargs.get("groups", dict())
-    groups = authz_client.get_groups(**overridden_params)
+    return authz_client.get_groups(**overridden_params)
 
+
+def sync(**kwargs):
+    """Sync CERN groups with local db.
+
+    When `CERN_SYNC_PIPELINE` is enabled, groups are fetched and serialized in
+    background threads while the previous ones are written.
+    The metrics of the run are emitted to the configured sinks at the end.
+    """
+    log_uuid = str(uuid.uuid4())
+    log_name = "groups-sync"
     log_info(
         log_name,
-        dict(action="fetching-cern-groups", status="completed"),
-        log_uuid=log_uuid,
-    )
-    log_info(
-        log_name,
-        dict(action="creating-updating-groups", status="started"),
-        log_uuid=log_uuid,
-    )
-    roles_ids = create_or_update_roles(_serialize_groups(groups))
-    # db.session.commit() happens inside create_or_update_roles
-    log_info(
-        log_name,
-        dict(
-            action="creating-updating-groups", status="completed", count=len(roles_ids)
-        ),
+        dict(action="fetching-cern-groups", status="started"),
         log_uuid=log_uuid,
     )
+    start_time = time.time()
+    metrics = SyncMetrics(log_name, log_uuid=log_uuid)
+    metrics.track_retries(get_retry_policy())
+
+    try:
+        groups = metrics.timed_iter(_get_groups(metrics, **kwargs), "fetch")
+        if current_app.config["CERN_SYNC_PIPELINE"]:
+            serialized = iter_pipelined(groups, _serialize_groups, metrics=metrics)
+        else:
+            serialized = _serialize_groups(groups)
+
+        log_info(
+            log_name,
+            dict(action="fetching-cern-groups", status="completed"),
+            log_uuid=log_uuid,
+        )
+        log_action = "creating-updating-groups"
+        log_info(log_name, dict(action=log_action, status="started"), log_uuid=log_uuid)
+        stats = dict()
+        with metrics.phase(log_action) as phase:
+            if current_app.config["CERN_SYNC_GROUPS_BULK_UPSERT"]:
+                roles_ids, stats = upsert_roles(serialized, metrics=metrics)
+            else:
+                roles_ids = create_or_update_roles(serialized)
+            # db.session.commit() happens inside upsert_roles/create_or_update_roles
+            phase["records"] = metrics.counter("fetch_records")
+        for key, value in stats.items():
+            metrics.incr(f"roles_{key}", value)
+        log_info(
+            log_name,
+            dict(
+                action=log_action,
+                status="completed",
+                count=len(roles_ids),
+                **stats,
+            ),
+            log_uuid=log_uuid,
+        )
+    finally:
+        metrics.gauge("total_seconds", time.time() - start_time)
+        metrics.emit()
 
     total_time = time.time() - start_time
     log_info(log_name, dict(status="completed", time=total_time), log_uuid=log_uuid)
@@ -7,12 +7,21 @@
 
 """Invenio-CERN-sync LDAP Client."""
 
+import base64
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
 try:
     import ldap
 except ImportError:
     ldap = None
 from flask import current_app
 
+from ..metrics import NULL_METRICS
+
 BASE = "OU=Users,OU=Organic Units,DC=cern,DC=ch"
 
 PRIMARY_ACCOUNTS_FILTER = "(&(cernAccountType=Primary)(cernActiveStatus=Active))"
@@ -37,6 +46,36 @@ RESPONSE_FIELDS = [
 ]
 
 
+def changed_since_filter(since, attribute="whenChanged"):
+    """Return the filter of the entries modified since the given ISO UTC date.
+
+    `whenChanged` is not replicated: it might differ between domain controllers,
+    by the replication delay.
+    """
+    dt = datetime.fromisoformat(since)
+    return f"({attribute}>={dt.strftime('%Y%m%d%H%M%S')}.0Z)"
+
+
+def cn_range_partitions(boundaries):
+    """Return disjoint filters covering all entries, split at the given `cn` values.
+
+    For example, `["m"]` returns the filters of the entries with `cn` before `m`,
+    and of the ones from `m` included.
+    """
+    partitions = [f"(!(cn>={boundaries[0]}))"]
+    for lower, upper in zip(boundaries, boundaries[1:]):
+        partitions.append(f"(&(cn>={lower})(!(cn>={upper})))")
+    partitions.append(f"(cn>={boundaries[-1]})")
+    return partitions
+
+
+CN_PARTITIONS = cn_range_partitions("bcdefghijklmnopqrstuvwxyz")
+"""Disjoint filters, partitioning the entries by the initial of their `cn`."""
+
+
+_PARTITION_DONE = object()
+
+
 class LdapClient:
     """Ldap client class for user importation/synchronization.
 
@@ -65,15 +104,24 @@ class LdapClient:
         ]
     """
 
-    def __init__(self, ldap_url=None, base=BASE):
-        """Initialize ldap connection."""
-        ldap_url = ldap_url or current_app.config["CERN_SYNC_LDAP_URL"]
-        self._ldap = ldap.initialize(ldap_url)
+    def __init__(self, ldap_url=None, base=BASE, metrics=None, max_connections=None):
+        """Initialize ldap connection.
+
+        :param metrics: the SyncMetrics of the run, where the pages are counted.
+        :param max_connections: max number of connections searching partitions in
+            parallel. Defaults to `CERN_SYNC_LDAP_MAX_CONNECTIONS`.
+        """
+        self._ldap_url = ldap_url or current_app.config["CERN_SYNC_LDAP_URL"]
+        self._ldap = ldap.initialize(self._ldap_url)
         self._base = base
+        self.metrics = metrics or NULL_METRICS
+        self.max_connections = (
+            max_connections or current_app.config["CERN_SYNC_LDAP_MAX_CONNECTIONS"]
+        )
 
-    def _search_paginated(self, filter, fields, page_control):
+    def _search_paginated(self, filter, fields, page_control, connection=None):
         """Execute search to get primary accounts."""
-        return self._ldap.search_ext(
+        return (connection or self._ldap).search_ext(
             self._base,
             ldap.SCOPE_ONELEVEL,
             filter,
@@ -81,31 +129,176 @@ class LdapClient:
             serverctrls=[page_control],
         )
 
-    def get_primary_accounts(
-        self, filter=PRIMARY_ACCOUNTS_FILTER, fields=RESPONSE_FIELDS
-    ):
-        """Retrieve all primary accounts from ldap."""
+    def _get_cookie(self, serverctrls):
+        """Return the cookie of the next page, or None after the last page."""
+        ldap_page_control = ldap.controls.SimplePagedResultsControl
+        ldap_page_control_type = ldap_page_control.controlType
+        controls = [
+            control
+            for control in serverctrls
+            if control.controlType == ldap_page_control_type
+        ]
+        if not controls:
+            current_app.logger.exception("The server ignores RFC 2696 control")
+            return None
+        return controls[0].cookie or None
+
+    def _iter_streamed(self, connection, filter, fields, page_size):
+        """Yield the entries of a paged search as they arrive, in lists.
+
+        Entries are read with `result3(all=0)`, without waiting for the whole
+        page to be received.
+        """
         page_control = ldap.controls.SimplePagedResultsControl(
-            True, size=1000, cookie=""
+            True, size=page_size, cookie=""
         )
-        result = []
         while True:
-            response = self._search_paginated(filter, fields, page_control)
-            rtype, rdata, rmsgid, serverctrls = self._ldap.result3(response)
-            result.extend([x[1] for x in rdata])
-
-            ldap_page_control = ldap.controls.SimplePagedResultsControl
-            ldap_page_control_type = ldap_page_control.controlType
-            controls = [
-                control
-                for control in serverctrls
-                if control.controlType == ldap_page_control_type
-            ]
-            if not controls:
-                current_app.logger.exception("The server ignores RFC 2696 control")
+            start = time.perf_counter()
+            msgid = self._search_paginated(filter, fields, page_control, connection)
+            while True:
+                rtype, rdata, rmsgid, serverctrls = connection.result3(msgid, all=0)
+                if rtype == ldap.RES_SEARCH_RESULT:
+                    break
+                if rtype == ldap.RES_SEARCH_ENTRY:
+                    yield [entry for _, entry in rdata]
+            self.metrics.observe("ldap_page_seconds", time.perf_counter() - start)
+            self.metrics.incr("ldap_pages")
+
+            cookie = self._get_cookie(serverctrls)
+            if not cookie:
                 break
-            if not controls[0].cookie:
+            page_control.cookie = cookie
+
+    def _iter_partitions(self, filter, fields, page_size, partitions):
+        """Search the partitions in parallel, on up to `max_connections` connections.
+
+        Each partition is a filter, added to the given one. Partitions must be
+        disjoint and, together, cover all the entries of the search. Entries are
+        yielded as soon as they arrive, in no specific order.
+        """
+        app = current_app._get_current_object()
+        # bounded, so that threads do not fetch faster than entries are consumed
+        results = queue.Queue(maxsize=self.max_connections * 2)
+        stop = threading.Event()
+        local = threading.local()
+        connections = []
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def _get_connection():
+            # each thread reuses its own connection for its partitions
+            if not hasattr(local, "connection"):
+                local.connection = ldap.initialize(self._ldap_url)
+                connections.append(local.connection)
+            return local.connection
+
+        def _search_partition(partition):
+            partition_filter = f"(&{filter}{partition})"
+            try:
+                with app.app_context():
+                    connection = _get_connection()
+                    for entries in self._iter_streamed(
+                        connection, partition_filter, fields, page_size
+                    ):
+                        if stop.is_set():
+                            return
+                        _put(entries)
+            except Exception as e:
+                _put(e)
+            finally:
+                _put(_PARTITION_DONE)
+
+        executor = ThreadPoolExecutor(max_workers=self.max_connections)
+        try:
+            for partition in partitions:
+                executor.submit(_search_partition, partition)
+
+            pending = len(partitions)
+            while pending:
+                entries = results.get()
+                if entries is _PARTITION_DONE:
+                    pending -= 1
+                elif isinstance(entries, Exception):
+                    raise entries
+                else:
+                    yield from entries
+        finally:
+            # stop the other threads on errors or when the consumer stops iterating,
+            # and wait for them to return before closing their connections
+            stop.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+            for connection in connections:
+                connection.unbind_s()
+
+    def iter_primary_accounts(
+        self,
+        filter=PRIMARY_ACCOUNTS_FILTER,
+        fields=RESPONSE_FIELDS,
+        page_size=None,
+        position=None,
+        since=None,
+        partitions=None,
+    ):
+        """Yield primary accounts from ldap, page by page.
+
+        Only one page of results is kept in memory: the next page is requested
+        when all the entries of the current one have been consumed.
+
+        :param page_size: number of entries per page. Defaults to
+            `CERN_SYNC_LDAP_PAGE_SIZE`.
+        :param position: dict updated with the base64 paged results `cookie` of
+            the current page and the `offset` in it of the last yielded entry. When
+            not empty, entries are fetched from this position. The server might
+            reject the cookie of another connection. It is not tracked when
+            searching partitions in parallel.
+        :param since: ISO UTC date. When provided, only the entries modified since
+            this date are fetched, see `changed_since_filter`.
+        :param partitions: list of disjoint filters, to search in parallel.
+            Defaults to `CERN_SYNC_LDAP_PARTITIONS`.
+        """
+        page_size = page_size or current_app.config["CERN_SYNC_LDAP_PAGE_SIZE"]
+        if since:
+            filter = f"(&{filter}{changed_since_filter(since)})"
+        partitions = partitions or current_app.config["CERN_SYNC_LDAP_PARTITIONS"]
+        if partitions and self.max_connections > 1:
+            yield from self._iter_partitions(filter, fields, page_size, partitions)
+            return
+
+        cookie, offset = "", 0
+        if position:
+            cookie = base64.b64decode(position["cookie"]) if position["cookie"] else ""
+            offset = position["offset"]
+        page_control = ldap.controls.SimplePagedResultsControl(
+            True, size=page_size, cookie=cookie
+        )
+        while True:
+            with self.metrics.timer("ldap_page_seconds"):
+                response = self._search_paginated(filter, fields, page_control)
+                rtype, rdata, rmsgid, serverctrls = self._ldap.result3(response)
+            self.metrics.incr("ldap_pages")
+            if position is not None:
+                page_cookie = base64.b64encode(page_control.cookie or b"")
+                position.update(cookie=page_cookie.decode("ascii"), offset=0)
+            for _, entry in rdata[offset:]:
+                offset += 1
+                if position is not None:
+                    position["offset"] = offset
+                yield entry
+            offset = 0
+
+            cookie = self._get_cookie(serverctrls)
+            if not cookie:
                 break
-            page_control.cookie = controls[0].cookie
+            page_control.cookie = cookie
 
-        return result
+    def get_primary_accounts(
+        self, filter=PRIMARY_ACCOUNTS_FILTER, fields=RESPONSE_FIELDS, page_size=None
+    ):
+        """Retrieve all primary accounts from ldap."""
+        return list(self.iter_primary_accounts(filter, fields, page_size=page_size))
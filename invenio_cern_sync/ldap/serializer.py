@@ -46,10 +46,15 @@ def serialize_ldap_user(ldap_user, userprofile_mapper=None, extra_data_mapper=No
 
 
 def serialize_ldap_users(ldap_users):
-    """Serialize LDAP users to Invenio users."""
+    """Serialize LDAP users to Invenio users.
+
+    The mappers are resolved from the config once, and not for each user.
+    """
+    userprofile_mapper = current_app.config["CERN_SYNC_LDAP_USERPROFILE_MAPPER"]
+    extra_data_mapper = current_app.config["CERN_SYNC_LDAP_USER_EXTRADATA_MAPPER"]
     for ldap_user in ldap_users:
         try:
-            yield serialize_ldap_user(ldap_user)
+            yield serialize_ldap_user(ldap_user, userprofile_mapper, extra_data_mapper)
         except InvalidLdapUser as e:
             current_app.logger.warning(str(e) + " Skipping this account...")
             continue
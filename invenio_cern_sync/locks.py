@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-CERN-sync locks, preventing overlapping sync runs.
+
+Locks are leases: they expire after `CERN_SYNC_LOCK_TTL` unless refreshed, so that
+a crashed worker does not block the next runs forever. While the lock is held,
+`heartbeat` refreshes it in a background thread.
+"""
+
+import os
+import socket
+import threading
+import uuid
+from contextlib import contextmanager
+
+try:
+    from invenio_cache import current_cache
+except ImportError:
+    current_cache = None
+from flask import current_app
+from invenio_db import db
+from sqlalchemy.exc import IntegrityError
+
+from .errors import SyncLocked
+from .logging import log_warning
+from .models import CERNSyncLock
+from .state import utcnow
+
+
+def new_owner():
+    """Return a new unique owner id, identifying the process for debugging."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4()}"
+
+
+class _LeaseLock:
+    """Base class of the lease locks."""
+
+    def __init__(self, name, owner=None, ttl=None):
+        """Constructor.
+
+        :param name: the name of the lock, e.g. `users` or `groups`.
+        :param owner: the owner id. Pass the id of the owner of a held lock to
+            refresh or release it from another task.
+        :param ttl: the timedelta after which the lock expires if not refreshed.
+            Defaults to `CERN_SYNC_LOCK_TTL`.
+        """
+        self.name = name
+        self.owner = owner or new_owner()
+        self.ttl = ttl or current_app.config["CERN_SYNC_LOCK_TTL"]
+
+    def acquire(self):
+        """Acquire the lock, and return True, or return False if already held."""
+        raise NotImplementedError()
+
+    def refresh(self):
+        """Extend the lease, and return False if the lock was lost meanwhile."""
+        raise NotImplementedError()
+
+    def release(self):
+        """Release the lock, if still held by this owner."""
+        raise NotImplementedError()
+
+    def get_holder(self):
+        """Return the owner id and the expiration of the held lock, or Nones."""
+        raise NotImplementedError()
+
+    @contextmanager
+    def heartbeat(self):
+        """Refresh the lock in a background thread, until the block ends."""
+        app = current_app._get_current_object()
+        stop = threading.Event()
+        interval = self.ttl.total_seconds() / 3
+
+        def _refresh():
+            with app.app_context():
+                while not stop.wait(interval):
+                    if not self.refresh():
+                        log_warning(
+                            "sync-lock",
+                            dict(action="lock-lost", lock=self.name, owner=self.owner),
+                        )
+                        return
+
+        thread = threading.Thread(target=_refresh, daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+
+
+class DBSyncLock(_LeaseLock):
+    """Lease lock stored in the `cern_sync_lock` table.
+
+    Each operation runs in its own short transaction, independent from the
+    session of the sync. Unlike a PostgreSQL advisory lock, bound to a connection,
+    the lease can be refreshed and released by other tasks, e.g. the subtasks of
+    the sharded users sync.
+    """
+
+    def acquire(self):
+        """Acquire the lock, and return True, or return False if already held."""
+        table = CERNSyncLock.__table__
+        now = utcnow()
+        values = dict(owner=self.owner, acquired_at=now, expires_at=now + self.ttl)
+        with db.engine.begin() as conn:
+            # take over an expired lease
+            result = conn.execute(
+                table.update()
+                .where(table.c.name == self.name, table.c.expires_at < now)
+                .values(**values)
+            )
+            if result.rowcount:
+                return True
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(table.insert().values(name=self.name, **values))
+            return True
+        except IntegrityError:
+            return False
+
+    def refresh(self):
+        """Extend the lease, and return False if the lock was lost meanwhile."""
+        table = CERNSyncLock.__table__
+        now = utcnow()
+        with db.engine.begin() as conn:
+            result = conn.execute(
+                table.update()
+                .where(table.c.name == self.name, table.c.owner == self.owner)
+                .values(expires_at=now + self.ttl)
+            )
+        return bool(result.rowcount)
+
+    def release(self):
+        """Release the lock, if still held by this owner."""
+        table = CERNSyncLock.__table__
+        with db.engine.begin() as conn:
+            conn.execute(
+                table.delete().where(
+                    table.c.name == self.name, table.c.owner == self.owner
+                )
+            )
+
+    def get_holder(self):
+        """Return the owner id and the expiration of the held lock, or Nones."""
+        table = CERNSyncLock.__table__
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                table.select().where(
+                    table.c.name == self.name, table.c.expires_at >= utcnow()
+                )
+            ).first()
+        return (row.owner, row.expires_at) if row else (None, None)
+
+
+class CacheSyncLock(_LeaseLock):
+    """Lease lock stored in the Invenio cache, e.g. Redis.
+
+    It requires the `cache` extra dependency. The cache must be shared by all the
+    workers. The lock is acquired with an atomic `add`, and expires with the cache
+    key. The lease is never extended: a generic cache cannot check the owner and
+    extend the key at once, so `CERN_SYNC_LOCK_TTL` must exceed the longest run.
+    """
+
+    @property
+    def key(self):
+        """Return the cache key of the lock."""
+        return f"cern-sync-lock:{self.name}"
+
+    def _value(self):
+        """Return the cached value of the lock."""
+        return dict(owner=self.owner, expires_at=(utcnow() + self.ttl).isoformat())
+
+    def acquire(self):
+        """Acquire the lock, and return True, or return False if already held."""
+        timeout = int(self.ttl.total_seconds())
+        return bool(current_cache.add(self.key, self._value(), timeout=timeout))
+
+    def refresh(self):
+        """Return False if the lock was lost, without extending the lease."""
+        value = current_cache.get(self.key)
+        return bool(value) and value["owner"] == self.owner
+
+    def release(self):
+        """Release the lock, if still held by this owner."""
+        value = current_cache.get(self.key)
+        if value and value["owner"] == self.owner:
+            current_cache.delete(self.key)
+
+    def get_holder(self):
+        """Return the owner id and the expiration of the held lock, or Nones."""
+        value = current_cache.get(self.key)
+        if not value:
+            return None, None
+        return value["owner"], value["expires_at"]
+
+
+def get_sync_lock(name, owner=None):
+    """Return the configured lock of the given name."""
+    return current_app.config["CERN_SYNC_LOCK"](name, owner=owner)
+
+
+def acquire_or_raise(name, log_uuid=None):
+    """Acquire the lock of the given name, or log the contention and raise.
+
+    :raises SyncLocked: when the lock is held by another run.
+    """
+    lock = get_sync_lock(name)
+    if lock.acquire():
+        return lock
+    holder, expires_at = lock.get_holder()
+    log_warning(
+        "sync-lock",
+        dict(
+            action="lock-contention",
+            lock=name,
+            holder=holder,
+            expires_at=str(expires_at),
+            policy=current_app.config["CERN_SYNC_LOCK_CONTENTION"],
+        ),
+        log_uuid=log_uuid,
+    )
+    raise SyncLocked(name, holder)
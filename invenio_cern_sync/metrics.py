@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-CERN-sync metrics of the sync runs.
+
+Each run collects counters, gauges and histograms in a `SyncMetrics`, emitted at
+the end of the run to the sinks configured in `CERN_SYNC_METRICS_SINKS`.
+"""
+
+import os
+import socket
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import current_app
+
+from .logging import log_error, log_info
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+"""Upper bounds, in seconds, of the buckets of the histograms."""
+
+
+def _key(name, labels):
+    """Return the key of a metric, with its labels."""
+    return name, tuple(sorted(labels.items()))
+
+
+def format_name(name, labels):
+    """Return the name of the metric with its labels, e.g. `name{phase="x"}`."""
+    if not labels:
+        return name
+    labels_str = ",".join(f'{key}="{value}"' for key, value in labels)
+    return f"{name}{{{labels_str}}}"
+
+
+class Histogram:
+    """Distribution of observed values, in cumulative buckets."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """Constructor."""
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        """Add a value."""
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+
+class SyncMetrics:
+    """Metrics of a sync run.
+
+    It is thread-safe, as pages can be fetched in parallel threads.
+    """
+
+    def __init__(self, name, log_uuid=None, part=None):
+        """Constructor.
+
+        :param name: the name of the sync, e.g. `users-sync`.
+        :param log_uuid: the uuid of the logs of the run.
+        :param part: the part of the run, e.g. `shard-3` or `merge` when the sync
+            runs in parallel tasks, each emitting its own metrics.
+        """
+        self.name = name
+        self.log_uuid = log_uuid
+        self.part = part
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+        self._lock = threading.Lock()
+        self._retry_policy = None
+        self._retry_stats = None
+
+    def incr(self, name, value=1, **labels):
+        """Increment a counter."""
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def counter(self, name, **labels):
+        """Return the value of a counter."""
+        return self.counters.get(_key(name, labels), 0)
+
+    def gauge(self, name, value, **labels):
+        """Set a gauge."""
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        """Add a value to a histogram."""
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if not histogram:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the seconds spent in the block in the given histogram."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed_iter(self, iterable, name, **labels):
+        """Yield from the iterable, counting the seconds spent producing items.
+
+        The seconds are added to the `<name>_seconds` counter, and the items to the
+        `<name>_records` counter.
+        """
+        iterator = iter(iterable)
+        seconds = records = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - start
+                records += 1
+                yield item
+        finally:
+            self.incr(f"{name}_seconds", seconds, **labels)
+            self.incr(f"{name}_records", records, **labels)
+
+    @contextmanager
+    def phase(self, name):
+        """Time a phase of the run.
+
+        The yielded dict `records` key must be set to the number of records
+        processed in the phase, to compute the phase records per second.
+        """
+        phase = dict(records=0)
+        start = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            seconds = time.perf_counter() - start
+            self.gauge("phase_seconds", seconds, phase=name)
+            self.gauge("phase_records", phase["records"], phase=name)
+            if seconds:
+                rate = phase["records"] / seconds
+                self.gauge("phase_records_per_second", rate, phase=name)
+
+    def track_retries(self, policy):
+        """Count the retries of the given policy from now until the metrics emit."""
+        self._retry_policy = policy
+        self._retry_stats = dict(policy.stats)
+
+    def _record_retries(self):
+        """Add the retries done since `track_retries` to the counters."""
+        if not self._retry_policy:
+            return
+        for key, value in self._retry_policy.stats.items():
+            self.incr(f"http_{key}", value - self._retry_stats.get(key, 0))
+        self._retry_policy = None
+
+    def emit(self, sinks=None):
+        """Send the metrics to the sinks. Errors of the sinks are only logged.
+
+        :param sinks: list of sinks. Defaults to the configured ones.
+        """
+        self._record_retries()
+        sinks = sinks if sinks is not None else get_metrics_sinks()
+        for sink in sinks:
+            try:
+                sink.emit(self)
+            except Exception as e:
+                log_error(
+                    self.name,
+                    dict(action="emitting-metrics", sink=str(sink), msg=str(e)),
+                    log_uuid=self.log_uuid,
+                )
+
+
+class _NullMetrics(SyncMetrics):
+    """Metrics that are not collected, when the caller does not provide any."""
+
+    def __init__(self):
+        """Constructor."""
+        super().__init__("null")
+
+    def incr(self, name, value=1, **labels):
+        """Do nothing."""
+
+    def gauge(self, name, value, **labels):
+        """Do nothing."""
+
+    def observe(self, name, value, **labels):
+        """Do nothing."""
+
+
+NULL_METRICS = _NullMetrics()
+"""Metrics that discard all values."""
+
+
+###################################################################################
+# Sinks
+
+
+class LogMetricsSink:
+    """Log the metrics with the structured logging of the module."""
+
+    def emit(self, metrics):
+        """Log all metrics in one message."""
+        values = dict()
+        for (name, labels), value in metrics.counters.items():
+            values[format_name(name, labels)] = value
+        for (name, labels), value in metrics.gauges.items():
+            values[format_name(name, labels)] = value
+        for (name, labels), histogram in metrics.histograms.items():
+            values[format_name(name, labels)] = dict(
+                count=histogram.count,
+                sum=histogram.sum,
+                min=histogram.min,
+                max=histogram.max,
+            )
+        if metrics.part:
+            values["part"] = metrics.part
+        log_info(
+            metrics.name, dict(action="metrics", **values), log_uuid=metrics.log_uuid
+        )
+
+
+class PrometheusFileSink:
+    """Write the metrics in the Prometheus text format.
+
+    The file, `<name>.prom` or `<name>-<part>.prom` in
+    `CERN_SYNC_METRICS_PROMETHEUS_DIR`, can be exposed with the textfile collector
+    of the node exporter. It is replaced atomically at the end of each run: the
+    counters and gauges, values of the last run only, are exported as gauges named
+    `<prefix>_last_run_<name>`. The metrics have a `sync` label, and a `part`
+    label when set.
+    """
+
+    def __init__(self, directory=None, prefix=None):
+        """Constructor."""
+        self.directory = (
+            directory or current_app.config["CERN_SYNC_METRICS_PROMETHEUS_DIR"]
+        )
+        self.prefix = prefix or current_app.config["CERN_SYNC_METRICS_PREFIX"]
+
+    def _name(self, name):
+        """Return the full name of the metric."""
+        return f"{self.prefix}_last_run_{name}".replace("-", "_")
+
+    def format(self, metrics):
+        """Return the metrics in the Prometheus text format."""
+        lines = []
+        sync = (("sync", metrics.name),)
+        if metrics.part:
+            sync += (("part", metrics.part),)
+
+        declared = set()
+        values = list(metrics.counters.items()) + list(metrics.gauges.items())
+        for (name, labels), value in sorted(values):
+            full_name = self._name(name)
+            if full_name not in declared:
+                lines.append(f"# TYPE {full_name} gauge")
+                declared.add(full_name)
+            lines.append(f"{format_name(full_name, sync + labels)} {value}")
+        for (name, labels), histogram in sorted(metrics.histograms.items()):
+            full_name = self._name(name)
+            lines.append(f"# TYPE {full_name} histogram")
+            cumulative = 0
+            bounds = [str(bound) for bound in histogram.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, histogram.bucket_counts):
+                cumulative += count
+                bucket_labels = sync + labels + (("le", bound),)
+                lines.append(
+                    f"{format_name(full_name + '_bucket', bucket_labels)} {cumulative}"
+                )
+            lines.append(
+                f"{format_name(full_name + '_sum', sync + labels)} {histogram.sum}"
+            )
+            lines.append(
+                f"{format_name(full_name + '_count', sync + labels)} {histogram.count}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def emit(self, metrics):
+        """Replace the file of this sync, or part of it, with the new metrics."""
+        name = f"{metrics.name}-{metrics.part}" if metrics.part else metrics.name
+        path = os.path.join(self.directory, f"{name}.prom")
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.format(metrics))
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+class StatsdMetricsSink:
+    """Send the metrics to a statsd collector, over UDP.
+
+    Histograms are sent as gauges of their count, sum and max.
+    """
+
+    def __init__(self, host=None, port=None, prefix=None):
+        """Constructor."""
+        config = current_app.config
+        self.address = (
+            host or config["CERN_SYNC_METRICS_STATSD_HOST"],
+            port or config["CERN_SYNC_METRICS_STATSD_PORT"],
+        )
+        self.prefix = prefix or config["CERN_SYNC_METRICS_PREFIX"]
+
+    def _name(self, metrics, name, labels):
+        """Return the statsd name, with the part and labels values as segments."""
+        segments = [self.prefix, metrics.name]
+        segments += [metrics.part] if metrics.part else []
+        segments += [name] + [value for _, value in labels]
+        return ".".join(segments).replace("-", "_")
+
+    def lines(self, metrics):
+        """Return the statsd lines of the metrics."""
+        lines = []
+        for (name, labels), value in metrics.counters.items():
+            lines.append(f"{self._name(metrics, name, labels)}:{value}|c")
+        for (name, labels), value in metrics.gauges.items():
+            lines.append(f"{self._name(metrics, name, labels)}:{value}|g")
+        for (name, labels), histogram in metrics.histograms.items():
+            base = self._name(metrics, name, labels)
+            lines.append(f"{base}.count:{histogram.count}|g")
+            lines.append(f"{base}.sum:{histogram.sum}|g")
+            lines.append(f"{base}.max:{histogram.max}|g")
+        return lines
+
+    def emit(self, metrics):
+        """Send one datagram per metric."""
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            for line in self.lines(metrics):
+                sock.sendto(line.encode("utf-8"), self.address)
+
+
+def get_metrics_sinks():
+    """Return the configured metrics sinks."""
+    return [factory() for factory in current_app.config["CERN_SYNC_METRICS_SINKS"]]
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-CERN-sync database models."""
+
+from invenio_db import db
+
+
+class CERNSyncState(db.Model, db.Timestamp):
+    """State of the successful sync runs, per kind of sync."""
+
+    __tablename__ = "cern_sync_state"
+
+    kind = db.Column(db.String(64), primary_key=True)
+    """Kind of sync, e.g. `users-AuthZ` or `groups`."""
+
+    watermark = db.Column(db.DateTime, nullable=True)
+    """Start time, in UTC, of the last successful run."""
+
+    last_full_sync = db.Column(db.DateTime, nullable=True)
+    """Start time, in UTC, of the last successful full run."""
+
+
+class CERNSyncLock(db.Model):
+    """Lease preventing overlapping sync runs of the same kind."""
+
+    __tablename__ = "cern_sync_lock"
+
+    name = db.Column(db.String(64), primary_key=True)
+    """Name of the lock, e.g. `users` or `groups`."""
+
+    owner = db.Column(db.String(255), nullable=False)
+    """Id of the run holding the lock."""
+
+    acquired_at = db.Column(db.DateTime, nullable=False)
+    """Time, in UTC, when the lock was acquired."""
+
+    expires_at = db.Column(db.DateTime, nullable=False)
+    """Time, in UTC, after which the lock can be taken over, if not refreshed."""
+
+
+class CERNSyncCheckpoint(db.Model, db.Timestamp):
+    """Position of an interrupted sync run, from which the next run can resume."""
+
+    __tablename__ = "cern_sync_checkpoint"
+
+    kind = db.Column(db.String(64), primary_key=True)
+    """Kind of sync, e.g. `users-AuthZ`."""
+
+    log_uuid = db.Column(db.String(36), nullable=False)
+    """Uuid of the logs of the run, kept by the resumed runs."""
+
+    params_hash = db.Column(db.String(64), nullable=False)
+    """Hash of the params of the run, which must match to resume it."""
+
+    started_at = db.Column(db.DateTime, nullable=False)
+    """Start time, in UTC, of the first run."""
+
+    position = db.Column(db.JSON, nullable=False)
+    """Pagination position of the last committed record, e.g. AuthZ `token`."""
+
+    missing = db.Column(db.JSON, nullable=False)
+    """Fetched users missing in the DB, to insert at the end of the run."""
+
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    """Number of users committed so far."""
+
+
+class CERNSyncUserChange(db.Model):
+    """Change of the e-mail/username, or of the identity id, of a synced user."""
+
+    __tablename__ = "cern_sync_user_change"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+
+    created = db.Column(db.DateTime, nullable=False)
+    """Time, in UTC, when the change was synced."""
+
+    identity_id = db.Column(db.String(255), nullable=True, index=True)
+    """CERN identity id of the user, after the change, if known."""
+
+    user_id = db.Column(db.Integer, nullable=True, index=True)
+    """Id of the local user. Not a foreign key, to keep the history of deleted users."""
+
+    action = db.Column(db.String(32), nullable=False)
+    """Kind of change, `userdata_changed` or `identityId_changed`."""
+
+    log_uuid = db.Column(db.String(36), nullable=True)
+    """Uuid of the logs of the run. None for the changes migrated from `extra_data`."""
+
+    data = db.Column(db.JSON, nullable=False)
+    """Previous and new values, e.g. `previous_email` and `new_email`."""
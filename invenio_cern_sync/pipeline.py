@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-CERN-sync pipeline, fetching and serializing ahead of the DB writes.
+
+Without it, a run fetches a page of records, serializes it and writes it to the
+DB, one step after the other: the DB is idle while the next page is fetched, and
+the network while the users are written.
+"""
+
+import queue
+import threading
+import time
+
+from flask import current_app
+
+from .metrics import NULL_METRICS
+from .utils import chunked
+
+_DONE = object()
+
+
+class _Failure:
+    """Exception raised by a stage, re-raised by its consumer."""
+
+    def __init__(self, exception):
+        """Constructor."""
+        self.exception = exception
+
+
+def iter_prefetched(
+    iterable, stage, metrics=NULL_METRICS, queue_size=None, batch_size=100
+):
+    """Yield the items of the iterable, produced ahead in a background thread.
+
+    The items are queued in batches, up to `queue_size` items: the thread waits
+    while the queue is full. Exceptions of the thread are raised by the consumer.
+    When the consumer stops iterating, e.g. on errors, the thread stops at the
+    next item and closes the iterable.
+
+    The thread runs in the app context of the caller. It does not share the DB
+    session of the caller: the iterable must not use it.
+
+    :param stage: name of the stage, labelling its metrics: the seconds spent
+        producing items, blocked on the full queue, and waited by the consumer.
+    :param queue_size: max number of queued items. Defaults to
+        `CERN_SYNC_PIPELINE_QUEUE_SIZE`.
+    """
+    app = current_app._get_current_object()
+    queue_size = queue_size or app.config["CERN_SYNC_PIPELINE_QUEUE_SIZE"]
+    items = queue.Queue(maxsize=max(1, queue_size // batch_size))
+    stop = threading.Event()
+
+    def _put(item):
+        start = time.perf_counter()
+        try:
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            blocked = time.perf_counter() - start
+            metrics.incr("pipeline_blocked_seconds", blocked, stage=stage)
+
+    def _produce():
+        result = _DONE
+        with app.app_context():
+            produced = metrics.timed_iter(iterable, "pipeline_produce", stage=stage)
+            try:
+                for batch in chunked(produced, batch_size):
+                    if not _put(batch):
+                        return
+            except BaseException as e:
+                result = _Failure(e)
+            finally:
+                produced.close()
+                close = getattr(iterable, "close", None)
+                if close:
+                    close()
+        _put(result)
+
+    def _consume():
+        thread = threading.Thread(
+            target=_produce, name=f"cern-sync-{stage}", daemon=True
+        )
+        thread.start()
+        waited = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                batch = items.get()
+                waited += time.perf_counter() - start
+                if batch is _DONE:
+                    return
+                if isinstance(batch, _Failure):
+                    raise batch.exception
+                yield from batch
+        finally:
+            # the thread might be blocked on the network: it is not waited for
+            stop.set()
+            metrics.incr("pipeline_wait_seconds", waited, stage=stage)
+
+    return _consume()
+
+
+def iter_pipelined(records, serializer_fn, metrics=NULL_METRICS, queue_size=None):
+    """Yield the serialized records, fetched and serialized in two threads.
+
+    See `iter_prefetched`.
+    """
+    # the fetch stage is only referenced by the serializer, and closed with it
+    return iter_prefetched(
+        serializer_fn(iter_prefetched(records, "fetch", metrics, queue_size)),
+        "serialize",
+        metrics,
+        queue_size,
+    )
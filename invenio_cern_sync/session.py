@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-CERN-sync management of the DB session of the long sync runs.
+
+A run updates all the users with the same `db.session`, committing every chunk.
+Each `User`, `UserIdentity` and `RemoteAccount` loaded would otherwise stay in
+its identity map until the end of the run, and be expired, and possibly loaded
+again, after each commit: the memory of the worker would grow with the number of
+CERN users.
+"""
+
+import gc
+import os
+import resource
+import sys
+
+from flask import current_app
+from invenio_db import db
+
+from .errors import MemoryLimitExceeded
+from .logging import log_error
+from .metrics import NULL_METRICS
+
+
+def get_rss_mb():
+    """Return the resident memory of the process, in MB."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        # not Linux: the peak resident memory, in bytes on macOS and KB elsewhere
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+class SyncSession:
+    """Context manager keeping the identity map of the session bounded to a chunk.
+
+    Within the block, commits do not expire the loaded objects, and `release`
+    expunges the objects loaded since the block was entered. The objects already
+    in the session before are kept, and expired when exiting the block.
+    """
+
+    def __init__(self, log_name, log_uuid=None, max_rss_mb=None, metrics=NULL_METRICS):
+        """Constructor.
+
+        :param max_rss_mb: max resident memory of the process, checked by
+            `release`. Defaults to `CERN_SYNC_USERS_MAX_RSS_MB`.
+        :param metrics: the SyncMetrics of the run.
+        """
+        self.log_name = log_name
+        self.log_uuid = log_uuid
+        self.max_rss_mb = max_rss_mb or current_app.config["CERN_SYNC_USERS_MAX_RSS_MB"]
+        self.metrics = metrics
+        self._session = None
+        self._kept = None
+        self._expire_on_commit = None
+
+    def __enter__(self):
+        """Stop expiring the objects on commit."""
+        self._session = db.session()
+        self._kept = set(self._session.identity_map.keys())
+        self._expire_on_commit = self._session.expire_on_commit
+        self._session.expire_on_commit = False
+        return self
+
+    def __exit__(self, *exc_info):
+        """Restore the session, expiring the objects modified by the run."""
+        if exc_info[0] is None:
+            # on errors, the objects might have changes not rolled back yet
+            self.release(check_memory=False)
+        self._session.expire_on_commit = self._expire_on_commit
+        self._session.expire_all()
+
+    def release(self, check_memory=True):
+        """Expunge the objects loaded since entering the block.
+
+        Objects must not have pending changes, i.e. it must be called after a
+        commit or a rollback.
+
+        :raises MemoryLimitExceeded: when the resident memory of the process still
+            exceeds the max once the objects are released.
+        """
+        session = self._session
+        for key, obj in list(session.identity_map.items()):
+            # objects might have been expunged already, by the cascade of another
+            if key not in self._kept and obj in session:
+                session.expunge(obj)
+        if check_memory and self.max_rss_mb:
+            self._check_memory()
+
+    def _check_memory(self):
+        """Raise if the resident memory of the process exceeds the max."""
+        rss_mb = get_rss_mb()
+        if rss_mb > self.max_rss_mb:
+            # the released objects might only be in reference cycles
+            gc.collect()
+            rss_mb = get_rss_mb()
+        self.metrics.gauge("rss_mb", rss_mb)
+        if rss_mb > self.max_rss_mb:
+            log_error(
+                self.log_name,
+                dict(
+                    action="memory-limit-exceeded",
+                    rss_mb=round(rss_mb),
+                    max_rss_mb=self.max_rss_mb,
+                ),
+                log_uuid=self.log_uuid,
+            )
+            raise MemoryLimitExceeded(rss_mb, self.max_rss_mb)
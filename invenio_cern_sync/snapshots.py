@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-CERN-sync snapshots of the source records of the full syncs.
+
+LDAP does not support deltas, and full AuthZ syncs fetch all identities: each
+user is serialized and reconciled with the DB even when it did not change. A
+snapshot, an SQLite file in `CERN_SYNC_SNAPSHOTS_DIR`, maps the id of each
+record synced by the previous full run to its hash. The next full run compares
+each fetched record with it, and only reconciles the added and changed ones.
+
+Delta runs, e.g. AuthZ runs with `since`, reconcile all the fetched records, and
+update their hash in the snapshot, so that the next full run compares the
+records with their last synced state.
+"""
+
+import os
+import sqlite3
+import tempfile
+from datetime import datetime, timezone
+
+from flask import current_app
+
+from .logging import log_info
+from .metrics import NULL_METRICS
+from .utils import fingerprint
+
+_SCHEMA = """
+CREATE TABLE records (id TEXT PRIMARY KEY, hash TEXT NOT NULL) WITHOUT ROWID;
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID;
+"""
+
+
+class SnapshotDiff:
+    """Diff of the fetched records with the snapshot of the previous full run.
+
+    The new snapshot is written to a temporary file while the run progresses,
+    and replaces the previous one only when the run succeeds. It contains the
+    unchanged records, and the changed ones once committed: the records that
+    fail, or that are inserted, are reconciled again by the next run.
+
+    On delta runs, no record is skipped, and the previous snapshot is updated in
+    place: each fetched record is removed from it before being reconciled, and
+    added back with its new hash once committed. A failed delta run can only
+    leave records to be reconciled again.
+    """
+
+    def __init__(
+        self,
+        kind,
+        params,
+        directory=None,
+        max_age=None,
+        flush_every=1000,
+        metrics=NULL_METRICS,
+        delta=False,
+    ):
+        """Constructor.
+
+        :param kind: the kind of sync, e.g. `users-LDAP`, naming the file.
+        :param params: the params of the run. The previous snapshot is ignored
+            when they changed.
+        :param directory: defaults to `CERN_SYNC_SNAPSHOTS_DIR`.
+        :param max_age: the previous snapshot is ignored when older. Defaults to
+            `CERN_SYNC_SNAPSHOT_MAX_AGE`.
+        :param metrics: the SyncMetrics of the run.
+        :param delta: True when the run only fetches the modified records, and
+            updates the previous snapshot instead of writing a new one.
+        """
+        config = current_app.config
+        directory = directory or config["CERN_SYNC_SNAPSHOTS_DIR"]
+        self.max_age = max_age or config["CERN_SYNC_SNAPSHOT_MAX_AGE"]
+        self.path = os.path.join(directory, f"{kind}.sqlite")
+        self.params_hash = fingerprint(params)
+        self.flush_every = flush_every
+        self.metrics = metrics
+        self.delta = delta
+        self.unchanged = 0
+        self._pending = dict()
+        self._rows = []
+        self._fetched = []
+
+        self._previous = self._open_previous()
+        if delta:
+            self._new = self._tmp_path = None
+            return
+        fd, self._tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        os.close(fd)
+        self._new = sqlite3.connect(self._tmp_path)
+        # the file is synced once, before replacing the previous one
+        self._new.execute("PRAGMA journal_mode = OFF")
+        self._new.execute("PRAGMA synchronous = OFF")
+        self._new.executescript(_SCHEMA)
+        self._new.execute(
+            "CREATE TEMP TABLE fetched (id TEXT PRIMARY KEY) WITHOUT ROWID"
+        )
+        created = datetime.now(tz=timezone.utc).isoformat()
+        self._new.executemany(
+            "INSERT INTO meta VALUES (?, ?)",
+            [("params_hash", self.params_hash), ("created", created)],
+        )
+
+    def _open_previous(self):
+        """Return a connection to the previous snapshot, if usable.
+
+        It is read-only, except on delta runs.
+        """
+        if not os.path.exists(self.path):
+            return None
+        if self.delta:
+            # autocommit: a record is removed before it is reconciled
+            conn = sqlite3.connect(
+                f"file:{self.path}?mode=rw", uri=True, isolation_level=None
+            )
+        else:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        meta = dict(conn.execute("SELECT key, value FROM meta"))
+        age = datetime.now(tz=timezone.utc) - datetime.fromisoformat(meta["created"])
+        if meta["params_hash"] != self.params_hash or age > self.max_age:
+            conn.close()
+            return None
+        return conn
+
+    @property
+    def has_previous(self):
+        """Return True when the records are compared with a previous snapshot."""
+        return self._previous is not None
+
+    def _add(self, record_id, record_hash):
+        """Add a record to the new snapshot."""
+        self._rows.append((record_id, record_hash))
+        if len(self._rows) >= self.flush_every:
+            self._flush()
+
+    def _flush(self):
+        """Write the buffered records to the new snapshot."""
+        self._new.executemany(
+            "INSERT OR REPLACE INTO records VALUES (?, ?)", self._rows
+        )
+        self._new.executemany("INSERT OR IGNORE INTO fetched VALUES (?)", self._fetched)
+        self._rows = []
+        self._fetched = []
+
+    def filter(self, users, seen_ids=None):
+        """Yield the serialized users added or changed since the previous snapshot.
+
+        Users are compared one by one, without reading ahead, so that the
+        pagination position of the run matches the last user yielded.
+
+        :param seen_ids: when provided, the set is filled with the identity ids of
+            all the users, including the unchanged ones.
+        """
+        for user in users:
+            user_id = str(user["user_identity_id"])
+            if seen_ids is not None:
+                seen_ids.add(user_id)
+            user_hash = fingerprint(user)
+            if self.delta:
+                if self._previous:
+                    self._previous.execute(
+                        "DELETE FROM records WHERE id = ?", (user_id,)
+                    )
+            elif self._previous:
+                self._fetched.append((user_id,))
+                if len(self._fetched) >= self.flush_every:
+                    self._flush()
+                previous = self._previous.execute(
+                    "SELECT hash FROM records WHERE id = ?", (user_id,)
+                ).fetchone()
+                if previous and previous[0] == user_hash:
+                    self.unchanged += 1
+                    self.metrics.incr("snapshot_unchanged")
+                    self._add(user_id, user_hash)
+                    continue
+            self._pending[user_id] = user_hash
+            yield user
+
+    def wrap(self, serializer_fn, seen_ids=None):
+        """Return the serializer function, only yielding the added or changed users.
+
+        See `filter`.
+        """
+
+        def _serialize(records):
+            return self.filter(serializer_fn(records), seen_ids=seen_ids)
+
+        return _serialize
+
+    def synced(self, users):
+        """Add the given users, updated and committed, to the new snapshot."""
+        rows = []
+        for user in users:
+            user_hash = self._pending.pop(str(user["user_identity_id"]), None)
+            if user_hash:
+                rows.append((str(user["user_identity_id"]), user_hash))
+        if not self.delta:
+            for row in rows:
+                self._add(*row)
+        elif self._previous and rows:
+            self._previous.executemany(
+                "INSERT OR REPLACE INTO records VALUES (?, ?)", rows
+            )
+
+    def commit(self, log_uuid=None):
+        """Replace the previous snapshot with the new one, atomically.
+
+        :return: the number of records of the previous snapshot not fetched again,
+            e.g. of the users who left CERN. Always 0 on delta runs.
+        """
+        if self.delta:
+            # the previous snapshot was updated in place
+            self.discard()
+            return 0
+        self._flush()
+        self._new.commit()
+        removed = 0
+        if self._previous:
+            self._previous.close()
+            self._previous = None
+            self._new.execute("ATTACH DATABASE ? AS previous", (self.path,))
+            (removed,) = self._new.execute(
+                "SELECT count(*) FROM previous.records AS p WHERE NOT EXISTS "
+                "(SELECT 1 FROM fetched AS f WHERE f.id = p.id)"
+            ).fetchone()
+            self._new.execute("DETACH DATABASE previous")
+        self._new.commit()
+        self._new.close()
+        with open(self._tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(self._tmp_path, self.path)
+
+        self.metrics.incr("snapshot_removed", removed)
+        log_info(
+            "sync-snapshot",
+            dict(
+                action="snapshot-saved",
+                path=self.path,
+                unchanged=self.unchanged,
+                removed=removed,
+            ),
+            log_uuid=log_uuid,
+        )
+        return removed
+
+    def discard(self):
+        """Delete the new snapshot, keeping the previous one."""
+        if self._previous:
+            self._previous.close()
+            self._previous = None
+        if self.delta:
+            return
+        self._new.close()
+        if os.path.exists(self._tmp_path):
+            os.unlink(self._tmp_path)
+
+
+def get_snapshot_diff(kind, params, metrics=NULL_METRICS, delta=False):
+    """Return a new SnapshotDiff, or None when `CERN_SYNC_SNAPSHOTS_DIR` is unset.
+
+    :param params: the params of the run, without the `since` of delta runs.
+    """
+    if not current_app.config["CERN_SYNC_SNAPSHOTS_DIR"]:
+        return None
+    return SnapshotDiff(kind, params, metrics=metrics, delta=delta)
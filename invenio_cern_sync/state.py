@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-CERN-sync persisted state of the sync runs."""
+
+from datetime import datetime, timezone
+
+from flask import current_app
+from invenio_db import db
+
+from .models import CERNSyncState
+
+
+def utcnow():
+    """Return the current naive UTC datetime, as stored in the DB."""
+    return datetime.now(tz=timezone.utc).replace(tzinfo=None)
+
+
+class DBSyncStateStore:
+    """Store the high-water mark of the sync runs in the DB."""
+
+    def get(self, kind):
+        """Return a tuple with the watermark and the last full sync of a kind.
+
+        Both values are None when no run of this kind ever succeeded.
+        """
+        state = db.session.get(CERNSyncState, kind)
+        if not state:
+            return None, None
+        return state.watermark, state.last_full_sync
+
+    def save(self, kind, watermark, full=False):
+        """Record a successful run of the given kind, started at `watermark`."""
+        state = db.session.get(CERNSyncState, kind)
+        if not state:
+            state = CERNSyncState(kind=kind)
+            db.session.add(state)
+        state.watermark = watermark
+        if full:
+            state.last_full_sync = watermark
+        db.session.commit()
+
+
+def get_sync_state_store():
+    """Return the configured store of the state of the sync runs."""
+    return current_app.config["CERN_SYNC_STATE_STORE"]()
+
+
+def get_since(kind, full=None, store=None):
+    """Return the date from which to sync, or None for a full sync.
+
+    A full sync is done when requested with `full=True`, when no run of this kind
+    ever succeeded, or when the last full sync is older than
+    `CERN_SYNC_FULL_SYNC_INTERVAL`.
+
+    :param kind: the kind of sync, e.g. `users-AuthZ` or `groups`.
+    :param full: True to force a full sync, False to force a delta one when
+        possible, None to decide based on the interval.
+    :return: the ISO formatted UTC watermark of the last successful run, or None.
+    """
+    if full:
+        return None
+    store = store or get_sync_state_store()
+    watermark, last_full_sync = store.get(kind)
+    if not watermark:
+        return None
+    if full is None:
+        interval = current_app.config["CERN_SYNC_FULL_SYNC_INTERVAL"]
+        if not last_full_sync or utcnow() - last_full_sync >= interval:
+            return None
+    return watermark.isoformat()
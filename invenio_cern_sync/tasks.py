@@ -7,37 +7,260 @@
 
 """Invenio-CERN-sync tasks."""
 
-from celery import shared_task
+import uuid
+from datetime import datetime
+
+from celery import chord, shared_task
 from flask import current_app
 from invenio_db import db
 
+from .checkpoints import get_resumed_started_at
+from .errors import SyncLocked
 from .groups.sync import sync as groups_sync
+from .locks import acquire_or_raise, get_sync_lock
+from .logging import log_info
+from .state import get_since, get_sync_state_store, utcnow
+from .users.sync import QUERY_PARAMS_KEYS, get_shards, merge_shards
 from .users.sync import sync as users_sync
+from .users.sync import sync_shard
 
 
-@shared_task
-def sync_users(*args, **kwargs):
-    """Task to sync users with CERN database."""
+def _sync_since_last_run(kind, sync_fn, params_key, full, args, kwargs):
+    """Run the sync from the watermark of the previous run, and save the new one.
+
+    :param params_key: the kwarg of `sync_fn` with the params of the AuthZ query,
+        where `since` is set. None when the source does not support deltas.
+    """
+    started_at = utcnow()
+    params = kwargs.get(params_key, dict()) if params_key else dict()
+    if params_key and "since" in params:
+        # the caller chose the date: do not move the watermark
+        return sync_fn(*args, **kwargs)
+
+    since = get_since(kind, full=full) if params_key else None
+    if since:
+        kwargs[params_key] = {**params, "since": since}
+    # a run resuming a checkpoint did not fetch again the records before it
+    started_at = min(started_at, get_resumed_started_at(kind) or started_at)
+    result = sync_fn(*args, **kwargs)
+    get_sync_state_store().save(kind, started_at, full=since is None)
+    return result
+
+
+def _get_params_key(method):
+    """Return the kwarg of the users sync where `since` is set, or None.
+
+    LDAP users are fetched incrementally only when `CERN_SYNC_LDAP_INCREMENTAL`
+    is enabled.
+    """
+    if method == "LDAP" and not current_app.config["CERN_SYNC_LDAP_INCREMENTAL"]:
+        return None
+    return QUERY_PARAMS_KEYS[method]
+
+
+def _acquire(task, name):
+    """Acquire the lock of the given name, or apply the contention policy.
+
+    :return: the acquired lock, or None when the run should be skipped.
+    """
+    try:
+        return acquire_or_raise(name)
+    except SyncLocked:
+        if current_app.config["CERN_SYNC_LOCK_CONTENTION"] == "retry":
+            countdown = current_app.config["CERN_SYNC_LOCK_RETRY_DELAY"]
+            raise task.retry(countdown=countdown)
+        return None
+
+
+@shared_task(bind=True)
+def sync_users(self, *args, full=None, **kwargs):
+    """Task to sync users with CERN database.
+
+    When syncing via AuthZ, or LDAP with `CERN_SYNC_LDAP_INCREMENTAL`, only the
+    users modified since the previous successful run are fetched, unless a full
+    sync is due or forced with `full=True`.
+    Only one users sync runs at a time: see `CERN_SYNC_LOCK_CONTENTION`.
+    """
     if current_app.config.get("DEBUG", True):
         current_app.logger.warning("Users sync disabled, the DEBUG env var is True.")
         return
 
+    lock = _acquire(self, "users")
+    if not lock:
+        return
+
+    method = args[0] if args else kwargs.get("method", "AuthZ")
+    params_key = _get_params_key(method)
     try:
-        users_sync(*args, **kwargs)
+        with lock.heartbeat():
+            _sync_since_last_run(
+                f"users-{method}", users_sync, params_key, full, args, kwargs
+            )
     except Exception as e:
         db.session.rollback()
         current_app.logger.exception(e)
+    finally:
+        lock.release()
 
 
-@shared_task
-def sync_groups(*args, **kwargs):
-    """Task to sync groups with CERN database."""
+@shared_task(bind=True)
+def sync_groups(self, *args, full=None, **kwargs):
+    """Task to sync groups with CERN database.
+
+    Only the groups modified since the previous successful run are fetched, unless
+    a full sync is due or forced with `full=True`.
+    Only one groups sync runs at a time: see `CERN_SYNC_LOCK_CONTENTION`.
+    """
     if current_app.config.get("DEBUG", True):
         current_app.logger.warning("Groups sync disabled, the DEBUG env var is True.")
         return
 
+    lock = _acquire(self, "groups")
+    if not lock:
+        return
+
+    try:
+        with lock.heartbeat():
+            _sync_since_last_run("groups", groups_sync, "groups", full, args, kwargs)
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception(e)
+    finally:
+        lock.release()
+
+
+@shared_task
+def sync_users_shard(
+    method,
+    shard,
+    log_uuid=None,
+    collect_seen=False,
+    part=None,
+    lock_owner=None,
+    **kwargs,
+):
+    """Task to fetch the users of a shard and update the existing ones.
+
+    :param shard: the filters of the users of the shard, see `get_shards`.
+    :param part: the name of the shard in the metrics, e.g. `shard-3`.
+    :param lock_owner: the owner of the users lock, refreshed while running.
+    """
+    lock = get_sync_lock("users", owner=lock_owner)
+    lock.refresh()
+    with lock.heartbeat():
+        return sync_shard(
+            method,
+            shard,
+            log_uuid=log_uuid,
+            collect_seen=collect_seen,
+            part=part,
+            **kwargs,
+        )
+
+
+@shared_task
+def merge_users_shards(
+    results, kind, started_at, full, deactivate=False, log_uuid=None, lock_owner=None
+):
+    """Task to complete the sharded sync, once all shards completed.
+
+    The watermark of the run is saved only here, when `kind` is given: when a
+    shard fails, this task is not run, and the users lock expires.
+    """
+    lock = get_sync_lock("users", owner=lock_owner)
+    lock.refresh()
     try:
-        groups_sync(*args, **kwargs)
+        with lock.heartbeat():
+            ids = merge_shards(results, log_uuid=log_uuid, deactivate=deactivate)
     except Exception as e:
         db.session.rollback()
         current_app.logger.exception(e)
+        return
+    finally:
+        lock.release()
+    if kind:
+        started_at = datetime.fromisoformat(started_at)
+        get_sync_state_store().save(kind, started_at, full=full)
+    return ids
+
+
+@shared_task(bind=True)
+def sync_users_sharded(self, *args, full=None, shards=None, **kwargs):
+    """Task to sync users with CERN database, in parallel Celery tasks.
+
+    The users are partitioned in the disjoint shards of `CERN_SYNC_USERS_SHARDS`,
+    or the given `shards`. Each `sync_users_shard` task fetches the users of its
+    shard and updates the existing ones, then `merge_users_shards` syncs the users
+    that failed, e.g. swapping their e-mails across shards, and inserts the new
+    users. Only the shard filters are sent to the workers: the missing and failed
+    users, usually few, are returned to the callback. It requires a Celery result
+    backend.
+
+    As `sync_users`, only the users modified since the previous successful run are
+    fetched via AuthZ, or LDAP when incremental, unless a full sync is due or
+    forced with `full=True`. The users lock is held until `merge_users_shards`
+    completes.
+    """
+    if current_app.config.get("DEBUG", True):
+        current_app.logger.warning("Users sync disabled, the DEBUG env var is True.")
+        return
+
+    lock = _acquire(self, "users")
+    if not lock:
+        return
+
+    method = args[0] if args else kwargs.pop("method", "AuthZ")
+    kind = f"users-{method}"
+    started_at = utcnow()
+    params_key = _get_params_key(method)
+    params = kwargs.get(params_key, dict()) if params_key else dict()
+    since = None
+    if params_key and "since" in params:
+        # the caller chose the date: do not move the watermark
+        since, kind = params["since"], None
+    elif params_key:
+        since = get_since(kind, full=full)
+        if since:
+            kwargs[params_key] = {**params, "since": since}
+
+    try:
+        shards = shards or get_shards(method)
+    except Exception as e:
+        lock.release()
+        current_app.logger.exception(e)
+        return
+    log_uuid = str(uuid.uuid4())
+    log_info(
+        "users-sync",
+        dict(action="dispatching-shards", method=method, shards=len(shards)),
+        log_uuid=log_uuid,
+    )
+
+    deactivate = (
+        since is None and current_app.config["CERN_SYNC_USERS_DEACTIVATE_DEPARTED"]
+    )
+    header = [
+        sync_users_shard.s(
+            method,
+            shard,
+            log_uuid=log_uuid,
+            collect_seen=deactivate,
+            part=f"shard-{index}",
+            lock_owner=lock.owner,
+            **kwargs,
+        )
+        for index, shard in enumerate(shards)
+    ]
+    callback = merge_users_shards.s(
+        kind=kind,
+        started_at=started_at.isoformat(),
+        full=since is None,
+        deactivate=deactivate,
+        log_uuid=log_uuid,
+        lock_owner=lock.owner,
+    )
+    try:
+        return chord(header)(callback)
+    except Exception as e:
+        lock.release()
+        current_app.logger.exception(e)
@@ -9,23 +9,32 @@
 
 from flask import current_app
 from flask_security.confirmable import confirm_user
+from flask_security.signals import user_confirmed
 from invenio_accounts.models import User
+from invenio_accounts.proxies import current_db_change_history
 from invenio_db import db
 from invenio_oauthclient.models import RemoteAccount, UserIdentity
+from sqlalchemy import select, true
 
 from invenio_cern_sync.sso import cern_remote_app_name
-from invenio_cern_sync.utils import is_different
+from invenio_cern_sync.state import utcnow
+from invenio_cern_sync.utils import chunked, is_different
 
 
-def _create_user(cern_user):
-    """Create new user."""
-    user = User(
+def _new_user(cern_user):
+    """Return a new user, not added to the session."""
+    return User(
         email=cern_user["email"],
         username=cern_user["username"],
         active=True,
         user_profile=cern_user["user_profile"],
         preferences=cern_user["preferences"],
     )
+
+
+def _create_user(cern_user):
+    """Create new user."""
+    user = _new_user(cern_user)
     db.session.add(user)
     # necessary to get the auto-generated `id`
     db.session.flush()
@@ -42,6 +51,14 @@ def _create_user_identity(user, cern_user):
     )
 
 
+def _remote_account_extra_data(cern_user):
+    """Return the `extra_data` of the new remote account of the user."""
+    return dict(
+        keycloak_id=cern_user["username"],
+        **cern_user.get("remote_account_extra_data", {})
+    )
+
+
 def _create_remote_account(user, cern_user):
     """Return new user entry."""
     client_id = current_app.config["CERN_APP_CREDENTIALS"]["consumer_key"]
@@ -49,10 +66,7 @@ def _create_remote_account(user, cern_user):
     return RemoteAccount.create(
         client_id=client_id,
         user_id=user.id,
-        extra_data=dict(
-            keycloak_id=cern_user["username"],
-            **cern_user.get("remote_account_extra_data", {})
-        ),
+        extra_data=_remote_account_extra_data(cern_user),
     )
 
 
@@ -82,6 +96,60 @@ def create_user(cern_user, auto_confirm=True):
     return user_id
 
 
+def create_users(cern_users, auto_confirm=True):
+    """Create Invenio users in bulk.
+
+    Unlike `create_user`, all users are inserted with one flush, batching the
+    INSERTs of each table, without a savepoint per row. Any error fails the whole
+    batch: the caller should wrap it in a savepoint.
+
+    :param cern_users: list of dicts, in the format expected by `create_user`.
+    :param auto_confirm: set the users `confirmed`
+    :return: the list of the newly created Invenio user ids.
+    """
+    assert cern_remote_app_name
+    client_id = current_app.config["CERN_APP_CREDENTIALS"]["consumer_key"]
+    assert client_id
+
+    users = [_new_user(cern_user) for cern_user in cern_users]
+    if auto_confirm:
+        now = current_app.extensions["security"].datetime_factory()
+        for user in users:
+            user.confirmed_at = now
+    db.session.add_all(users)
+    # the `id`s of all users are returned by the batched INSERT
+    db.session.flush()
+
+    db.session.add_all(
+        [
+            UserIdentity(
+                id=cern_user["user_identity_id"],
+                method=cern_remote_app_name,
+                id_user=user.id,
+            )
+            for user, cern_user in zip(users, cern_users)
+        ]
+    )
+    db.session.add_all(
+        [
+            RemoteAccount(
+                client_id=client_id,
+                user_id=user.id,
+                extra_data=_remote_account_extra_data(cern_user),
+            )
+            for user, cern_user in zip(users, cern_users)
+        ]
+    )
+    db.session.flush()
+
+    if auto_confirm:
+        # as `confirm_user` does, for the listeners of confirmed users
+        app = current_app._get_current_object()
+        for user in users:
+            user_confirmed.send(app, user=user)
+    return [user.id for user in users]
+
+
 ###################################################################################
 # User update
 
@@ -135,13 +203,16 @@ def _update_useridentity(user_id, user_identity, cern_user):
     return updated
 
 
-def _update_remote_account(user, cern_user):
-    """Update RemoteAccount table."""
+def _update_remote_account(user, cern_user, remote_account=None):
+    """Update RemoteAccount table.
+
+    :param remote_account: the already fetched RemoteAccount of the user, if any.
+    """
     updated = False
     extra_data = cern_user["remote_account_extra_data"]
     client_id = current_app.config["CERN_APP_CREDENTIALS"]["consumer_key"]
     assert client_id
-    remote_account = RemoteAccount.get(user.id, client_id)
+    remote_account = remote_account or RemoteAccount.get(user.id, client_id)
 
     if not remote_account:
         # should probably never happen
@@ -154,11 +225,63 @@ def _update_remote_account(user, cern_user):
     return updated
 
 
-def update_existing_user(local_user, local_user_identity, cern_user):
+def update_existing_user(
+    local_user, local_user_identity, cern_user, remote_account=None
+):
     """Update all user tables, when necessary."""
     user_updated = _update_user(local_user, cern_user)
     identity_updated = _update_useridentity(
         local_user.id, local_user_identity, cern_user
     )
-    remote_updated = _update_remote_account(local_user, cern_user)
+    remote_updated = _update_remote_account(
+        local_user, cern_user, remote_account=remote_account
+    )
     return user_updated or identity_updated or remote_updated
+
+
+###################################################################################
+# User deactivation
+
+
+def iter_active_identities(batch_size=1000):
+    """Stream the `(identity id, user id)` of the active CERN users, by identity id.
+
+    Rows are fetched with a server-side cursor, `batch_size` at a time. On
+    PostgreSQL, ids are sorted by code point, as Python sorts strings, so that the
+    stream can be merge-joined with a sorted list of ids.
+    """
+    sort_key = UserIdentity.id
+    if db.engine.dialect.name == "postgresql":
+        sort_key = sort_key.collate("C")
+    stmt = (
+        select(UserIdentity.id, UserIdentity.id_user)
+        .join(User, User.id == UserIdentity.id_user)
+        .where(UserIdentity.method == cern_remote_app_name, User.active == true())
+        .order_by(sort_key)
+        .execution_options(yield_per=batch_size)
+    )
+    for row in db.session.execute(stmt):
+        yield row.id, row.id_user
+
+
+def deactivate_users(user_ids, batch_size=1000):
+    """Deactivate the given users, with one UPDATE per batch of `batch_size`.
+
+    :return: the number of deactivated users.
+    """
+    table = User.__table__
+    # naive UTC, as `User.updated` is written by the ORM
+    now = utcnow()
+    session_id = id(db.session)
+    count = 0
+    for batch in chunked(user_ids, batch_size):
+        stmt = (
+            table.update()
+            .where(table.c.id.in_(batch), table.c.active == true())
+            .values(active=False, updated=now, version_id=table.c.version_id + 1)
+        )
+        count += db.session.execute(stmt).rowcount
+        # let the listeners of the datastore, e.g. the indexers, know what changed
+        for user_id in batch:
+            current_db_change_history.add_updated_user(session_id, user_id)
+    return count
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-CERN-sync buffer of the new users, inserted after all the updates."""
+
+import json
+import tempfile
+
+from flask import current_app
+
+
+class MissingUsersBuffer:
+    """Append-only queue of serialized users, spilled to a temporary file.
+
+    Users are written as JSON lines, in memory until `max_memory` bytes, then to
+    a temporary file. Only their identity ids and usernames are kept in memory,
+    to detect the users fetched twice and the usernames already taken by another
+    new user, which would fail the insertion of their chunk.
+    """
+
+    def __init__(self, max_memory=None):
+        """Constructor.
+
+        :param max_memory: max size, in bytes, of the users kept in memory.
+            Defaults to `CERN_SYNC_USERS_MISSING_MAX_MEMORY`.
+        """
+        self.max_memory = (
+            max_memory or current_app.config["CERN_SYNC_USERS_MISSING_MAX_MEMORY"]
+        )
+        self._file = tempfile.SpooledTemporaryFile(
+            max_size=self.max_memory, prefix="cern-sync-missing-"
+        )
+        self._size = 0
+        self._identity_ids = set()
+        self._usernames = set()
+
+    def __len__(self):
+        """Return the number of buffered users."""
+        return len(self._identity_ids)
+
+    def __contains__(self, identity_id):
+        """Return True if the user with the given identity id is buffered."""
+        return str(identity_id) in self._identity_ids
+
+    def has_username(self, username):
+        """Return True if a buffered user has the given username."""
+        return username.lower() in self._usernames
+
+    def add(self, invenio_user):
+        """Append the serialized user, unless its identity id or username is taken.
+
+        :return: True if the user was added.
+        """
+        identity_id = str(invenio_user["user_identity_id"])
+        if identity_id in self._identity_ids or self.has_username(
+            invenio_user["username"]
+        ):
+            return False
+        line = json.dumps(invenio_user).encode("utf-8") + b"\n"
+        self._file.write(line)
+        self._size += len(line)
+        self._identity_ids.add(identity_id)
+        self._usernames.add(invenio_user["username"].lower())
+        return True
+
+    def extend(self, invenio_users):
+        """Append the serialized users, see `add`.
+
+        :return: the list of the users not added.
+        """
+        return [u for u in invenio_users if not self.add(u)]
+
+    def __iter__(self):
+        """Yield the buffered users, in the order they were added."""
+        self._file.flush()
+        self._file.seek(0)
+        try:
+            for line in self._file:
+                yield json.loads(line)
+        finally:
+            # next users are appended at the end
+            self._file.seek(0, 2)
+
+    @property
+    def spilled(self):
+        """Return True if the users were written to disk.
+
+        The file rolls over to disk once more than `max_memory` bytes are written.
+        """
+        return self._size > self.max_memory
+
+    def close(self):
+        """Delete the buffered users."""
+        self._file.close()
+
+    def __enter__(self):
+        """Return the buffer."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Delete the buffered users."""
+        self.close()
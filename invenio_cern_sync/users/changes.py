@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-CERN-sync history of the e-mail/username and identity id changes.
+
+Each change is a row of the `cern_sync_user_change` table, written with the
+synced users of its chunk. The changes were previously recorded in the `changes`
+list of the `RemoteAccount.extra_data`, rewritten with each new change, see
+`migrate_extra_data_changes`.
+"""
+
+from datetime import datetime, timezone
+
+from flask import current_app
+from invenio_accounts.models import UserIdentity
+from invenio_db import db
+from invenio_oauthclient.models import RemoteAccount
+from sqlalchemy import insert
+
+from ..models import CERNSyncUserChange
+from ..sso import cern_remote_app_name
+from ..state import utcnow
+
+USER_DATA_CHANGED = "userdata_changed"
+IDENTITY_ID_CHANGED = "identityId_changed"
+
+
+class UserChanges:
+    """Changes of the users synced by a run, written to the DB in batches.
+
+    Changes are added while the users of a chunk are reconciled, and inserted at
+    once by `flush`, before the chunk is committed.
+    """
+
+    def __init__(self, log_uuid=None):
+        """Constructor.
+
+        :param log_uuid: the uuid of the logs of the run, stored with each change.
+        """
+        self.log_uuid = log_uuid
+        self._pending = []
+
+    def add(self, action, identity_id, user_id, **data):
+        """Add a change, with the previous and new values as `data`."""
+        self._pending.append(
+            dict(
+                created=utcnow(),
+                identity_id=str(identity_id),
+                user_id=user_id,
+                action=action,
+                log_uuid=self.log_uuid,
+                data=data,
+            )
+        )
+
+    def flush(self):
+        """Insert the pending changes in the DB session, without committing."""
+        if self._pending:
+            db.session.execute(insert(CERNSyncUserChange), self._pending)
+            self._pending = []
+
+    def clear(self):
+        """Discard the pending changes, e.g. of a rolled back chunk."""
+        self._pending = []
+
+
+def get_user_changes(identity_id=None, user_id=None):
+    """Return the query of the changes of a user, the most recent first.
+
+    :param identity_id: the CERN identity id of the user after the change.
+    :param user_id: the id of the local user.
+    """
+    query = CERNSyncUserChange.query
+    if identity_id is not None:
+        query = query.filter_by(identity_id=str(identity_id))
+    if user_id is not None:
+        query = query.filter_by(user_id=user_id)
+    return query.order_by(
+        CERNSyncUserChange.created.desc(), CERNSyncUserChange.id.desc()
+    )
+
+
+def prune_user_changes(retention=None):
+    """Delete the changes older than the retention, without committing.
+
+    :param retention: timedelta. Defaults to `CERN_SYNC_USERS_CHANGES_RETENTION`.
+        Nothing is deleted when None.
+    :return: the number of deleted changes.
+    """
+    retention = retention or current_app.config["CERN_SYNC_USERS_CHANGES_RETENTION"]
+    if not retention:
+        return 0
+    return CERNSyncUserChange.query.filter(
+        CERNSyncUserChange.created < utcnow() - retention
+    ).delete(synchronize_session=False)
+
+
+def _created(change):
+    """Return the naive UTC datetime of a change of the `extra_data`."""
+    if not change.get("datetime"):
+        return utcnow()
+    created = datetime.fromisoformat(change["datetime"])
+    if created.tzinfo:
+        created = created.astimezone(timezone.utc).replace(tzinfo=None)
+    return created
+
+
+def migrate_extra_data_changes(batch_size=1000):
+    """Move the `changes` of the CERN remote accounts to the changes table.
+
+    Remote accounts are migrated in batches, each committed: it can be run again
+    if interrupted, and while the users are synced.
+
+    :return: the number of migrated changes.
+    """
+    client_id = current_app.config["CERN_APP_CREDENTIALS"]["consumer_key"]
+    migrated, last_id = 0, 0
+    while True:
+        remote_accounts = (
+            RemoteAccount.query.filter(
+                RemoteAccount.client_id == client_id, RemoteAccount.id > last_id
+            )
+            .order_by(RemoteAccount.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not remote_accounts:
+            return migrated
+        last_id = remote_accounts[-1].id
+
+        remote_accounts = [ra for ra in remote_accounts if ra.extra_data.get("changes")]
+        user_ids = [ra.user_id for ra in remote_accounts]
+        identity_ids = dict(
+            db.session.query(UserIdentity.id_user, UserIdentity.id).filter(
+                UserIdentity.id_user.in_(user_ids),
+                UserIdentity.method == cern_remote_app_name,
+            )
+        )
+        rows = []
+        for remote_account in remote_accounts:
+            extra_data = dict(remote_account.extra_data)
+            for change in extra_data.pop("changes"):
+                data = {
+                    key: value
+                    for key, value in change.items()
+                    if key not in ("datetime", "action")
+                }
+                rows.append(
+                    dict(
+                        created=_created(change),
+                        identity_id=change.get("new_identity_id")
+                        or identity_ids.get(remote_account.user_id),
+                        user_id=remote_account.user_id,
+                        action=change.get("action"),
+                        log_uuid=None,
+                        data=data,
+                    )
+                )
+            remote_account.extra_data = extra_data
+        if rows:
+            db.session.execute(insert(CERNSyncUserChange), rows)
+        db.session.commit()
+        migrated += len(rows)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-CERN-sync lookup of the local users to reconcile."""
+
+from collections import defaultdict
+
+from flask import current_app
+from invenio_accounts.models import User, UserIdentity
+from invenio_oauthclient.models import RemoteAccount
+from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
+
+
+class LocalUsersLookup:
+    """Resolve local users, identities and remote accounts, one query per lookup."""
+
+    def __init__(self, client_id=None):
+        """Constructor."""
+        self.client_id = (
+            client_id or current_app.config["CERN_APP_CREDENTIALS"]["consumer_key"]
+        )
+
+    def prefetch(self, invenio_users):
+        """Prepare the lookup for the given chunk of serialized users."""
+
+    def track(self, *objs):
+        """Notify the lookup that the given objects might have changed."""
+
+    def get_identity(self, identity_id):
+        """Return the UserIdentity with the given id, or None."""
+        return UserIdentity.query.filter_by(id=identity_id).one_or_none()
+
+    def get_user(self, email, username):
+        """Return the User with the given e-mail and username, or None."""
+        return User.query.filter_by(email=email, username=username).one_or_none()
+
+    def get_identity_by_user(self, user_id):
+        """Return the UserIdentity of the given user id or raise NoResultFound."""
+        return UserIdentity.query.filter_by(id_user=user_id).one()
+
+    def get_remote_account(self, user_id):
+        """Return the RemoteAccount of the given user id, or None."""
+        return RemoteAccount.get(user_id, self.client_id)
+
+
+def _one_or_none(objs):
+    """Return the only element of the list, None if empty, or raise."""
+    if len(objs) > 1:
+        raise MultipleResultsFound(
+            "Multiple rows were found when one or none was required"
+        )
+    return objs[0] if objs else None
+
+
+class _Index:
+    """Group objects by a key that can change while objects are being updated."""
+
+    def __init__(self, key_fn):
+        """Constructor."""
+        self._key_fn = key_fn
+        self._by_key = defaultdict(list)
+        self._keys = dict()
+
+    def add(self, obj):
+        """Index the object under its current key, dropping the previous one."""
+        previous_key = self._keys.get(obj)
+        key = self._key_fn(obj)
+        if previous_key == key and obj in self._by_key[key]:
+            return
+        if previous_key is not None:
+            self._by_key[previous_key].remove(obj)
+        self._by_key[key].append(obj)
+        self._keys[obj] = key
+
+    def __contains__(self, obj):
+        """Return True if the object is indexed."""
+        return obj in self._keys
+
+    def get(self, key):
+        """Return the list of objects indexed under the given key."""
+        return list(self._by_key.get(key, []))
+
+
+class BulkLocalUsersLookup(LocalUsersLookup):
+    """Resolve local users from in-memory dicts, prefetched once per chunk.
+
+    For each chunk of serialized users, it fetches the matching `User`,
+    `UserIdentity` and `RemoteAccount` rows with one `IN (...)` query per table.
+    The objects updated while reconciling the chunk must be passed to `track`, so
+    that the following lookups see the same state that a query would return.
+    """
+
+    def prefetch(self, invenio_users):
+        """Fetch all the rows that could match the given chunk of users."""
+        self._identities_by_id = _Index(lambda ui: ui.id)
+        self._identities_by_user = _Index(lambda ui: ui.id_user)
+        self._users = _Index(lambda u: (u.email, u._username))
+        self._remote_accounts = dict()
+
+        emails = {invenio_user["email"] for invenio_user in invenio_users}
+        identity_ids = {
+            invenio_user["user_identity_id"] for invenio_user in invenio_users
+        }
+
+        users = User.query.filter(User._email.in_(emails)).all() if emails else []
+        # all the identities of these users are fetched
+        self._identity_user_ids = {user.id for user in users}
+        for user in users:
+            self._users.add(user)
+
+        identities = UserIdentity.query.filter(
+            UserIdentity.id.in_(identity_ids)
+            | UserIdentity.id_user.in_(self._identity_user_ids)
+        ).all()
+        for user_identity in identities:
+            self._identities_by_id.add(user_identity)
+            if user_identity.id_user in self._identity_user_ids:
+                self._identities_by_user.add(user_identity)
+
+        # the users linked to the fetched identities are also candidates
+        self._user_ids = self._identity_user_ids | {
+            user_identity.id_user for user_identity in identities
+        }
+        remote_accounts = RemoteAccount.query.filter(
+            RemoteAccount.client_id == self.client_id,
+            RemoteAccount.user_id.in_(self._user_ids),
+        ).all()
+        for remote_account in remote_accounts:
+            self._remote_accounts.setdefault(remote_account.user_id, remote_account)
+
+    def track(self, *objs):
+        """Re-index the given objects after they have been updated or created."""
+        for obj in objs:
+            if isinstance(obj, User):
+                self._users.add(obj)
+            elif isinstance(obj, UserIdentity):
+                self._identities_by_id.add(obj)
+                tracked = obj in self._identities_by_user
+                if tracked or obj.id_user in self._identity_user_ids:
+                    self._identities_by_user.add(obj)
+            elif isinstance(obj, RemoteAccount):
+                self._remote_accounts.setdefault(obj.user_id, obj)
+
+    def get_identity(self, identity_id):
+        """Return the UserIdentity with the given id, or None."""
+        return _one_or_none(self._identities_by_id.get(identity_id))
+
+    def get_user(self, email, username):
+        """Return the User with the given e-mail and username, or None."""
+        return _one_or_none(self._users.get((email, username.lower())))
+
+    def get_identity_by_user(self, user_id):
+        """Return the UserIdentity of the given user id or raise NoResultFound."""
+        if user_id not in self._identity_user_ids:
+            # not prefetched, e.g. a user that changed e-mail in this chunk
+            return super().get_identity_by_user(user_id)
+        user_identity = _one_or_none(self._identities_by_user.get(user_id))
+        if not user_identity:
+            raise NoResultFound("No row was found when one was required")
+        return user_identity
+
+    def get_remote_account(self, user_id):
+        """Return the RemoteAccount of the given user id, or None."""
+        if user_id not in self._user_ids:
+            return super().get_remote_account(user_id)
+        return self._remote_accounts.get(user_id)
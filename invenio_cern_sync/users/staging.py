@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-CERN-sync set-based reconciliation of the users, on PostgreSQL.
+
+All the serialized CERN users are copied, with `COPY`, to a temporary staging
+table. Then, a few statements resolve the local user of each staged user, and
+update all the changed users at once, as `_update_existing_user` does for each.
+
+The statements bypass the validation of the `User` model: the username, the
+profile and the preferences of each user are validated before the copy instead.
+"""
+
+import csv
+import io
+import json
+import tempfile
+from datetime import datetime, timezone
+
+from flask import current_app
+from invenio_accounts.profiles.dicts import UserPreferenceDict, UserProfileDict
+from invenio_accounts.utils import split_emailaddr, validate_username
+from invenio_db import db
+from sqlalchemy import text
+
+from ..errors import StagingConflict
+from ..sso import cern_remote_app_name
+from ..state import utcnow
+from ..utils import chunked, fingerprint
+
+TABLE = "cern_sync_users_staging"
+
+_CREATE = f"""
+CREATE TEMPORARY TABLE {TABLE} (
+    seq bigint NOT NULL,
+    identity_id text NOT NULL,
+    email text NOT NULL,
+    domain text NOT NULL,
+    username text NOT NULL,
+    fingerprint text,
+    data jsonb NOT NULL,
+    identity_user_id integer,
+    user_id integer,
+    target_id integer,
+    unchanged boolean NOT NULL DEFAULT false,
+    change jsonb
+) ON COMMIT DROP
+"""
+
+_COLUMNS = "seq, identity_id, email, domain, username, fingerprint, data"
+
+_RESOLVE = [
+    # the user of the identity id, the CERN unique id
+    f"""
+    UPDATE {TABLE} AS s SET identity_user_id = ui.id_user
+    FROM accounts_useridentity AS ui WHERE ui.id = s.identity_id
+    """,
+    # the user with the same e-mail and username
+    f"""
+    UPDATE {TABLE} AS s SET user_id = u.id
+    FROM accounts_user AS u
+    WHERE u.email = s.email AND u.username = lower(s.username)
+    """,
+    # the identity id wins when both changed, see `_update_existing_user`
+    f"""
+    UPDATE {TABLE} SET target_id = coalesce(identity_user_id, user_id)
+    """,
+]
+
+_CONFLICTS = f"""
+SELECT
+    (SELECT count(*) FROM (
+        SELECT target_id FROM {TABLE} WHERE target_id IS NOT NULL
+        GROUP BY target_id HAVING count(*) > 1
+    ) AS t)
+    + (SELECT count(*) FROM (
+        SELECT s.identity_id FROM {TABLE} AS s
+        JOIN accounts_useridentity AS ui ON ui.id_user = s.user_id
+        WHERE s.identity_user_id IS NULL
+        GROUP BY s.identity_id HAVING count(*) > 1
+    ) AS i)
+"""
+
+_SKIP_UNCHANGED = f"""
+UPDATE {TABLE} AS s SET unchanged = true
+FROM oauthclient_remoteaccount AS ra
+WHERE s.identity_user_id = s.user_id
+    AND ra.user_id = s.target_id AND ra.client_id = :client_id
+    AND ra.extra_data ->> 'fingerprint' = s.fingerprint
+"""
+
+_USER_DATA_CHANGES = f"""
+UPDATE {TABLE} AS s SET change = jsonb_build_object(
+    'action', 'userdata_changed',
+    'previous_username', u.displayname,
+    'previous_email', u.email,
+    'new_username', s.username,
+    'new_email', s.email
+)
+FROM accounts_user AS u
+WHERE u.id = s.target_id
+    AND s.identity_user_id IS NOT NULL
+    AND s.user_id IS DISTINCT FROM s.identity_user_id
+RETURNING s.identity_id, s.target_id, s.change
+"""
+
+_IDENTITY_ID_CHANGES = f"""
+UPDATE {TABLE} AS s SET change = jsonb_build_object(
+    'action', 'identityId_changed',
+    'previous_identity_id', coalesce(
+        (SELECT ui.id FROM accounts_useridentity AS ui WHERE ui.id_user = s.user_id),
+        s.identity_id
+    ),
+    'new_identity_id', s.identity_id
+)
+WHERE s.identity_user_id IS NULL AND s.user_id IS NOT NULL
+RETURNING s.identity_id, s.target_id, s.username, s.email, s.change
+"""
+
+_USER_CHANGED = """
+    u.email IS DISTINCT FROM lower(s.email)
+    OR u.username IS DISTINCT FROM lower(s.username)
+"""
+
+# the users changing an e-mail or username taken by another staged user are moved
+# aside first, as the unique constraints are checked for each updated row. The
+# placeholders are never committed: `_UPDATE_USERS` sets the validated values of
+# each moved user in the same savepoint.
+_SWAPPED_USERS = f"""
+UPDATE accounts_user AS u SET
+    email = 'cern-sync-swap-' || u.id || '@invalid',
+    username = 'cern-sync-swap-' || u.id
+FROM {TABLE} AS s
+WHERE u.id = s.target_id AND NOT s.unchanged AND ({_USER_CHANGED})
+    AND EXISTS (
+        SELECT 1 FROM {TABLE} AS o
+        WHERE o.target_id <> u.id AND NOT o.unchanged
+            AND (lower(o.email) = u.email OR lower(o.username) = u.username)
+    )
+RETURNING u.id
+"""
+
+_UPDATE_USERS = f"""
+UPDATE accounts_user AS u SET
+    email = lower(s.email),
+    domain = s.domain,
+    username = lower(s.username),
+    displayname = s.username,
+    profile = coalesce(u.profile, '{{}}') || (s.data -> 'user_profile'),
+    preferences = coalesce(u.preferences, '{{}}') || (s.data -> 'preferences'),
+    updated = :now,
+    version_id = u.version_id + 1
+FROM {TABLE} AS s
+WHERE u.id = s.target_id AND NOT s.unchanged AND (
+    {_USER_CHANGED}
+    OR EXISTS (
+        SELECT 1 FROM jsonb_each(s.data -> 'user_profile') AS kv
+        WHERE u.profile -> kv.key IS DISTINCT FROM kv.value
+    )
+    OR EXISTS (
+        SELECT 1 FROM jsonb_each(s.data -> 'preferences') AS kv
+        WHERE coalesce(u.preferences -> kv.key, '""') IS DISTINCT FROM kv.value
+    )
+)
+RETURNING u.id
+"""
+
+_UPDATE_IDENTITIES = f"""
+UPDATE accounts_useridentity AS ui SET id = s.identity_id, updated = :now
+FROM {TABLE} AS s
+WHERE ui.id_user = s.user_id AND s.identity_user_id IS NULL
+RETURNING ui.id_user
+"""
+
+_INSERT_IDENTITIES = f"""
+INSERT INTO accounts_useridentity (id, method, id_user, created, updated)
+SELECT s.identity_id, :method, s.user_id, :now, :now
+FROM {TABLE} AS s
+WHERE s.identity_user_id IS NULL AND s.user_id IS NOT NULL
+    AND NOT EXISTS (
+        SELECT 1 FROM accounts_useridentity AS ui WHERE ui.id_user = s.user_id
+    )
+RETURNING id_user
+"""
+
+_EXTRA_DATA = "(s.data -> 'remote_account_extra_data')"
+
+_UPDATE_REMOTE_ACCOUNTS = f"""
+UPDATE oauthclient_remoteaccount AS ra SET
+    extra_data = ra.extra_data || {_EXTRA_DATA},
+    updated = :now
+FROM {TABLE} AS s
+WHERE ra.user_id = s.target_id AND ra.client_id = :client_id AND NOT s.unchanged
+    AND EXISTS (
+        SELECT 1 FROM jsonb_each({_EXTRA_DATA}) AS kv
+        WHERE ra.extra_data -> kv.key IS DISTINCT FROM kv.value
+    )
+RETURNING ra.user_id
+"""
+
+# stored apart, to not report users as updated only for a new fingerprint
+_UPDATE_FINGERPRINTS = f"""
+UPDATE oauthclient_remoteaccount AS ra SET
+    extra_data = ra.extra_data || jsonb_build_object('fingerprint', s.fingerprint)
+FROM {TABLE} AS s
+WHERE ra.user_id = s.target_id AND ra.client_id = :client_id AND NOT s.unchanged
+    AND s.fingerprint IS NOT NULL
+    AND ra.extra_data ->> 'fingerprint' IS DISTINCT FROM s.fingerprint
+"""
+
+_INSERT_REMOTE_ACCOUNTS = f"""
+INSERT INTO oauthclient_remoteaccount (user_id, client_id, extra_data, created, updated)
+SELECT s.target_id, :client_id, {_EXTRA_DATA}, :now, :now
+FROM {TABLE} AS s
+WHERE s.target_id IS NOT NULL AND NOT s.unchanged
+    AND NOT EXISTS (
+        SELECT 1 FROM oauthclient_remoteaccount AS ra
+        WHERE ra.user_id = s.target_id AND ra.client_id = :client_id
+    )
+RETURNING user_id
+"""
+
+_INSERT_CHANGES = f"""
+INSERT INTO cern_sync_user_change (created, identity_id, user_id, action, log_uuid, data)
+SELECT :created, s.identity_id, s.target_id, s.change ->> 'action', :log_uuid,
+    CAST(s.change - 'action' AS json)
+FROM {TABLE} AS s
+WHERE s.change IS NOT NULL
+ORDER BY s.seq
+"""
+
+
+def is_valid(invenio_user):
+    """Return True if the user passes the validation of the `User` model.
+
+    The username, the profile and the preferences are validated as their setters
+    do, e.g. against the `ACCOUNTS_USER_PROFILE_SCHEMA`.
+    """
+    try:
+        validate_username(invenio_user["username"])
+        UserProfileDict(**invenio_user["user_profile"])
+        UserPreferenceDict(**invenio_user["preferences"])
+    except ValueError:
+        return False
+    return True
+
+
+def is_staging_enabled():
+    """Return True if the users are reconciled via a staging table."""
+    return (
+        current_app.config["CERN_SYNC_USERS_STAGING"]
+        and db.engine.dialect.name == "postgresql"
+    )
+
+
+class UsersStaging:
+    """Staging table of the serialized CERN users, in the current transaction.
+
+    The table is dropped on commit: the users to insert and the reconciled users
+    must be read before.
+    """
+
+    def __init__(self, client_id=None, copy_every=10000):
+        """Constructor.
+
+        :param copy_every: number of users copied with each `COPY` statement.
+        """
+        self.client_id = (
+            client_id or current_app.config["CERN_APP_CREDENTIALS"]["consumer_key"]
+        )
+        self.copy_every = copy_every
+        self.count = 0
+        self.invalid = 0
+
+    def _execute(self, sql, **params):
+        """Execute the statement in the current transaction."""
+        return db.session.execute(text(sql), params)
+
+    def _copy(self, rows):
+        """Copy the rows to the staging table.
+
+        All strings are quoted, and a quoted empty string is not NULL in CSV: the
+        missing fingerprints, written as `""`, are forced to NULL.
+        """
+        buffer = io.StringIO()
+        csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(rows)
+        buffer.seek(0)
+        cursor = db.session.connection().connection.driver_connection.cursor()
+        try:
+            cursor.copy_expert(
+                f"COPY {TABLE} ({_COLUMNS}) FROM STDIN "
+                "WITH (FORMAT csv, FORCE_NULL (fingerprint))",
+                buffer,
+            )
+        finally:
+            cursor.close()
+
+    def stage(self, invenio_users, skip_unchanged=False, seen_ids=None):
+        """Create the staging table, and copy the serialized users to it.
+
+        The users fetched twice are staged once, with their last values. The
+        invalid users, see `is_valid`, are counted in `invalid`.
+
+        :param skip_unchanged: when True, the fingerprint of each user is staged.
+        :param seen_ids: when provided, the set is filled with the identity ids of
+            all the users.
+        """
+        self._execute(f"DROP TABLE IF EXISTS {TABLE}")
+        self._execute(_CREATE)
+        for chunk in chunked(invenio_users, self.copy_every):
+            rows = []
+            for invenio_user in chunk:
+                identity_id = str(invenio_user["user_identity_id"])
+                if seen_ids is not None:
+                    seen_ids.add(identity_id)
+                if not is_valid(invenio_user):
+                    self.invalid += 1
+                rows.append(
+                    (
+                        self.count,
+                        identity_id,
+                        invenio_user["email"],
+                        split_emailaddr(invenio_user["email"])[1],
+                        invenio_user["username"],
+                        fingerprint(invenio_user) if skip_unchanged else None,
+                        json.dumps(invenio_user),
+                    )
+                )
+                self.count += 1
+            self._copy(rows)
+
+        self._execute(
+            f"DELETE FROM {TABLE} AS a USING {TABLE} AS b "
+            "WHERE a.identity_id = b.identity_id AND a.seq < b.seq"
+        )
+        self._execute(f"ALTER TABLE {TABLE} ADD PRIMARY KEY (identity_id)")
+        self._execute(f"CREATE INDEX ON {TABLE} (target_id)")
+        self._execute(f"ANALYZE {TABLE}")
+
+    def reconcile(self, skip_unchanged=False, log_uuid=None):
+        """Update the local users changed in the staged users, in a savepoint.
+
+        The e-mail/username and identity id changes are recorded in the changes
+        table, with the given `log_uuid`.
+
+        :raises StagingConflict: when a staged user is not valid, or a local user
+            matches several staged users, or has several identities. On any error,
+            the savepoint is rolled back.
+        :return: a dict with the `updated` user ids, the number of `unchanged` and
+            `swapped` users, the `user_data_changes` rows, with the `identity_id`,
+            the `target_id` and the `change`, and the `identity_id_changes` rows,
+            with also the `username` and the `email`.
+        """
+        if self.invalid:
+            # updated in chunks instead, to fail as the `User` model does
+            raise StagingConflict(f"{self.invalid} staged users are not valid.")
+        params = dict(
+            # aware, as a naive value would be read in the time zone of the session
+            now=datetime.now(tz=timezone.utc),
+            client_id=self.client_id,
+            method=cern_remote_app_name,
+        )
+        with db.session.begin_nested():
+            for sql in _RESOLVE:
+                self._execute(sql)
+            conflicts = self._execute(_CONFLICTS).scalar()
+            if conflicts:
+                raise StagingConflict(f"{conflicts} local users are ambiguous.")
+            unchanged = 0
+            if skip_unchanged:
+                unchanged = self._execute(_SKIP_UNCHANGED, **params).rowcount
+
+            user_data_changes = self._execute(_USER_DATA_CHANGES, **params).all()
+            identity_id_changes = self._execute(_IDENTITY_ID_CHANGES, **params).all()
+            swapped = self._execute(_SWAPPED_USERS, **params).all()
+
+            updated = {row[0] for row in self._execute(_UPDATE_USERS, **params)}
+            if not {row[0] for row in swapped} <= updated:
+                raise StagingConflict("Users moved aside were not updated.")
+            for sql in [
+                _UPDATE_IDENTITIES,
+                _INSERT_IDENTITIES,
+                _UPDATE_REMOTE_ACCOUNTS,
+            ]:
+                updated.update(row[0] for row in self._execute(sql, **params))
+            self._execute(_UPDATE_FINGERPRINTS, **params)
+            updated.update(
+                row[0] for row in self._execute(_INSERT_REMOTE_ACCOUNTS, **params)
+            )
+            self._execute(_INSERT_CHANGES, created=utcnow(), log_uuid=log_uuid)
+
+        return dict(
+            updated=updated,
+            unchanged=unchanged,
+            swapped=len(swapped),
+            user_data_changes=user_data_changes,
+            identity_id_changes=identity_id_changes,
+        )
+
+    def _iter_data(self, where=""):
+        """Yield the staged users matching the condition, in the fetched order."""
+        stmt = text(f"SELECT data FROM {TABLE} {where} ORDER BY seq")
+        for (data,) in db.session.execute(stmt.execution_options(yield_per=1000)):
+            yield data
+
+    def iter_missing(self):
+        """Yield the staged users without a local user, to insert."""
+        return self._iter_data("WHERE target_id IS NULL")
+
+    def iter_reconciled(self):
+        """Yield the staged users with a local user."""
+        return self._iter_data("WHERE target_id IS NOT NULL")
+
+    def spool(self, max_memory=None):
+        """Return an iterable of all the staged users, kept after the commit.
+
+        The users are written as JSON lines to a temporary file, e.g. to reconcile
+        them one chunk after the other instead.
+        """
+        max_memory = (
+            max_memory or current_app.config["CERN_SYNC_USERS_MISSING_MAX_MEMORY"]
+        )
+        spool = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        for data in self._iter_data():
+            spool.write(json.dumps(data).encode("utf-8") + b"\n")
+        self.drop()
+
+        def _iter():
+            with spool:
+                spool.seek(0)
+                for line in spool:
+                    yield json.loads(line)
+
+        return _iter()
+
+    def drop(self):
+        """Drop the staging table."""
+        self._execute(f"DROP TABLE IF EXISTS {TABLE}")
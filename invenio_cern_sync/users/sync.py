@@ -7,220 +7,592 @@
 
 """Invenio-CERN-sync users sync API."""
 
+import copy
+import itertools
 import time
 import uuid
-from datetime import datetime, timezone
 
 from flask import current_app
-from invenio_accounts.models import User, UserIdentity
+from invenio_accounts.models import UserIdentity
+from invenio_accounts.proxies import current_db_change_history
 from invenio_db import db
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm.exc import NoResultFound
 
-from ..authz.client import AuthZService, KeycloakService
+from ..authz.aio import AsyncAuthZService, AsyncKeycloakService, iter_sync
+from ..authz.client import (
+    PERSON_ID_SHARDS,
+    AuthZService,
+    KeycloakService,
+    in_shard,
+)
+from ..authz.retry import get_retry_policy
 from ..authz.serializer import serialize_cern_identities
-from ..ldap.client import LdapClient
+from ..checkpoints import SyncCheckpoint
+from ..errors import StagingConflict
+from ..ldap.client import CN_PARTITIONS, PRIMARY_ACCOUNTS_FILTER, LdapClient
 from ..ldap.serializer import serialize_ldap_users
-from ..logging import log_info, log_warning
+from ..logging import log_error, log_info, log_warning
+from ..metrics import NULL_METRICS, SyncMetrics
+from ..pipeline import iter_pipelined
+from ..session import SyncSession
+from ..snapshots import get_snapshot_diff
 from ..sso import cern_remote_app_name
-from .api import create_user, update_existing_user
+from ..utils import chunked, fingerprint
+from .api import (
+    create_user,
+    create_users,
+    deactivate_users,
+    iter_active_identities,
+    update_existing_user,
+)
+from .buffer import MissingUsersBuffer
+from .changes import (
+    IDENTITY_ID_CHANGED,
+    USER_DATA_CHANGED,
+    UserChanges,
+    prune_user_changes,
+)
+from .lookup import BulkLocalUsersLookup, LocalUsersLookup
+from .staging import UsersStaging, is_staging_enabled
 
 
 def _log_user_data_changed(
     log_uuid,
     log_name,
     log_action,
-    ra_extra_data,
+    changes,
     identity_id,
+    user_id,
     previous_username,
     previous_email,
     new_username,
     new_email,
 ):
-    """Log a warning about username/e-mail change."""
+    """Log a warning about username/e-mail change.
+
+    :param changes: the UserChanges of the run, where the change is recorded. None
+        when already recorded.
+    """
     log_msg = f"Username/e-mail changed for UserIdentity.id #{identity_id}. Local DB username/e-mail: `{previous_username}` `{previous_email}`. New from CERN DB: `{new_username}` `{new_email}`."
     log_warning(log_name, dict(action=log_action, msg=log_msg), log_uuid=log_uuid)
 
-    # record this change in the RemoteAccount.extra_data
-    ra_extra_data.append(
-        dict(
-            datetime=datetime.now(tz=timezone.utc).isoformat(),
-            action="userdata_changed",
+    if changes is not None:
+        changes.add(
+            USER_DATA_CHANGED,
+            identity_id,
+            user_id,
             previous_username=previous_username,
             previous_email=previous_email,
             new_username=new_username,
             new_email=new_email,
         )
-    )
-    return ra_extra_data
 
 
 def _log_identity_id_changed(
     log_uuid,
     log_name,
     log_action,
-    ra_extra_data,
+    changes,
+    user_id,
     username,
     email,
     previous_identity_id,
     new_identity_id,
 ):
-    """Log a warning about Identity Id change."""
+    """Log a warning about Identity Id change.
+
+    :param changes: the UserChanges of the run, where the change is recorded. None
+        when already recorded.
+    """
     log_msg = f"Identity Id changed for User `{username}` `{email}`. Previous UserIdentity.id in the local DB: `{previous_identity_id}` - New Identity Id from CERN DB: `{new_identity_id}`."
     log_warning(log_name, dict(action=log_action, msg=log_msg), log_uuid=log_uuid)
 
-    # record this change in the RemoteAccount.extra_data
-    ra_extra_data.append(
-        dict(
-            datetime=datetime.now(tz=timezone.utc).isoformat(),
-            action="identityId_changed",
+    if changes is not None:
+        changes.add(
+            IDENTITY_ID_CHANGED,
+            new_identity_id,
+            user_id,
             previous_identity_id=previous_identity_id,
             new_identity_id=new_identity_id,
         )
+
+
+def _update_existing_user(
+    invenio_user,
+    lookup,
+    log_uuid,
+    log_name,
+    log_action,
+    user_fingerprint=None,
+    changes=None,
+):
+    """Reconcile one CERN user with the local DB.
+
+    :param user_fingerprint: the hash of the serialized user. When it matches the
+        one stored at the previous sync, the user tables are not compared.
+    :param changes: the UserChanges where the e-mail/username and identity id
+        changes are recorded.
+    :return: a tuple with the local user, None when missing in the DB, and True if
+        any of the user tables was updated, or None if the user is unchanged.
+    """
+    user = user_identity = None
+    is_linked = False
+
+    # Fetch the local user by `identity_id`, the CERN unique id
+    user_identity = lookup.get_identity(invenio_user["user_identity_id"])
+    # Fetch the local user also by email and username, so we can compare
+    user = lookup.get_user(invenio_user["email"], invenio_user["username"])
+    is_missing = not user_identity and not user
+    if is_missing:
+        # The user does not exist in the DB.
+        # The creation of new users is done after all updates completed,
+        # to avoid conflicts in case other `identity_id` have changed.
+        return None, False
+    else:
+        # We start checking first if we found the user by `identity_id`
+        # The assumption is that `identity_id` and `e-mail/username` cannot both
+        # have changed since the previous sync.
+        if user_identity and (not user or user.id != user_identity.id_user):
+            # The `e-mail/username` changed.
+            # The User `e-mail/username` referenced by this `identity_id`
+            # will have to be updated.
+            user = user_identity.user
+            _log_user_data_changed(
+                log_uuid,
+                log_name,
+                log_action,
+                changes=changes,
+                identity_id=invenio_user["user_identity_id"],
+                user_id=user.id,
+                previous_username=user.username,
+                previous_email=user.email,
+                new_username=invenio_user["username"],
+                new_email=invenio_user["email"],
+            )
+        elif user and (not user_identity or user_identity.id_user != user.id):
+            # The `identity_id` changed or it does not exist yet.
+            try:
+                user_identity = lookup.get_identity_by_user(user.id)
+            except NoResultFound:
+                UserIdentity.create(
+                    user,
+                    cern_remote_app_name,
+                    invenio_user["user_identity_id"],
+                )
+                db.session.flush()
+                user_identity = UserIdentity.query.filter_by(id_user=user.id).one()
+
+            _log_identity_id_changed(
+                log_uuid,
+                log_name,
+                log_action,
+                changes=changes,
+                user_id=user.id,
+                username=invenio_user["username"],
+                email=invenio_user["email"],
+                previous_identity_id=user_identity.id,
+                new_identity_id=invenio_user["user_identity_id"],
+            )
+        else:
+            # Both found, make sure that the `identity_id` and the `e-mail/username`
+            # are associated to the same user.
+            assert (
+                user.id == user_identity.id_user
+            ), f"User and UserIdentity are not correctly linked for user #{user.id} and user_identity #{user_identity.id}"
+            is_linked = True
+
+    remote_account = lookup.get_remote_account(user.id)
+    if (
+        is_linked
+        and user_fingerprint
+        and remote_account
+        and remote_account.extra_data.get("fingerprint") == user_fingerprint
+    ):
+        # same CERN data as in the previous sync: nothing to update
+        return user, None
+
+    updated = update_existing_user(
+        user, user_identity, invenio_user, remote_account=remote_account
     )
-    return ra_extra_data
+    if user_fingerprint and remote_account:
+        # stored apart, to not report users as updated only for a new fingerprint
+        remote_account.extra_data["fingerprint"] = user_fingerprint
+    # the e-mail, username or identity id might have changed: keep the lookup in sync
+    lookup.track(user, user_identity)
+    return user, updated
 
 
-def _update_existing(users, serializer_fn, log_uuid, log_name, persist_every=500):
-    """Update existing users in batches and return a list of missing users to insert."""
+def _reconcile_chunk(
+    chunk, lookup, skip_unchanged, log_uuid, log_name, log_action, changes=None
+):
+    """Reconcile a chunk of users with the local DB, without committing.
+
+    :param changes: the UserChanges where the changes of the users are recorded.
+    :return: a tuple with the list of missing users, the set of updated user ids
+        and the number of unchanged users.
+    """
     missing = []
     updated = set()
+    unchanged_count = 0
+    for invenio_user in chunk:
+        user_fingerprint = fingerprint(invenio_user) if skip_unchanged else None
+        user, user_updated = _update_existing_user(
+            invenio_user,
+            lookup,
+            log_uuid,
+            log_name,
+            log_action,
+            user_fingerprint=user_fingerprint,
+            changes=changes,
+        )
+        if not user:
+            if user_fingerprint:
+                extra_data = invenio_user["remote_account_extra_data"]
+                extra_data["fingerprint"] = user_fingerprint
+            missing.append(invenio_user)
+        elif user_updated is None:
+            unchanged_count += 1
+        elif user_updated:
+            updated.add(user.id)
+    return missing, updated, unchanged_count
+
+
+def _add_missing(missing, invenio_users, log_uuid, log_name, metrics):
+    """Add the users to insert to the list or MissingUsersBuffer."""
+    # the buffer returns the users fetched twice, or with a taken username
+    rejected = missing.extend(invenio_users)
+    if rejected:
+        log_warning(
+            log_name,
+            dict(
+                action="updating-existing-users",
+                msg=f"Skipping {len(rejected)} new users with the identity id or username of another new user: {[u['username'] for u in rejected]}",
+            ),
+            log_uuid=log_uuid,
+        )
+        metrics.incr("users_missing_rejected", len(rejected))
+
+
+def _update_existing(
+    users,
+    serializer_fn,
+    log_uuid,
+    log_name,
+    persist_every=500,
+    seen_ids=None,
+    metrics=NULL_METRICS,
+    deferred=None,
+    checkpoint=None,
+    snapshot=None,
+    missing=None,
+):
+    """Update existing users in batches and return the missing users to insert.
+
+    The serialized users are processed in chunks of `persist_every`: when the bulk
+    lookup is enabled, the local users of each chunk are fetched all at once.
+    When `CERN_SYNC_USERS_SKIP_UNCHANGED` is enabled, the users with the same
+    fingerprint as in the previous sync are skipped. The DB objects of each chunk
+    are released from the session before the next one, see `SyncSession`.
+
+    :param seen_ids: when provided, the set is filled with the identity ids of
+        all the fetched users.
+    :param metrics: the SyncMetrics of the run.
+    :param deferred: when provided, the chunks that fail are rolled back and their
+        users added to this list, instead of failing the sync.
+    :param checkpoint: when provided, the SyncCheckpoint saved with each chunk.
+    :param snapshot: when provided, the SnapshotDiff where the users of each
+        committed chunk are added.
+    :param missing: when provided, the MissingUsersBuffer where the missing users
+        are added and returned, instead of a list.
+    """
+    missing = [] if missing is None else missing
+    updated = set()
+    unchanged_count = 0
+    skip_unchanged = current_app.config["CERN_SYNC_USERS_SKIP_UNCHANGED"]
     log_action = "updating-existing-users"
     log_info(log_name, dict(action=log_action, status="started"), log_uuid=log_uuid)
 
-    processed_count = 0
-
-    for invenio_user in serializer_fn(users):
-        user = user_identity = None
-
-        # Fetch the local user by `identity_id`, the CERN unique id
-        user_identity = UserIdentity.query.filter_by(
-            id=invenio_user["user_identity_id"]
-        ).one_or_none()
-        # Fetch the local user also by email and username, so we can compare
-        user = User.query.filter_by(
-            email=invenio_user["email"], username=invenio_user["username"]
-        ).one_or_none()
-        is_missing = not user_identity and not user
-        if is_missing:
-            # The user does not exist in the DB.
-            # The creation of new users is done after all updates completed,
-            # to avoid conflicts in case other `identity_id` have changed.
-            missing.append(invenio_user)
-            continue
-        else:
-            # We start checking first if we found the user by `identity_id`
-            # The assumption is that `identity_id` and `e-mail/username` cannot both
-            # have changed since the previous sync.
-            if user_identity and (not user or user.id != user_identity.id_user):
-                # The `e-mail/username` changed.
-                # The User `e-mail/username` referenced by this `identity_id`
-                # will have to be updated.
-                user = user_identity.user
-                _ra_extra_data = invenio_user["remote_account_extra_data"].get(
-                    "changes", []
+    if current_app.config["CERN_SYNC_USERS_BULK_LOOKUP"]:
+        lookup = BulkLocalUsersLookup()
+    else:
+        lookup = LocalUsersLookup()
+
+    changes = UserChanges(log_uuid=log_uuid)
+    serialized = metrics.timed_iter(serializer_fn(users), "fetch_serialize")
+    sync_session = SyncSession(log_name, log_uuid=log_uuid, metrics=metrics)
+    with sync_session, metrics.phase(log_action) as phase:
+        for chunk in chunked(serialized, persist_every):
+            # the previous chunk is committed or rolled back
+            sync_session.release()
+            if seen_ids is not None:
+                seen_ids.update(str(u["user_identity_id"]) for u in chunk)
+            # users are modified while reconciled: keep them as fetched
+            original_chunk = copy.deepcopy(chunk) if deferred is not None else None
+            try:
+                with metrics.timer("db_lookup_seconds"):
+                    lookup.prefetch(chunk)
+                with metrics.timer("db_reconcile_seconds"):
+                    chunk_missing, chunk_updated, chunk_unchanged = _reconcile_chunk(
+                        chunk,
+                        lookup,
+                        skip_unchanged,
+                        log_uuid,
+                        log_name,
+                        log_action,
+                        changes,
+                    )
+                    changes.flush()
+                if checkpoint:
+                    checkpoint.save(chunk_missing, phase["records"] + len(chunk))
+                # Commit every `persist_every` users
+                with metrics.timer("db_commit_seconds"):
+                    db.session.commit()
+                metrics.incr("db_commits")
+            except Exception as e:
+                if deferred is None:
+                    raise
+                db.session.rollback()
+                changes.clear()
+                log_warning(
+                    log_name,
+                    dict(
+                        action=log_action,
+                        msg=f"Error updating users: {e}. Deferring {len(chunk)} users...",
+                    ),
+                    log_uuid=log_uuid,
+                )
+                deferred.extend(original_chunk)
+                metrics.incr("users_deferred", len(chunk))
+                continue
+
+            if snapshot:
+                missing_ids = {u["user_identity_id"] for u in chunk_missing}
+                snapshot.synced(
+                    u for u in chunk if u["user_identity_id"] not in missing_ids
+                )
+            _add_missing(missing, chunk_missing, log_uuid, log_name, metrics)
+            updated.update(chunk_updated)
+            unchanged_count += chunk_unchanged
+            phase["records"] += len(chunk)
+
+        # Final commit for any remaining uncommitted changes
+        db.session.commit()
+
+    metrics.incr("users_updated", len(updated))
+    metrics.incr("users_unchanged", unchanged_count)
+    log_info(
+        log_name,
+        dict(
+            action=log_action,
+            status="completed",
+            updated_count=len(updated),
+            unchanged_count=unchanged_count,
+        ),
+        log_uuid=log_uuid,
+    )
+    return missing, updated
+
+
+def _with_fingerprint(invenio_user):
+    """Store the fingerprint of the user to insert in its remote account."""
+    user_fingerprint = fingerprint(invenio_user)
+    invenio_user["remote_account_extra_data"]["fingerprint"] = user_fingerprint
+    return invenio_user
+
+
+def _update_existing_staged(
+    users,
+    serializer_fn,
+    log_uuid,
+    log_name,
+    seen_ids=None,
+    metrics=NULL_METRICS,
+    snapshot=None,
+    missing=None,
+):
+    """Update existing users at once, and return the missing users to insert.
+
+    All the serialized users are copied to a staging table, and reconciled with
+    set-based statements, see `invenio_cern_sync.users.staging`, then committed.
+    When they cannot be reconciled at once, e.g. because a local user matches
+    several CERN users or a unique e-mail is taken, they are updated in chunks by
+    `_update_existing` instead. Runs are not checkpointed.
+
+    See `_update_existing` for the params.
+    """
+    missing = [] if missing is None else missing
+    skip_unchanged = current_app.config["CERN_SYNC_USERS_SKIP_UNCHANGED"]
+    log_action = "updating-existing-users"
+    log_info(log_name, dict(action=log_action, status="started"), log_uuid=log_uuid)
+
+    staging = UsersStaging()
+    serialized = metrics.timed_iter(serializer_fn(users), "fetch_serialize")
+    result = None
+    with metrics.phase(log_action) as phase:
+        with metrics.timer("db_stage_seconds"):
+            staging.stage(serialized, skip_unchanged=skip_unchanged, seen_ids=seen_ids)
+        try:
+            with metrics.timer("db_reconcile_seconds"):
+                result = staging.reconcile(
+                    skip_unchanged=skip_unchanged, log_uuid=log_uuid
                 )
-                ra_extra_data = _log_user_data_changed(
+        except (StagingConflict, SQLAlchemyError) as e:
+            log_warning(
+                log_name,
+                dict(
+                    action=log_action,
+                    msg=f"Error reconciling the staged users: {e}. Updating them in chunks...",
+                ),
+                log_uuid=log_uuid,
+            )
+            metrics.incr("db_staging_fallbacks")
+
+        if result:
+            # the changes are recorded by the staging
+            for row in result["user_data_changes"]:
+                _log_user_data_changed(
                     log_uuid,
                     log_name,
                     log_action,
-                    ra_extra_data=_ra_extra_data,
-                    identity_id=invenio_user["user_identity_id"],
-                    previous_username=user.username,
-                    previous_email=user.email,
-                    new_username=invenio_user["username"],
-                    new_email=invenio_user["email"],
-                )
-                invenio_user["remote_account_extra_data"]["changes"] = ra_extra_data
-            elif user and (not user_identity or user_identity.id_user != user.id):
-                # The `identity_id` changed or it does not exist yet.
-                try:
-                    user_identity = UserIdentity.query.filter_by(id_user=user.id).one()
-                except NoResultFound:
-                    UserIdentity.create(
-                        user,
-                        cern_remote_app_name,
-                        invenio_user["user_identity_id"],
-                    )
-                    db.session.flush()
-                    user_identity = UserIdentity.query.filter_by(id_user=user.id).one()
-
-                _ra_extra_data = invenio_user["remote_account_extra_data"].get(
-                    "changes", []
+                    changes=None,
+                    identity_id=row.identity_id,
+                    user_id=row.target_id,
+                    previous_username=row.change["previous_username"],
+                    previous_email=row.change["previous_email"],
+                    new_username=row.change["new_username"],
+                    new_email=row.change["new_email"],
                 )
-                ra_extra_data = _log_identity_id_changed(
+            for row in result["identity_id_changes"]:
+                _log_identity_id_changed(
                     log_uuid,
                     log_name,
                     log_action,
-                    ra_extra_data=_ra_extra_data,
-                    username=invenio_user["username"],
-                    email=invenio_user["email"],
-                    previous_identity_id=user_identity.id,
-                    new_identity_id=invenio_user["user_identity_id"],
+                    changes=None,
+                    user_id=row.target_id,
+                    username=row.username,
+                    email=row.email,
+                    previous_identity_id=row.change["previous_identity_id"],
+                    new_identity_id=row.change["new_identity_id"],
                 )
-                invenio_user["remote_account_extra_data"]["changes"] = ra_extra_data
-            else:
-                # Both found, make sure that the `identity_id` and the `e-mail/username`
-                # are associated to the same user.
-                assert (
-                    user.id == user_identity.id_user
-                ), f"User and UserIdentity are not correctly linked for user #{user.id} and user_identity #{user_identity.id}"
-
-        if update_existing_user(user, user_identity, invenio_user):
-            updated.add(user.id)
 
-        processed_count += 1
-        # Commit every `persist_every` iterations
-        if processed_count % persist_every == 0:
-            db.session.commit()
+            # the staging table is dropped on commit
+            missing_users = staging.iter_missing()
+            if skip_unchanged:
+                missing_users = map(_with_fingerprint, missing_users)
+            _add_missing(missing, missing_users, log_uuid, log_name, metrics)
+            if snapshot:
+                snapshot.synced(staging.iter_reconciled())
+            # let the listeners of the datastore, e.g. the indexers, know what changed
+            session_id = id(db.session)
+            for user_id in result["updated"]:
+                current_db_change_history.add_updated_user(session_id, user_id)
+            with metrics.timer("db_commit_seconds"):
+                db.session.commit()
+            metrics.incr("db_commits")
+            phase["records"] = staging.count
 
-    # Final commit for any remaining uncommitted changes
-    db.session.commit()
+    if not result:
+        return _update_existing(
+            staging.spool(),
+            lambda users: users,
+            log_uuid,
+            log_name,
+            metrics=metrics,
+            snapshot=snapshot,
+            missing=missing,
+        )
 
+    metrics.incr("users_updated", len(result["updated"]))
+    metrics.incr("users_unchanged", result["unchanged"])
+    metrics.incr("users_swapped", result["swapped"])
     log_info(
         log_name,
-        dict(action=log_action, status="completed", updated_count=len(updated)),
+        dict(
+            action=log_action,
+            status="completed",
+            updated_count=len(result["updated"]),
+            unchanged_count=result["unchanged"],
+        ),
         log_uuid=log_uuid,
     )
-    return missing, updated
+    return missing, result["updated"]
 
 
-def _insert_missing(invenio_users, log_uuid, log_name, persist_every=500):
-    """Insert users in batches."""
-    log_action = "inserting-missing-users"
-    log_info(log_name, dict(action=log_action, status="started"), log_uuid=log_uuid)
+def _is_skipped(invenio_user):
+    """Return True if the user should not be created."""
+    if invenio_user["username"].startswith("_"):
+        # Seems that the auth team uses this as a temporal solution for
+        # users that need to be imported in the system after they left CERN
+        current_app.logger.warning(
+            f"Skipping user with username starting with `_`: {invenio_user}"
+        )
+        return True
+    return False
 
-    inserted = set()
-    processed_count = 0
 
+def _insert_one_by_one(invenio_users):
+    """Insert users one by one, each in a savepoint, skipping the failing ones."""
+    inserted = set()
     for invenio_user in invenio_users:
         try:
-            if invenio_user["username"].startswith("_"):
-                # Seems that the auth team uses this as a temporal solution for
-                # users that need to be imported in the system after they left CERN
-                current_app.logger.warning(
-                    f"Skipping user with username starting with `_`: {invenio_user}"
-                )
-                continue
-
             with db.session.begin_nested():
                 _id = create_user(invenio_user)
                 inserted.add(_id)
-
-            processed_count += 1
-
-            # Commit every `persist_every` iterations
-            if processed_count % persist_every == 0:
-                db.session.commit()
-
         except Exception as e:
             current_app.logger.warning(
                 f"Error creating user from CERN data: {e}. Skipping this user... User: {invenio_user}"
             )
             continue
+    return inserted
+
 
-    # Final commit for any remaining uncommitted changes
-    db.session.commit()
+def _insert_missing(
+    invenio_users, log_uuid, log_name, persist_every=500, metrics=NULL_METRICS
+):
+    """Insert users in batches.
+
+    When `CERN_SYNC_USERS_BULK_INSERT` is enabled, each batch is inserted with
+    batched INSERTs. If that fails, only the users of the failed batch are
+    inserted again one by one, skipping the invalid ones.
+    """
+    log_action = "inserting-missing-users"
+    log_info(log_name, dict(action=log_action, status="started"), log_uuid=log_uuid)
+
+    inserted = set()
+    bulk_insert = current_app.config["CERN_SYNC_USERS_BULK_INSERT"]
+    valid_users = (u for u in invenio_users if not _is_skipped(u))
+
+    sync_session = SyncSession(log_name, log_uuid=log_uuid, metrics=metrics)
+    with sync_session, metrics.phase(log_action) as phase:
+        for chunk in chunked(valid_users, persist_every):
+            sync_session.release()
+            with metrics.timer("db_insert_seconds"):
+                if bulk_insert:
+                    try:
+                        with db.session.begin_nested():
+                            inserted.update(create_users(chunk))
+                    except Exception as e:
+                        log_warning(
+                            log_name,
+                            dict(
+                                action=log_action,
+                                msg=f"Error creating users in bulk: {e}. Creating them one by one...",
+                            ),
+                            log_uuid=log_uuid,
+                        )
+                        metrics.incr("db_insert_fallbacks")
+                        inserted.update(_insert_one_by_one(chunk))
+                else:
+                    inserted.update(_insert_one_by_one(chunk))
 
+            # Commit every `persist_every` users
+            with metrics.timer("db_commit_seconds"):
+                db.session.commit()
+            metrics.incr("db_commits")
+            phase["records"] += len(chunk)
+
+    metrics.incr("users_inserted", len(inserted))
     log_info(
         log_name,
         dict(action=log_action, status="completed", inserted_count=len(inserted)),
@@ -229,48 +601,429 @@ def _insert_missing(invenio_users, log_uuid, log_name, persist_every=500):
     return inserted
 
 
-def sync(method="AuthZ", **kwargs):
-    """Sync CERN accounts with local db."""
-    if method not in ["AuthZ", "LDAP"]:
-        raise ValueError(
-            f"Unknown param method {method}. Possible values `AuthZ` or `LDAP`."
-        )
+def _find_departed(seen_ids, batch_size):
+    """Merge-join the local CERN identities with the ids seen in the sync.
 
-    log_uuid = str(uuid.uuid4())
-    log_name = "users-sync"
+    :return: a tuple with the ids of the local users not seen, and the number of
+        local CERN users.
+    """
+    seen = iter(sorted(seen_ids))
+    seen_id = next(seen, None)
+    departed = []
+    local_count = 0
+    for identity_id, user_id in iter_active_identities(batch_size):
+        local_count += 1
+        while seen_id is not None and seen_id < identity_id:
+            seen_id = next(seen, None)
+        if seen_id != identity_id:
+            departed.append(user_id)
+    return departed, local_count
+
+
+def _deactivate_departed(
+    seen_ids, log_uuid, log_name, batch_size=1000, metrics=NULL_METRICS
+):
+    """Deactivate the local CERN users not returned by a full sync.
+
+    Nothing is deactivated when the ratio of the departed users exceeds
+    `CERN_SYNC_USERS_DEPARTED_MAX_RATIO`.
+    """
+    log_action = "deactivating-departed-users"
+    log_info(log_name, dict(action=log_action, status="started"), log_uuid=log_uuid)
+
+    with metrics.phase(log_action) as phase:
+        departed, local_count = _find_departed(seen_ids, batch_size)
+        phase["records"] = local_count
+        max_ratio = current_app.config["CERN_SYNC_USERS_DEPARTED_MAX_RATIO"]
+        if local_count and len(departed) / local_count > max_ratio:
+            log_error(
+                log_name,
+                dict(
+                    action=log_action,
+                    status="aborted",
+                    msg=f"{len(departed)} of {local_count} users would be deactivated, more than the max ratio {max_ratio}.",
+                ),
+                log_uuid=log_uuid,
+            )
+            return set()
+
+        deactivated_count = deactivate_users(departed, batch_size=batch_size)
+        db.session.commit()
+
+    metrics.incr("users_deactivated", deactivated_count)
     log_info(
         log_name,
-        dict(action="fetching-cern-users", status="started", method=method),
+        dict(
+            action=log_action,
+            status="completed",
+            deactivated_count=deactivated_count,
+        ),
         log_uuid=log_uuid,
     )
-    start_time = time.time()
+    return set(departed)
 
-    if method == "AuthZ":
+
+QUERY_PARAMS_KEYS = dict(AuthZ="identities", LDAP="accounts")
+"""Kwarg of `sync`, per method, with the params of the query of the users."""
+
+
+def _get_users(method, metrics, position=None, **kwargs):
+    """Return the iterable of the CERN users to sync, and their serializer.
+
+    :param position: the pagination position, tracked and resumed from by the
+        sequential AuthZ and the LDAP fetching. See `SyncCheckpoint`.
+    """
+    if method == "AuthZ" and current_app.config["CERN_SYNC_AUTHZ_ASYNC"]:
+        overridden_params = kwargs.get("keycloak_service", dict())
+        keycloak_service = AsyncKeycloakService(**overridden_params)
+
+        overridden_params = kwargs.get("authz_service", dict())
+        authz_client = AsyncAuthZService(
+            keycloak_service, metrics=metrics, **overridden_params
+        )
+
+        overridden_params = kwargs.get("identities", dict())
+        users = iter_sync(
+            authz_client.get_identities(**overridden_params),
+            aclose=authz_client.aclose,
+        )
+        return users, serialize_cern_identities
+    elif method == "AuthZ":
         overridden_params = kwargs.get("keycloak_service", dict())
         keycloak_service = KeycloakService(**overridden_params)
 
         overridden_params = kwargs.get("authz_service", dict())
-        authz_client = AuthZService(keycloak_service, **overridden_params)
+        authz_client = AuthZService(
+            keycloak_service, metrics=metrics, **overridden_params
+        )
 
         overridden_params = kwargs.get("identities", dict())
-        users = authz_client.get_identities(**overridden_params)
-        serializer_fn = serialize_cern_identities
+        users = authz_client.get_identities(position=position, **overridden_params)
+        return users, serialize_cern_identities
     elif method == "LDAP":
         overridden_params = kwargs.get("ldap", dict())
-        ldap_client = LdapClient(**overridden_params)
-        users = ldap_client.get_primary_accounts()
-        serializer_fn = serialize_ldap_users
+        ldap_client = LdapClient(metrics=metrics, **overridden_params)
+
+        overridden_params = kwargs.get("accounts", dict())
+        users = ldap_client.iter_primary_accounts(
+            position=position, **overridden_params
+        )
+        return users, serialize_ldap_users
+    raise ValueError(
+        f"Unknown param method {method}. Possible values `AuthZ` or `LDAP`."
+    )
+
+
+def _snapshot_params(method, kwargs):
+    """Return the params of the run identifying its snapshot, without `since`."""
+    key = QUERY_PARAMS_KEYS[method]
+    params = {k: v for k, v in kwargs.get(key, dict()).items() if k != "since"}
+    kwargs = {k: v for k, v in kwargs.items() if k != key}
+    if params:
+        kwargs[key] = params
+    return dict(method=method, **kwargs)
+
+
+def _record_serialization(metrics, pipelined=False):
+    """Split the time spent fetching and serializing users, and count the invalid.
+
+    :param pipelined: True when the users were serialized in the pipeline, while
+        fetched, see `iter_pipelined`.
+    """
+    fetched = metrics.counter("fetch_records")
+    # the users unchanged since the snapshot are serialized, but not yielded
+    serialized = metrics.counter("fetch_serialize_records") + metrics.counter(
+        "snapshot_unchanged"
+    )
+    metrics.incr("skipped_invalid_records", fetched - serialized)
+    if pipelined:
+        # the serialize stage waits for the fetch stage, instead of fetching
+        serialize_seconds = metrics.counter(
+            "pipeline_produce_seconds", stage="serialize"
+        ) - metrics.counter("pipeline_wait_seconds", stage="fetch")
     else:
+        serialize_seconds = metrics.counter(
+            "fetch_serialize_seconds"
+        ) - metrics.counter("fetch_seconds")
+    metrics.incr("serialize_seconds", serialize_seconds)
+
+
+def sync(method="AuthZ", **kwargs):
+    """Sync CERN accounts with local db.
+
+    When `CERN_SYNC_USERS_DEACTIVATE_DEPARTED` is enabled, the local CERN users
+    not returned by a full sync, i.e. without `since` param, are deactivated.
+    When `CERN_SYNC_USERS_CHECKPOINTS` is enabled, a run with the same params as a
+    recently failed one resumes from its last checkpoint.
+    When `CERN_SYNC_SNAPSHOTS_DIR` is set, full syncs only reconcile the users
+    added or changed since the snapshot of the previous full sync, which delta
+    syncs keep up to date.
+    When `CERN_SYNC_USERS_STAGING` is enabled on PostgreSQL, the existing users are
+    reconciled at once via a staging table.
+    When `CERN_SYNC_PIPELINE` is enabled, users are fetched and serialized in
+    background threads while the previous ones are reconciled.
+    The metrics of the run are emitted to the configured sinks at the end.
+    """
+    if method not in ["AuthZ", "LDAP"]:
         raise ValueError(
             f"Unknown param method {method}. Possible values `AuthZ` or `LDAP`."
         )
 
-    missing_invenio_users, updated_ids = _update_existing(
-        users, serializer_fn, log_uuid, log_name
+    log_name = "users-sync"
+    checkpoint = SyncCheckpoint(
+        f"users-{method}", dict(method=method, **kwargs), str(uuid.uuid4())
+    )
+    checkpoint.resume()
+    log_uuid = checkpoint.log_uuid
+    log_info(
+        log_name,
+        dict(action="fetching-cern-users", status="started", method=method),
+        log_uuid=log_uuid,
     )
-    inserted_ids = _insert_missing(missing_invenio_users, log_uuid, log_name)
+    start_time = time.time()
+    metrics = SyncMetrics(log_name, log_uuid=log_uuid)
+    metrics.track_retries(get_retry_policy())
+    snapshot = None
+    missing = MissingUsersBuffer()
+    # users are fetched ahead of the ones committed: the position is not tracked
+    pipelined = current_app.config["CERN_SYNC_PIPELINE"] and not checkpoint.position
+
+    try:
+        users, serializer_fn = _get_users(
+            method,
+            metrics,
+            position=None if pipelined else checkpoint.position,
+            **kwargs,
+        )
+        users = metrics.timed_iter(users, "fetch")
+        if pipelined:
+            # the users are serialized by the pipeline
+            users, serializer_fn = (
+                iter_pipelined(users, serializer_fn, metrics=metrics),
+                lambda users: users,
+            )
+
+        is_full = not kwargs.get(QUERY_PARAMS_KEYS[method], dict()).get("since")
+        deactivate = (
+            is_full and current_app.config["CERN_SYNC_USERS_DEACTIVATE_DEPARTED"]
+        )
+        if deactivate and checkpoint.resumed:
+            # the users fetched before the checkpoint are not known
+            log_warning(
+                log_name,
+                dict(
+                    action="deactivating-departed-users",
+                    status="skipped",
+                    msg="The run resumes from a checkpoint.",
+                ),
+                log_uuid=log_uuid,
+            )
+            deactivate = False
+        seen_ids = set() if deactivate else None
+        # delta runs update the snapshot of the full runs with the same params
+        snapshot = get_snapshot_diff(
+            checkpoint.kind,
+            _snapshot_params(method, kwargs),
+            metrics=metrics,
+            delta=not is_full,
+        )
+        if snapshot:
+            serializer_fn = snapshot.wrap(serializer_fn, seen_ids=seen_ids)
+
+        if is_staging_enabled():
+            _, updated_ids = _update_existing_staged(
+                users,
+                serializer_fn,
+                log_uuid,
+                log_name,
+                seen_ids=seen_ids,
+                metrics=metrics,
+                snapshot=snapshot,
+                missing=missing,
+            )
+        else:
+            _, updated_ids = _update_existing(
+                users,
+                serializer_fn,
+                log_uuid,
+                log_name,
+                seen_ids=seen_ids,
+                metrics=metrics,
+                checkpoint=checkpoint,
+                snapshot=snapshot,
+                missing=missing,
+            )
+        inserted_ids = _insert_missing(
+            itertools.chain(checkpoint.missing, missing),
+            log_uuid,
+            log_name,
+            metrics=metrics,
+        )
+        if deactivate:
+            updated_ids |= _deactivate_departed(
+                seen_ids, log_uuid, log_name, metrics=metrics
+            )
+        metrics.incr("user_changes_pruned", prune_user_changes())
+        checkpoint.delete()
+        db.session.commit()
+        if snapshot:
+            snapshot.commit(log_uuid=log_uuid)
+    except Exception:
+        checkpoint.discard_if_unusable()
+        if snapshot:
+            snapshot.discard()
+        raise
+    finally:
+        missing.close()
+        _record_serialization(metrics, pipelined=pipelined)
+        metrics.gauge("total_seconds", time.time() - start_time)
+        metrics.emit()
 
     total_time = time.time() - start_time
     log_info(log_name, dict(status="completed", time=total_time), log_uuid=log_uuid)
 
     return list(updated_ids.union(inserted_ids))
+
+
+###################################################################################
+# Sharded sync
+
+
+def get_shards(method="AuthZ"):
+    """Return the disjoint filters of the users of each shard of the given method.
+
+    Defaults to `PERSON_ID_SHARDS` for AuthZ and to `CN_PARTITIONS` for LDAP, see
+    `CERN_SYNC_USERS_SHARDS`.
+    """
+    if method not in ["AuthZ", "LDAP"]:
+        raise ValueError(
+            f"Unknown param method {method}. Possible values `AuthZ` or `LDAP`."
+        )
+    shards = current_app.config["CERN_SYNC_USERS_SHARDS"] or dict()
+    defaults = dict(AuthZ=PERSON_ID_SHARDS, LDAP=CN_PARTITIONS)
+    return shards.get(method) or defaults[method]
+
+
+def _shard_kwargs(method, shard, kwargs):
+    """Return the kwargs of `sync`, with the query restricted to the given shard.
+
+    :param shard: a list of AuthZ filters, or an LDAP filter.
+    """
+    key = QUERY_PARAMS_KEYS[method]
+    params = dict(kwargs.get(key, dict()))
+    if method == "AuthZ":
+        params["filters"] = list(params.get("filters", [])) + list(shard)
+    else:
+        params["filter"] = f"(&{params.get('filter', PRIMARY_ACCOUNTS_FILTER)}{shard})"
+    return {**kwargs, key: params}
+
+
+def _iter_in_shard(identities, shard):
+    """Yield the AuthZ identities, checking that they match the shard filters.
+
+    :raises ValueError: when an identity is not in the shard, e.g. because AuthZ
+        did not apply the filters: the shards would not be disjoint.
+    """
+    for identity in identities:
+        if not in_shard(identity, shard):
+            raise ValueError(
+                f"Identity {identity.get('personId')} does not match the shard "
+                f"filters {shard}."
+            )
+        yield identity
+
+
+def sync_shard(method, shard, log_uuid=None, collect_seen=False, part=None, **kwargs):
+    """Fetch the CERN users of a shard and update the existing ones.
+
+    Each shard fetches its own users, filtered at the source, so that they are
+    streamed as in `sync` instead of being passed around.
+    The users are not inserted: a new user could take the e-mail or username
+    freed by a user of another shard, not updated yet. For the same reason, the
+    chunks that fail are not retried here, but returned to be synced once all the
+    shards completed.
+
+    :param shard: the filters of the users of the shard, see `get_shards`.
+    :param collect_seen: True to return the identity ids of all the fetched users,
+        e.g. to deactivate the departed ones.
+    :param part: the name of the shard in the metrics, e.g. `shard-3`.
+    :param kwargs: the params of the query of the users, as for `sync`.
+    :return: a dict with the `updated` user ids, the `missing` users to insert,
+        the `deferred` users and the `seen` identity ids.
+    """
+    if method not in ["AuthZ", "LDAP"]:
+        raise ValueError(
+            f"Unknown param method {method}. Possible values `AuthZ` or `LDAP`."
+        )
+
+    log_name = "users-sync"
+    metrics = SyncMetrics(log_name, log_uuid=log_uuid, part=part)
+    metrics.track_retries(get_retry_policy())
+    seen_ids = set() if collect_seen else None
+    deferred = []
+    try:
+        users, serializer_fn = _get_users(
+            method, metrics, **_shard_kwargs(method, shard, kwargs)
+        )
+        if method == "AuthZ":
+            users = _iter_in_shard(users, shard)
+        missing, updated = _update_existing(
+            metrics.timed_iter(users, "fetch"),
+            serializer_fn,
+            log_uuid,
+            log_name,
+            seen_ids=seen_ids,
+            metrics=metrics,
+            deferred=deferred,
+        )
+    finally:
+        metrics.emit()
+    return dict(
+        updated=list(updated),
+        missing=missing,
+        deferred=deferred,
+        seen=list(seen_ids or []),
+    )
+
+
+def merge_shards(results, log_uuid=None, deactivate=False):
+    """Aggregate the results of `sync_shard`, and complete the sync.
+
+    The deferred users, e.g. swapping their e-mails across shards, are updated
+    again, one chunk after the other. Then, the missing users are inserted and,
+    when `deactivate` is True, the departed users deactivated.
+
+    :return: the list of the updated and inserted user ids.
+    """
+    log_name = "users-sync"
+    metrics = SyncMetrics(log_name, log_uuid=log_uuid, part="merge")
+    updated_ids, missing, deferred, seen_ids = set(), [], [], set()
+    for result in results:
+        updated_ids.update(result["updated"])
+        missing.extend(result["missing"])
+        deferred.extend(result["deferred"])
+        seen_ids.update(result["seen"])
+
+    try:
+        if deferred:
+            deferred_missing, deferred_updated = _update_existing(
+                deferred, lambda users: users, log_uuid, log_name, metrics=metrics
+            )
+            missing.extend(deferred_missing)
+            updated_ids.update(deferred_updated)
+        inserted_ids = _insert_missing(missing, log_uuid, log_name, metrics=metrics)
+        if deactivate:
+            updated_ids |= _deactivate_departed(
+                seen_ids, log_uuid, log_name, metrics=metrics
+            )
+        metrics.incr("user_changes_pruned", prune_user_changes())
+        db.session.commit()
+    finally:
+        metrics.emit()
+
+    log_info(
+        log_name,
+        dict(status="completed", shards=len(results), deferred_count=len(deferred)),
+        log_uuid=log_uuid,
+    )
+    return list(updated_ids.union(inserted_ids))
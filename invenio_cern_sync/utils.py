@@ -7,6 +7,10 @@
 
 """Invenio-CERN-sync utils."""
 
+import hashlib
+import json
+from itertools import islice
+
 
 def first_or_raise(d, key):
     """Return the decoded first value of the given key or raise."""
@@ -15,9 +19,13 @@ def first_or_raise(d, key):
 
 def first_or_default(d, key, default=""):
     """Return the decoded first value of the given key or return default."""
+    # optional LDAP attributes are often missing: avoid raising in that case
+    values = d.get(key)
+    if not values:
+        return default
     try:
-        return d[key][0].decode("utf8")
-    except (KeyError, IndexError, AttributeError):
+        return values[0].decode("utf8")
+    except AttributeError:
         return default
 
 
@@ -26,3 +34,19 @@ def is_different(new_dict, existing_dict):
     for key, value in new_dict.items():
         if key not in existing_dict or existing_dict[key] != value:
             return True
+
+
+def chunked(iterable, size):
+    """Yield lists of at most `size` elements from the given iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def fingerprint(data):
+    """Return a stable hash of the given JSON serializable dict."""
+    serialized = json.dumps(data, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(serialized.encode("utf8")).hexdigest()
@@ -11,6 +11,8 @@ import pytest
 from invenio_app.factory import create_app as _create_app
 from marshmallow import Schema, fields
 
+from invenio_cern_sync.locks import CacheSyncLock
+
 
 class CustomProfile(Schema):
     """A custom user profile schema that matches the default mapper."""
@@ -42,6 +44,12 @@ def app_config(
     app_config["CERN_APP_CREDENTIALS"] = {"consumer_key": client_id}
     app_config["ACCOUNTS_USER_PROFILE_SCHEMA"] = CustomProfile()
     app_config["THEME_FRONTPAGE"] = False
+    app_config["CACHE_TYPE"] = "SimpleCache"
+    if app_config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        # the default DB lock writes in its own transactions, which SQLite blocks
+        # while the test session holds its outer transaction: see
+        # `tests/test_locks.py` for the tests of the DB lock on SQLite
+        app_config["CERN_SYNC_LOCK"] = CacheSyncLock
     return app_config
 
 
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Alembic migrations tests, on PostgreSQL only."""
+
+import importlib.util
+from pathlib import Path
+
+import pytest
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from sqlalchemy import MetaData, create_engine
+from sqlalchemy_utils.functions import create_database, drop_database
+
+import invenio_cern_sync
+from invenio_cern_sync.models import (
+    CERNSyncCheckpoint,
+    CERNSyncLock,
+    CERNSyncState,
+    CERNSyncUserChange,
+)
+
+MODELS = [CERNSyncState, CERNSyncLock, CERNSyncCheckpoint, CERNSyncUserChange]
+
+
+def _revisions():
+    """Return the migration modules of the package, in order."""
+    modules = dict()
+    for path in (Path(invenio_cern_sync.__file__).parent / "alembic").glob(
+        "[0-9a-f]*_*.py"
+    ):
+        spec = importlib.util.spec_from_file_location(path.stem, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        modules[module.down_revision] = module
+    revisions = []
+    module = next(m for m in modules.values() if m.branch_labels)
+    while module:
+        revisions.append(module)
+        module = modules.get(module.revision)
+    return revisions
+
+
+@pytest.fixture()
+def empty_engine(database):
+    """Engine of an empty database, next to the test one."""
+    if database.engine.name != "postgresql":
+        pytest.skip("The column types are not reflected on other databases.")
+    url = database.engine.url.set(database=f"{database.engine.url.database}_alembic")
+    create_database(url)
+    engine = create_engine(url)
+    yield engine
+    engine.dispose()
+    drop_database(url)
+
+
+def test_migrations_same_as_models(empty_engine):
+    """Test that the migrations create the tables as declared by the models."""
+    revisions = _revisions()
+    assert len(revisions) == 5
+    metadata = MetaData(naming_convention=CERNSyncState.metadata.naming_convention)
+    for model in MODELS:
+        model.__table__.to_metadata(metadata)
+
+    with empty_engine.begin() as connection:
+        context = MigrationContext.configure(connection)
+        with Operations.context(context):
+            for revision in revisions:
+                revision.upgrade()
+        context = MigrationContext.configure(
+            connection,
+            opts=dict(
+                compare_type=True,
+                include_name=lambda name, type_, parent: (
+                    type_ != "table" or name in metadata.tables
+                ),
+            ),
+        )
+        assert compare_metadata(context, metadata) == []
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Asyncio AuthZ client tests."""
+
+import time
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from invenio_cern_sync.authz.aio import (
+    AsyncAuthZService,
+    AsyncKeycloakService,
+    iter_sync,
+)
+from invenio_cern_sync.authz.client import PERSON_ID_SHARDS, clear_tokens_cache
+from invenio_cern_sync.errors import RequestError
+from invenio_cern_sync.users.sync import sync
+
+httpx = pytest.importorskip("httpx")
+
+
+@pytest.fixture()
+def authz_server(cern_identities):
+    """Fake Keycloak and AuthZ endpoints, paginating identities one by one."""
+    clear_tokens_cache()
+    calls = dict(token=0, identity=0, unauthorized=0)
+
+    def _handler(request):
+        if request.url.path.endswith("/token"):
+            calls["token"] += 1
+            token = f"token-{calls['token']}"
+            return httpx.Response(200, json={"access_token": token, "expires_in": 300})
+
+        token = request.headers["Authorization"].removeprefix("Bearer ")
+        if calls.get("revoked") in (token, "*"):
+            calls["unauthorized"] += 1
+            return httpx.Response(401)
+
+        calls["identity"] += 1
+        query = parse_qs(urlparse(str(request.url)).query)
+        identities = cern_identities
+        shard_filter = [f for f in query["filter"] if f.startswith("personId")]
+        if shard_filter:
+            digit = shard_filter[0][-1]
+            identities = [i for i in identities if i["personId"].endswith(digit)]
+        page = int(query.get("token", ["0"])[0])
+        next_page = page + 1 if page + 1 < len(identities) else None
+        return httpx.Response(
+            200,
+            json={
+                "data": identities[page : page + 1],
+                "pagination": {"token": str(next_page) if next_page else None},
+            },
+        )
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(_handler))
+    with patch(
+        "invenio_cern_sync.authz.aio.create_async_http_client", return_value=client
+    ):
+        yield calls
+
+
+def _authz_service():
+    """Return a new async AuthZ service."""
+    keycloak_service = AsyncKeycloakService(
+        base_url="https://keycloak.test", client_id="id", client_secret="secret"
+    )
+    return AsyncAuthZService(keycloak_service, base_url="https://authz.test")
+
+
+def test_get_identities(app, authz_server, cern_identities):
+    """Test that identities are fetched page by page, with one token."""
+    authz_service = _authz_service()
+    identities = list(
+        iter_sync(authz_service.get_identities(), aclose=authz_service.aclose)
+    )
+
+    assert identities == cern_identities
+    assert authz_server["identity"] == len(cern_identities)
+    assert authz_server["token"] == 1
+    assert authz_service.client.is_closed
+
+
+def test_iter_sync_prefetched(app, authz_server, cern_identities):
+    """Test that identities are fetched ahead, while the consumer is busy."""
+    authz_service = _authz_service()
+    identities = iter_sync(
+        authz_service.get_identities(), aclose=authz_service.aclose, queue_size=3
+    )
+
+    assert next(identities) == cern_identities[0]
+    # while the consumer is idle, 3 are queued and 1 more waits for the queue
+    deadline = time.monotonic() + 5
+    while authz_server["identity"] < 5 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    assert authz_server["identity"] == 5 < len(cern_identities)
+
+    # stopping the iteration stops the fetching, and closes the clients
+    identities.close()
+    assert authz_server["identity"] == 5
+    assert authz_service.client.is_closed
+
+
+def test_get_identities_concurrently(app, authz_server, cern_identities):
+    """Test that shards are fetched concurrently, and all identities returned."""
+    authz_service = _authz_service()
+    identities = list(
+        iter_sync(
+            authz_service.get_identities(shards=PERSON_ID_SHARDS),
+            aclose=authz_service.aclose,
+        )
+    )
+
+    assert sorted(i["personId"] for i in identities) == sorted(
+        i["personId"] for i in cern_identities
+    )
+    assert authz_server["token"] == 1
+
+
+def test_get_identities_token_refresh(app, authz_server, cern_identities):
+    """Test that a rejected token is refreshed and the request replayed."""
+    authz_service = _authz_service()
+    # the first token is rejected once issued
+    authz_server["revoked"] = "token-1"
+    identities = iter_sync(authz_service.get_identities(), aclose=authz_service.aclose)
+
+    assert list(identities) == cern_identities
+    assert authz_server["unauthorized"] == 1
+    assert authz_server["token"] == 2
+
+
+def test_get_identities_error(app, authz_server):
+    """Test that errors are raised to the synchronous consumer."""
+    authz_server["revoked"] = "*"
+    authz_service = _authz_service()
+
+    with pytest.raises(RequestError) as exc_info:
+        list(iter_sync(authz_service.get_identities(), aclose=authz_service.aclose))
+    assert exc_info.value.status_code == 401
+
+
+def test_sync_users_async(app, authz_server, cern_identities, db, monkeypatch):
+    """Test the users sync with the async client."""
+    monkeypatch.setitem(app.config, "CERN_SYNC_AUTHZ_ASYNC", True)
+
+    results = sync(
+        method="AuthZ",
+        keycloak_service=dict(base_url="https://keycloak.test", client_secret="secret"),
+        authz_service=dict(base_url="https://authz.test", max_concurrency=2),
+    )
+
+    assert len(results) == len(cern_identities)
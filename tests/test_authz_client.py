@@ -8,10 +8,22 @@
 """Invenio-CERN-sync test AuthZ client."""
 
 from unittest.mock import MagicMock, patch
+from urllib.parse import parse_qs, urlparse
 
 import pytest
+import requests
 
-from invenio_cern_sync.authz.client import AuthZService, KeycloakService
+from invenio_cern_sync.authz.client import (
+    PERSON_ID_SHARDS,
+    AuthZService,
+    HTTPSession,
+    KeycloakService,
+    clear_tokens_cache,
+    create_http_session,
+    in_shard,
+    request_with_retries,
+)
+from invenio_cern_sync.errors import RequestError
 
 
 @pytest.fixture
@@ -30,6 +42,12 @@ def app_with_extra_config(app):
     yield app
 
 
+@pytest.fixture(autouse=True)
+def tokens_cache():
+    """Clear the Keycloak tokens cache before each test."""
+    clear_tokens_cache()
+
+
 @pytest.fixture
 def mock_keycloak_service():
     """Mock Keycloak service."""
@@ -64,6 +82,7 @@ def test_get_authz_token(app_with_extra_config, mock_request_with_retries):
             "client_secret": "test-client-secret",
             "audience": "authorization-service-api",
         },
+        session=keycloak_service.session,
     )
 
 
@@ -167,6 +186,7 @@ def test_fetch_all_pagination(
             url=expected_url,
             method="GET",
             headers=headers,
+            session=authz_service.session,
         )
 
     for i in range(total):
@@ -207,3 +227,159 @@ def test_get_groups_empty(
 
     assert len(groups) == 0
     mock_request_with_retries.assert_called()
+
+
+def test_http_session(app_with_extra_config):
+    """Test that the Keycloak and AuthZ services share a pooled session."""
+    app_with_extra_config.config.update(
+        {"CERN_SYNC_HTTP_POOL_SIZE": 4, "CERN_SYNC_HTTP_TIMEOUT": 12}
+    )
+    keycloak_service = KeycloakService()
+    authz_service = AuthZService(keycloak_service)
+    session = keycloak_service.session
+
+    assert isinstance(session, HTTPSession)
+    assert authz_service.session is session
+    assert session.timeout == 12
+    adapter = session.get_adapter("https://authz.test")
+    assert adapter._pool_maxsize == 4
+    assert session.headers["Connection"] == "keep-alive"
+
+    session = create_http_session(keep_alive=False, timeout=(1, 2))
+    assert session.headers["Connection"] == "close"
+    assert session.timeout == (1, 2)
+
+
+def test_request_with_retries_session(app_with_extra_config):
+    """Test that requests are made with the given session."""
+    session = MagicMock()
+    response = request_with_retries(
+        url="https://authz.test/api", method="GET", headers={}, session=session
+    )
+
+    assert response == session.get.return_value
+    session.get.assert_called_once_with("https://authz.test/api", headers={})
+
+
+def test_person_id_shards():
+    """Test that each numeric person id is in exactly one of the shards."""
+    for person_id in ["0", "7", "10", "12345", "99999", "100000"]:
+        identity = dict(personId=person_id, type="Person")
+        shards = [shard for shard in PERSON_ID_SHARDS if in_shard(identity, shard)]
+        assert shards == [[f"personId:endswith:{person_id[-1]}"]]
+    # the other filters are not checked
+    assert in_shard(dict(personId="12"), ["type:Person", "personId:endswith:2"])
+    assert not in_shard(dict(), ["personId:endswith:2"])
+
+
+def _mock_sharded_responses(cern_identities):
+    """Return a side effect for requests, paginating identities by shard."""
+
+    def _request(url, **kwargs):
+        digit = parse_qs(urlparse(url).query)["filter"][-1][-1]
+        shard = [i for i in cern_identities if i["personId"].endswith(digit)]
+        page = 1 if "token=" in url else 0
+        mock_response = MagicMock()
+        mock_response.json.return_value = {
+            "data": shard[page : page + 1],
+            "pagination": {"token": "next-token" if len(shard) > page + 1 else None},
+        }
+        return mock_response
+
+    return _request
+
+
+def test_get_identities_concurrently(
+    app_with_extra_config,
+    cern_identities,
+    mock_keycloak_service,
+    mock_request_with_retries,
+):
+    """Test fetching identities in parallel shards."""
+    # two identities in the shard `0`, to test the pagination of each shard
+    cern_identities.append({**cern_identities[0], "personId": "99990", "upn": "x"})
+    mock_request_with_retries.side_effect = _mock_sharded_responses(cern_identities)
+
+    authz_service = AuthZService(mock_keycloak_service, limit=1, max_threads=3)
+    identities = list(authz_service.get_identities(shards=PERSON_ID_SHARDS))
+
+    assert sorted(i["upn"] for i in identities) == sorted(
+        i["upn"] for i in cern_identities
+    )
+    # 2 pages for the shard `0`, 1 page for each of the other shards
+    assert mock_request_with_retries.call_count == len(PERSON_ID_SHARDS) + 1
+
+
+def test_get_identities_concurrently_error(
+    app_with_extra_config,
+    mock_keycloak_service,
+    mock_request_with_retries,
+):
+    """Test that errors in one of the shards are raised to the consumer."""
+    mock_request_with_retries.side_effect = RequestError("url", "error")
+
+    authz_service = AuthZService(mock_keycloak_service, limit=1, max_threads=3)
+    with pytest.raises(RequestError):
+        list(authz_service.get_identities(shards=PERSON_ID_SHARDS))
+
+
+@patch("invenio_cern_sync.authz.client.time.time")
+def test_get_authz_token_cached(
+    mock_time, app_with_extra_config, mock_request_with_retries
+):
+    """Test that the token is cached until it is about to expire."""
+    mock_time.return_value = 1000
+    mock_response = MagicMock()
+    mock_response.json.return_value = {"access_token": "token-1", "expires_in": 300}
+    mock_request_with_retries.return_value = mock_response
+
+    assert KeycloakService().get_authz_token() == "token-1"
+    # another instance with the same client id reuses the token
+    assert KeycloakService().get_authz_token() == "token-1"
+    assert mock_request_with_retries.call_count == 1
+
+    # the token is refreshed before its expiration, minus the leeway
+    mock_time.return_value = 1000 + 300 - 60
+    mock_response.json.return_value = {"access_token": "token-2", "expires_in": 300}
+    assert KeycloakService().get_authz_token() == "token-2"
+    assert mock_request_with_retries.call_count == 2
+
+
+def test_fetch_all_token_refresh(
+    app_with_extra_config, cern_identities, mock_request_with_retries
+):
+    """Test that the token is refreshed and the page replayed on 401."""
+    keycloak_service = MagicMock()
+    keycloak_service.get_authz_token.side_effect = lambda force_refresh=False: (
+        "new-token" if force_refresh else "old-token"
+    )
+    mock_response = MagicMock()
+    mock_response.json.return_value = {"data": [cern_identities[0]]}
+    mock_request_with_retries.side_effect = [
+        RequestError("url", "Unauthorized", status_code=401),
+        mock_response,
+    ]
+
+    authz_service = AuthZService(keycloak_service, limit=1)
+    url = "https://authz.test/api/v1.0/Identity?filter=type:Person"
+    results = list(authz_service._fetch_all(url, {"accept": "application/json"}))
+
+    assert len(results) == 1
+    assert mock_request_with_retries.call_args_list[-1].kwargs["headers"] == {
+        "accept": "application/json",
+        "Authorization": "Bearer new-token",
+    }
+    keycloak_service.get_authz_token.assert_called_with(force_refresh=True)
+
+
+def test_request_with_retries_unauthorized(app_with_extra_config):
+    """Test that 401 responses are not retried."""
+    session = MagicMock()
+    error = requests.exceptions.HTTPError(response=MagicMock(status_code=401))
+    session.get.return_value.raise_for_status.side_effect = error
+
+    with pytest.raises(RequestError) as exc_info:
+        request_with_retries(url="https://authz.test/api", session=session)
+
+    assert exc_info.value.status_code == 401
+    assert session.get.call_count == 1
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it under
+# the terms of the MIT License; see LICENSE file for more details.
+
+"""Invenio-CERN-sync test retry policy."""
+
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+
+from invenio_cern_sync.authz.client import request_with_retries
+from invenio_cern_sync.authz.retry import RetryPolicy
+from invenio_cern_sync.errors import CircuitOpenError, RequestError
+
+URL = "https://authz.test/api/v1.0/Identity"
+
+
+def _error_response(status_code, headers=None):
+    """Return a mocked response failing with the given status."""
+    response = MagicMock(status_code=status_code, headers=headers or {})
+    response.raise_for_status.side_effect = requests.exceptions.HTTPError(
+        response=response
+    )
+    return response
+
+
+@pytest.fixture
+def policy(app):
+    """Retry policy without real sleeps."""
+    policy = RetryPolicy(
+        max_attempts=3,
+        backoff=2,
+        max_backoff=30,
+        failure_threshold=3,
+        reset_timeout=60,
+    )
+    with patch("invenio_cern_sync.authz.retry.time.sleep"):
+        yield policy
+
+
+def test_get_delay(policy):
+    """Test exponential backoff with jitter."""
+    for attempt in range(6):
+        expected = min(2 * 2**attempt, 30)
+        delay = policy.get_delay(attempt)
+        assert expected / 2 <= delay <= expected
+
+
+def test_get_delay_retry_after(policy):
+    """Test that Retry-After is honored on 429 and 503."""
+    assert policy.get_delay(0, _error_response(429, {"Retry-After": "7"})) == 7
+    assert policy.get_delay(0, _error_response(503, {"Retry-After": "120"})) == 30
+    assert policy.get_delay(0, _error_response(500, {"Retry-After": "7"})) <= 2
+
+
+def test_retry_on_server_errors(policy):
+    """Test that server errors are retried, and the retries counted."""
+    session = MagicMock()
+    session.get.side_effect = [_error_response(503), _error_response(502), MagicMock()]
+
+    request_with_retries(url=URL, session=session, policy=policy)
+
+    assert session.get.call_count == 3
+    assert policy.stats["retries"] == 2
+    assert policy.stats["sleep_time"] > 0
+
+
+def test_fail_fast_on_client_errors(policy):
+    """Test that non-retryable statuses fail immediately."""
+    session = MagicMock()
+    session.get.return_value = _error_response(404)
+
+    with pytest.raises(RequestError) as exc_info:
+        request_with_retries(url=URL, session=session, policy=policy)
+
+    assert exc_info.value.status_code == 404
+    assert session.get.call_count == 1
+    assert policy.stats["retries"] == 0
+
+
+@patch("invenio_cern_sync.authz.retry.time.monotonic")
+def test_circuit_breaker(mock_monotonic, policy):
+    """Test that the circuit opens after consecutive failures."""
+    mock_monotonic.return_value = 1000
+    session = MagicMock()
+    session.get.side_effect = requests.exceptions.ConnectionError()
+
+    with pytest.raises(RequestError):
+        request_with_retries(url=URL, session=session, policy=policy)
+    assert session.get.call_count == 3
+
+    # the circuit is open: requests to the same endpoint are not sent
+    with pytest.raises(CircuitOpenError):
+        request_with_retries(url=f"{URL}?limit=10", session=session, policy=policy)
+    assert session.get.call_count == 3
+    # other endpoints are not affected
+    session.get.side_effect = None
+    request_with_retries(url="https://authz.test/api/v1.0/Group", session=session)
+
+    # after the timeout, one request is let through and closes the circuit
+    mock_monotonic.return_value = 1000 + 60
+    request_with_retries(url=URL, session=session, policy=policy)
+    request_with_retries(url=URL, session=session, policy=policy)
+    assert session.get.call_count == 6
+
+
+@patch("invenio_cern_sync.authz.retry.time.monotonic")
+def test_circuit_breaker_half_open(mock_monotonic, policy):
+    """Test that a single probe is let through the half-open circuit."""
+    mock_monotonic.return_value = 1000
+    for _ in range(3):
+        policy.record_failure(URL)
+    assert policy.is_open(URL)
+
+    mock_monotonic.return_value = 1000 + 60
+    assert not policy.is_open(URL)
+    # the other requests are rejected while the probe is in flight
+    assert policy.is_open(URL)
+    assert policy.is_open(f"{URL}?limit=10")
+
+    # the probe fails: the circuit opens again for the reset timeout
+    policy.record_failure(URL)
+    mock_monotonic.return_value = 1000 + 60 + 59
+    assert policy.is_open(URL)
+    mock_monotonic.return_value = 1000 + 60 + 60
+    assert not policy.is_open(URL)
+    assert policy.is_open(URL)
+
+    # the probe succeeds: the circuit closes
+    policy.record_success(URL)
+    assert not policy.is_open(URL)
+    assert not policy.is_open(URL)
+    # and opens again only after the threshold
+    policy.record_failure(URL)
+    assert not policy.is_open(URL)
+
+
+@patch("invenio_cern_sync.authz.retry.time.monotonic")
+def test_circuit_breaker_probe_lost(mock_monotonic, policy):
+    """Test that another probe is let through if the first one is not recorded."""
+    mock_monotonic.return_value = 1000
+    for _ in range(3):
+        policy.record_failure(URL)
+
+    mock_monotonic.return_value = 1000 + 60
+    assert not policy.is_open(URL)
+    mock_monotonic.return_value = 1000 + 60 + 59
+    assert policy.is_open(URL)
+    mock_monotonic.return_value = 1000 + 60 + 60
+    assert not policy.is_open(URL)
+    assert policy.is_open(URL)
+
+    # the probe fails with a non-retryable status: the endpoint is available
+    policy.record_failure(URL, 404)
+    assert not policy.is_open(URL)
+    assert not policy.is_open(URL)
+
+
+@patch("invenio_cern_sync.authz.retry.time.monotonic")
+def test_circuit_breaker_probe_request(mock_monotonic, policy):
+    """Test that a failed probe request is not retried."""
+    mock_monotonic.return_value = 1000
+    session = MagicMock()
+    session.get.side_effect = requests.exceptions.ConnectionError()
+    with pytest.raises(RequestError):
+        request_with_retries(url=URL, session=session, policy=policy)
+    assert session.get.call_count == 3
+
+    mock_monotonic.return_value = 1000 + 60
+    with pytest.raises(CircuitOpenError):
+        request_with_retries(url=URL, session=session, policy=policy)
+    assert session.get.call_count == 4
+    with pytest.raises(CircuitOpenError):
+        request_with_retries(url=URL, session=session, policy=policy)
+    assert session.get.call_count == 4
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Benchmark fakes tests."""
+
+from unittest.mock import patch
+
+from benchmarks.fakes import (
+    Dataset,
+    FakeCERNServer,
+    FakeLdapConnection,
+    fake_ldap_module,
+)
+from invenio_cern_sync.authz.client import (
+    PERSON_ID_SHARDS,
+    AuthZService,
+    KeycloakService,
+    clear_tokens_cache,
+)
+from invenio_cern_sync.ldap.client import LdapClient
+
+
+def test_fake_cern_server(app):
+    """Test that the fake AuthZ service paginates all the records."""
+    clear_tokens_cache()
+    dataset = Dataset(25)
+    with FakeCERNServer(dataset) as server:
+        keycloak_service = KeycloakService(base_url=server.url, client_secret="s")
+        authz_service = AuthZService(keycloak_service, base_url=server.url, limit=10)
+
+        identities = list(authz_service.get_identities())
+        assert identities == [dataset.identity(i) for i in range(25)]
+        sharded = list(authz_service.get_identities(shards=PERSON_ID_SHARDS))
+        assert sorted(sharded, key=lambda i: i["personId"]) == identities
+        assert len(list(authz_service.get_groups())) == 25
+        assert server.stats["token"] == 1
+
+
+def test_fake_ldap(app):
+    """Test that the fake LDAP backend paginates all the entries."""
+    dataset = Dataset(25, churn=0.2, revision=1)
+    connection = FakeLdapConnection(dataset)
+    with patch("invenio_cern_sync.ldap.client.ldap", fake_ldap_module(connection)):
+        client = LdapClient(ldap_url="ldap://fake")
+        entries = client.get_primary_accounts(page_size=10)
+
+    assert entries == [dataset.ldap_user(i) for i in range(25)]
+    assert connection.stats["pages"] == 3
+    assert entries[0]["displayName"] == [b"User 0 rev1"]
+    assert entries[-1]["displayName"] == [b"User 24 rev0"]
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Sync checkpoints tests."""
+
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from unittest.mock import MagicMock, patch
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from invenio_accounts.models import User
+from sqlalchemy import update
+
+from invenio_cern_sync.authz.client import AuthZService
+from invenio_cern_sync.checkpoints import get_resumed_started_at
+from invenio_cern_sync.errors import RequestError
+from invenio_cern_sync.models import CERNSyncCheckpoint
+from invenio_cern_sync.users.sync import _update_existing, sync
+
+
+def _fake_request(identities, limit, fail_at=None):
+    """Return a fake `AuthZService._request`, serving pages of the identities."""
+    requested = []
+
+    def _request(self, url, headers):
+        offset = int(parse_qs(urlparse(url).query).get("token", ["0"])[-1])
+        requested.append(offset)
+        if offset == fail_at:
+            raise RequestError(url, "AuthZ is down")
+        next_offset = offset + limit
+        token = str(next_offset) if next_offset < len(identities) else None
+        response = MagicMock()
+        response.json.return_value = {
+            "data": identities[offset:next_offset],
+            "pagination": {"token": token},
+        }
+        return response
+
+    return _request, requested
+
+
+@pytest.fixture()
+def small_chunks():
+    """Commit every 3 users."""
+    update_existing = partial(_update_existing, persist_every=3)
+    with patch("invenio_cern_sync.users.sync._update_existing", update_existing):
+        yield
+
+
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+def test_sync_resumes_from_checkpoint(
+    MockKeycloakService, app, cern_identities, db, small_chunks
+):
+    """Test that a failed sync is resumed from the last committed chunk."""
+    fake_request, requested = _fake_request(cern_identities, limit=4, fail_at=8)
+    params = dict(authz_service=dict(limit=4))
+    with patch.object(AuthZService, "_request", fake_request):
+        with pytest.raises(RequestError):
+            sync(**params)
+    assert requested == [0, 4, 8]
+
+    # 2 chunks of 3 users committed, the last one from the 2nd page
+    checkpoint = db.session.get(CERNSyncCheckpoint, "users-AuthZ")
+    assert checkpoint.position == dict(token="4", offset=2)
+    assert checkpoint.processed == 6
+    assert len(checkpoint.missing) == 6
+    assert User.query.count() == 0
+    assert get_resumed_started_at("users-AuthZ") == checkpoint.started_at
+
+    fake_request, requested = _fake_request(cern_identities, limit=4)
+    with patch.object(AuthZService, "_request", fake_request):
+        ids = sync(**params)
+    assert requested == [4, 8]
+    assert len(ids) == len(cern_identities)
+    assert User.query.count() == len(cern_identities)
+    assert not db.session.get(CERNSyncCheckpoint, "users-AuthZ")
+
+
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+def test_sync_checkpoint_not_resumed(
+    MockKeycloakService, app, cern_identities, db, small_chunks
+):
+    """Test that the checkpoints of other params or too old are not resumed."""
+    fake_request, requested = _fake_request(cern_identities, limit=4, fail_at=8)
+    with patch.object(AuthZService, "_request", fake_request):
+        with pytest.raises(RequestError):
+            sync(authz_service=dict(limit=4))
+
+    fake_request, requested = _fake_request(cern_identities, limit=5)
+    with patch.object(AuthZService, "_request", fake_request):
+        sync(authz_service=dict(limit=5))
+    assert requested == [0, 5]
+
+    fake_request, requested = _fake_request(cern_identities, limit=4, fail_at=8)
+    with patch.object(AuthZService, "_request", fake_request):
+        with pytest.raises(RequestError):
+            sync(authz_service=dict(limit=4))
+    validity = app.config["CERN_SYNC_USERS_CHECKPOINT_VALIDITY"]
+    expired = datetime.now(tz=timezone.utc) - validity - timedelta(minutes=1)
+    db.session.execute(update(CERNSyncCheckpoint).values(updated=expired))
+    db.session.commit()
+    assert get_resumed_started_at("users-AuthZ") is None
+
+    fake_request, requested = _fake_request(cern_identities, limit=4)
+    with patch.object(AuthZService, "_request", fake_request):
+        sync(authz_service=dict(limit=4))
+    assert requested == [0, 4, 8]
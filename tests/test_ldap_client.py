@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""LDAP client tests."""
+
+import time
+from unittest.mock import MagicMock, patch
+
+from invenio_cern_sync.ldap.client import (
+    PRIMARY_ACCOUNTS_FILTER,
+    LdapClient,
+    cn_range_partitions,
+)
+
+RES_SEARCH_ENTRY = 100
+RES_SEARCH_RESULT = 101
+
+
+def _mock_pages(ldap_users, page_size):
+    """Return a side effect for `result3`, paginating the given users."""
+    pages = [
+        ldap_users[i : i + page_size] for i in range(0, len(ldap_users), page_size)
+    ]
+
+    def _result3(response):
+        page = pages.pop(0)
+        control = MagicMock(controlType="paged", cookie=b"next" if pages else b"")
+        return None, [(f"CN={u['cn'][0]}", u) for u in page], None, [control]
+
+    return _result3
+
+
+@patch("invenio_cern_sync.ldap.client.ldap")
+def test_iter_primary_accounts(mock_ldap, app, ldap_users):
+    """Test that entries are yielded page by page."""
+    mock_ldap.controls.SimplePagedResultsControl.controlType = "paged"
+    connection = mock_ldap.initialize.return_value
+    connection.result3.side_effect = _mock_pages(ldap_users, page_size=4)
+
+    client = LdapClient(ldap_url="ldap://ldap.test")
+    entries = client.iter_primary_accounts(page_size=4)
+
+    # the first page only is requested before consuming the entries
+    assert next(entries) == ldap_users[0]
+    assert connection.result3.call_count == 1
+
+    assert [ldap_users[0]] + list(entries) == ldap_users
+    assert connection.result3.call_count == 3
+    mock_ldap.controls.SimplePagedResultsControl.assert_called_once_with(
+        True, size=4, cookie=""
+    )
+
+
+@patch("invenio_cern_sync.ldap.client.ldap")
+def test_get_primary_accounts(mock_ldap, app, ldap_users):
+    """Test that all entries are returned, with the configured page size."""
+    mock_ldap.controls.SimplePagedResultsControl.controlType = "paged"
+    connection = mock_ldap.initialize.return_value
+    connection.result3.side_effect = _mock_pages(ldap_users, page_size=1000)
+
+    client = LdapClient(ldap_url="ldap://ldap.test")
+
+    assert client.get_primary_accounts() == ldap_users
+    mock_ldap.controls.SimplePagedResultsControl.assert_called_once_with(
+        True, size=app.config["CERN_SYNC_LDAP_PAGE_SIZE"], cookie=""
+    )
+
+
+@patch("invenio_cern_sync.ldap.client.ldap")
+def test_iter_primary_accounts_since(mock_ldap, app, ldap_users):
+    """Test that only the entries modified since the given date are searched."""
+    mock_ldap.controls.SimplePagedResultsControl.controlType = "paged"
+    connection = mock_ldap.initialize.return_value
+    connection.result3.side_effect = _mock_pages(ldap_users, page_size=1000)
+
+    client = LdapClient(ldap_url="ldap://ldap.test")
+    list(client.iter_primary_accounts(since="2024-01-02T03:04:05"))
+
+    search_filter = connection.search_ext.call_args.args[2]
+    assert (
+        search_filter == f"(&{PRIMARY_ACCOUNTS_FILTER}(whenChanged>=20240102030405.0Z))"
+    )
+
+
+class _StreamingConnection:
+    """Fake connection, returning the entries of the partition one by one."""
+
+    def __init__(self, ldap_users, partitions):
+        """Constructor."""
+        self.ldap_users = ldap_users
+        self.partitions = partitions
+        self.results = dict()
+        self.unbound = False
+        self.busy = False
+        self.unbound_busy = False
+        self.delay = 0
+
+    def search_ext(self, base, scope, filter, fields, serverctrls=None):
+        """Queue the entries of the partition in the filter, and a final result."""
+        index = next(
+            i for i, p in enumerate(self.partitions) if filter.endswith(p + ")")
+        )
+        users = [u for u in self.ldap_users if (u["cn"][0] >= b"jdoe5") == index]
+        msgid = len(self.results) + 1
+        self.results[msgid] = [(RES_SEARCH_ENTRY, [("CN=u", u)]) for u in users]
+        control = MagicMock(controlType="paged", cookie=b"")
+        self.results[msgid].append((RES_SEARCH_RESULT, [], [control]))
+        return msgid
+
+    def result3(self, msgid, all=1):
+        """Return the next result of the search."""
+        assert all == 0
+        self.busy = True
+        time.sleep(self.delay)
+        self.busy = False
+        rtype, rdata, *serverctrls = self.results[msgid].pop(0)
+        return rtype, rdata, msgid, serverctrls[0] if serverctrls else []
+
+    def unbind_s(self):
+        """Close the connection."""
+        self.unbound = True
+        self.unbound_busy |= self.busy
+
+
+@patch("invenio_cern_sync.ldap.client.ldap")
+def test_iter_primary_accounts_partitions(mock_ldap, app, ldap_users):
+    """Test that partitions are searched in parallel, on their own connections."""
+    mock_ldap.controls.SimplePagedResultsControl.controlType = "paged"
+    mock_ldap.RES_SEARCH_ENTRY = RES_SEARCH_ENTRY
+    mock_ldap.RES_SEARCH_RESULT = RES_SEARCH_RESULT
+    partitions = cn_range_partitions(["jdoe5"])
+    assert partitions == ["(!(cn>=jdoe5))", "(cn>=jdoe5)"]
+    connections = []
+
+    def _initialize(url):
+        connections.append(_StreamingConnection(ldap_users, partitions))
+        return connections[-1]
+
+    mock_ldap.initialize.side_effect = _initialize
+
+    client = LdapClient(ldap_url="ldap://ldap.test", max_connections=2)
+    entries = list(client.iter_primary_accounts(partitions=partitions))
+
+    assert sorted(e["cn"] for e in entries) == sorted(u["cn"] for u in ldap_users)
+    # the connection of the client, and one per thread, closed at the end
+    assert 2 <= len(connections) <= 3
+    assert all(c.unbound for c in connections[1:])
+
+
+@patch("invenio_cern_sync.ldap.client.ldap")
+def test_iter_primary_accounts_partitions_closed(mock_ldap, app, ldap_users):
+    """Test that connections are closed once their thread stopped using them."""
+    mock_ldap.controls.SimplePagedResultsControl.controlType = "paged"
+    mock_ldap.RES_SEARCH_ENTRY = RES_SEARCH_ENTRY
+    mock_ldap.RES_SEARCH_RESULT = RES_SEARCH_RESULT
+    partitions = cn_range_partitions(["jdoe5"])
+    connections = []
+
+    def _initialize(url):
+        connections.append(_StreamingConnection(ldap_users, partitions))
+        connections[-1].delay = 0.05
+        return connections[-1]
+
+    mock_ldap.initialize.side_effect = _initialize
+
+    client = LdapClient(ldap_url="ldap://ldap.test", max_connections=2)
+    entries = client.iter_primary_accounts(partitions=partitions)
+    next(entries)
+    # the consumer stops while the threads are still waiting for entries
+    entries.close()
+
+    assert all(c.unbound for c in connections[1:])
+    assert not any(c.unbound_busy for c in connections)
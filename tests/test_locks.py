@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Sync locks tests."""
+
+import time
+from datetime import timedelta
+from unittest.mock import patch
+
+import pytest
+from invenio_cache import current_cache
+
+from invenio_cern_sync.locks import CacheSyncLock, DBSyncLock, get_sync_lock
+from invenio_cern_sync.models import CERNSyncState
+from invenio_cern_sync.tasks import sync_groups
+
+
+@pytest.mark.parametrize("lock_cls", [DBSyncLock, CacheSyncLock])
+def test_lock(lock_cls, app, db):
+    """Test that a lock is held by one owner at a time."""
+    lock = lock_cls(f"test-{lock_cls.__name__}")
+    other = lock_cls(lock.name)
+
+    assert lock.acquire()
+    assert not other.acquire()
+    assert other.get_holder()[0] == lock.owner
+    assert lock.refresh()
+    assert not other.refresh()
+
+    # another task can release the lock of the owner
+    other.release()
+    assert not other.acquire()
+    lock_cls(lock.name, owner=lock.owner).release()
+    assert other.acquire()
+    assert not lock.refresh()
+    other.release()
+    assert other.get_holder() == (None, None)
+
+
+def test_db_lock_expiry(app, db):
+    """Test that an expired lock is taken over."""
+    lock = DBSyncLock("test-expiry", ttl=timedelta(seconds=-1))
+    other = DBSyncLock("test-expiry")
+
+    assert lock.acquire()
+    assert other.get_holder() == (None, None)
+    assert other.acquire()
+    assert not lock.refresh()
+    other.release()
+
+
+def test_cache_lock_not_extended(app, db):
+    """Test that refreshing the cache lock never overwrites another lease."""
+    lock = CacheSyncLock("test-cache-refresh")
+    other = CacheSyncLock(lock.name)
+
+    assert lock.acquire()
+    holder = other.get_holder()
+    assert lock.refresh()
+    assert other.get_holder() == holder
+
+    # the lease expired and was taken over
+    current_cache.delete(lock.key)
+    assert other.acquire()
+    assert not lock.refresh()
+    assert other.get_holder()[0] == other.owner
+    other.release()
+
+
+def test_heartbeat(app, db):
+    """Test that the lock is refreshed while held."""
+    lock = DBSyncLock("test-heartbeat", ttl=timedelta(seconds=0.3))
+    assert lock.acquire()
+    with patch.object(DBSyncLock, "refresh", return_value=True) as mock_refresh:
+        with lock.heartbeat():
+            time.sleep(0.35)
+    assert mock_refresh.call_count >= 2
+    lock.release()
+
+
+@pytest.mark.parametrize("lock_cls", [DBSyncLock, CacheSyncLock])
+@patch("invenio_cern_sync.locks.log_warning")
+@patch("invenio_cern_sync.tasks.groups_sync")
+def test_sync_task_contention(
+    mock_sync, mock_log_warning, lock_cls, app, database, monkeypatch
+):
+    """Test that a sync task is skipped while the same sync is running.
+
+    The `db` fixture is not used: its outer transaction would block the writes of
+    the DB lock on SQLite. The state of the run is deleted at the end.
+    """
+    monkeypatch.setitem(app.config, "DEBUG", False)
+    monkeypatch.setitem(app.config, "CERN_SYNC_LOCK", lock_cls)
+    running = get_sync_lock("groups")
+    assert isinstance(running, lock_cls)
+    assert running.acquire()
+
+    try:
+        sync_groups()
+        mock_sync.assert_not_called()
+        extra = mock_log_warning.call_args.args[1]
+        assert extra["action"] == "lock-contention"
+        assert extra["holder"] == running.owner
+
+        running.release()
+        sync_groups()
+        mock_sync.assert_called_once_with()
+        # the lock is released at the end of the run
+        assert get_sync_lock("groups").get_holder() == (None, None)
+    finally:
+        running.release()
+        CERNSyncState.query.filter_by(kind="groups").delete()
+        database.session.commit()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Sync metrics tests."""
+
+import socket
+from unittest.mock import patch
+
+from invenio_cern_sync.authz.retry import RetryPolicy
+from invenio_cern_sync.metrics import (
+    LogMetricsSink,
+    PrometheusFileSink,
+    StatsdMetricsSink,
+    SyncMetrics,
+)
+from invenio_cern_sync.users.sync import sync
+
+
+def _metrics():
+    """Return metrics with one value of each type."""
+    metrics = SyncMetrics("users-sync", log_uuid="uuid")
+    metrics.incr("authz_pages", 2)
+    metrics.observe("authz_page_seconds", 0.2)
+    metrics.observe("authz_page_seconds", 3)
+    with metrics.phase("updating-existing-users") as phase:
+        phase["records"] = 10
+    return metrics
+
+
+def test_sync_metrics(app):
+    """Test the collection of the metrics."""
+    metrics = _metrics()
+    assert metrics.counter("authz_pages") == 2
+    histogram = metrics.histograms[("authz_page_seconds", ())]
+    assert (histogram.count, histogram.sum, histogram.max) == (2, 3.2, 3)
+    phase = (("phase", "updating-existing-users"),)
+    assert metrics.gauges[("phase_records", phase)] == 10
+    assert metrics.gauges[("phase_records_per_second", phase)] > 0
+
+    items = list(metrics.timed_iter(range(5), "fetch"))
+    assert items == list(range(5))
+    assert metrics.counter("fetch_records") == 5
+
+    policy = RetryPolicy(max_attempts=2, backoff=0)
+    metrics.track_retries(policy)
+    policy.record_retry(0.5)
+    metrics.emit(sinks=[])
+    assert metrics.counter("http_retries") == 1
+    assert metrics.counter("http_sleep_time") == 0.5
+
+
+def test_prometheus_sink(app, tmp_path):
+    """Test that the metrics are written in the Prometheus text format."""
+    PrometheusFileSink(directory=str(tmp_path)).emit(_metrics())
+
+    lines = (tmp_path / "users-sync.prom").read_text().splitlines()
+    # the values of the last run, reset at each run, are gauges
+    assert "# TYPE cern_sync_last_run_authz_pages gauge" in lines
+    assert 'cern_sync_last_run_authz_pages{sync="users-sync"} 2' in lines
+    assert not [line for line in lines if "_total" in line]
+    assert (
+        'cern_sync_last_run_authz_page_seconds_bucket{sync="users-sync",le="0.25"} 1'
+        in lines
+    )
+    assert (
+        'cern_sync_last_run_authz_page_seconds_bucket{sync="users-sync",le="+Inf"} 2'
+        in lines
+    )
+    assert 'cern_sync_last_run_authz_page_seconds_count{sync="users-sync"} 2' in lines
+    assert (
+        "cern_sync_last_run_phase_records"
+        '{sync="users-sync",phase="updating-existing-users"} 10' in lines
+    )
+    assert list(tmp_path.iterdir()) == [tmp_path / "users-sync.prom"]
+
+
+def test_prometheus_sink_parts(app, tmp_path):
+    """Test that the parts of a run, e.g. the shards, write their own files."""
+    sink = PrometheusFileSink(directory=str(tmp_path))
+    for part in ["shard-0", "shard-1", "merge"]:
+        metrics = SyncMetrics("users-sync", log_uuid="uuid", part=part)
+        metrics.incr("authz_pages", 2)
+        sink.emit(metrics)
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "users-sync-merge.prom",
+        "users-sync-shard-0.prom",
+        "users-sync-shard-1.prom",
+    ]
+    lines = (tmp_path / "users-sync-shard-1.prom").read_text().splitlines()
+    assert 'cern_sync_last_run_authz_pages{sync="users-sync",part="shard-1"} 2' in lines
+
+
+def test_statsd_sink(app):
+    """Test that the metrics are sent to the statsd collector."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as collector:
+        collector.bind(("127.0.0.1", 0))
+        collector.settimeout(1)
+        host, port = collector.getsockname()
+        sink = StatsdMetricsSink(host=host, port=port)
+        sink.emit(_metrics())
+        received = {collector.recv(1024).decode() for _ in sink.lines(_metrics())}
+
+    assert "cern_sync.users_sync.authz_pages:2|c" in received
+    assert "cern_sync.users_sync.authz_page_seconds.count:2|g" in received
+    assert "cern_sync.users_sync.phase_records.updating_existing_users:10|g" in received
+
+
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_sync_emits_metrics(
+    MockAuthZService, MockKeycloakService, app, cern_identities, db
+):
+    """Test that the metrics of a sync run are emitted to the sinks."""
+    invalid_identity = dict(cern_identities[0])
+    del invalid_identity["personId"]
+    identities = cern_identities + [invalid_identity]
+    MockAuthZService.return_value.get_identities.return_value = identities
+
+    with patch.object(LogMetricsSink, "emit") as mock_emit:
+        sync(method="AuthZ")
+
+    metrics = mock_emit.call_args.args[0]
+    assert metrics.counter("fetch_records") == len(identities)
+    assert metrics.counter("skipped_invalid_records") == 1
+    assert metrics.counter("db_commits") >= 2
+    phase = (("phase", "updating-existing-users"),)
+    assert metrics.gauges[("phase_records", phase)] == len(cern_identities)
+    assert ("db_lookup_seconds", ()) in metrics.histograms
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Pipeline tests."""
+
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+from invenio_accounts.models import User
+from invenio_accounts.proxies import current_datastore
+
+from invenio_cern_sync.groups.sync import sync as groups_sync
+from invenio_cern_sync.metrics import SyncMetrics
+from invenio_cern_sync.pipeline import iter_pipelined, iter_prefetched
+from invenio_cern_sync.users.sync import sync as users_sync
+
+
+def test_pipelined(app):
+    """Test that the records are fetched and serialized in other threads."""
+    threads = set()
+    metrics = SyncMetrics("test")
+
+    def _serialize(records):
+        for record in records:
+            threads.add(threading.current_thread().name)
+            yield record * 2
+
+    results = list(iter_pipelined(range(1000), _serialize, metrics=metrics))
+    assert results == [i * 2 for i in range(1000)]
+    assert threads == {"cern-sync-serialize"}
+    assert metrics.counter("pipeline_produce_records", stage="fetch") == 1000
+    assert metrics.counter("pipeline_produce_records", stage="serialize") == 1000
+
+
+def test_prefetched_backpressure(app):
+    """Test that the thread does not produce more than the queue can hold."""
+    produced = []
+
+    def _produce():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    items = iter_prefetched(_produce(), "fetch", queue_size=20, batch_size=10)
+    assert next(items) == 0
+    time.sleep(0.5)
+    # 1 batch being consumed, 2 queued and 1 waiting for the queue
+    assert 10 < len(produced) <= 40
+    items.close()
+
+
+def test_prefetched_error(app):
+    """Test that the errors of the thread are raised by the consumer."""
+
+    def _produce():
+        yield 1
+        raise ValueError("AuthZ is down")
+
+    items = iter_prefetched(_produce(), "fetch")
+    with pytest.raises(ValueError, match="AuthZ is down"):
+        list(items)
+
+
+def test_prefetched_cancel(app):
+    """Test that the thread stops and closes the iterable when the consumer stops."""
+    closed = threading.Event()
+
+    def _produce():
+        try:
+            i = 0
+            while True:
+                yield i
+                i += 1
+        finally:
+            closed.set()
+
+    items = iter_prefetched(_produce(), "fetch", queue_size=20, batch_size=10)
+    assert next(items) == 0
+    items.close()
+    assert closed.wait(5)
+
+
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_sync_users_pipelined(
+    MockAuthZService, MockKeycloakService, app, cern_identities, db, monkeypatch
+):
+    """Test the users sync, with the users fetched in a pipeline."""
+    monkeypatch.setitem(app.config, "CERN_SYNC_PIPELINE", True)
+    MockAuthZService.return_value.get_identities.return_value = cern_identities
+
+    results = users_sync(method="AuthZ")
+    assert len(results) == len(cern_identities)
+    assert User.query.count() == len(cern_identities)
+    # the position is not tracked
+    get_identities = MockAuthZService.return_value.get_identities
+    assert get_identities.call_args.kwargs["position"] is None
+
+
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_sync_users_pipelined_error(
+    MockAuthZService, MockKeycloakService, app, cern_identities, db, monkeypatch
+):
+    """Test that the errors of the fetch stage fail the sync."""
+    monkeypatch.setitem(app.config, "CERN_SYNC_PIPELINE", True)
+
+    def _get_identities(**kwargs):
+        for identity in cern_identities:
+            yield {
+                **identity,
+                "personId": f"9{identity['personId']}",
+                "upn": f"new{identity['upn']}",
+                "primaryAccountEmail": f"new{identity['primaryAccountEmail']}",
+            }
+        raise ConnectionError("AuthZ is down")
+
+    MockAuthZService.return_value.get_identities.side_effect = _get_identities
+    count = User.query.count()
+    with pytest.raises(ConnectionError):
+        users_sync(method="AuthZ")
+    # the users of the failed chunk are not inserted
+    assert User.query.count() == count
+
+
+@patch("invenio_cern_sync.groups.sync.KeycloakService")
+@patch("invenio_cern_sync.groups.sync.AuthZService")
+def test_sync_groups_pipelined(
+    MockAuthZService, MockKeycloakService, app, authz_groups, monkeypatch
+):
+    """Test the groups sync, with the groups fetched in a pipeline."""
+    monkeypatch.setitem(app.config, "CERN_SYNC_PIPELINE", True)
+    MockAuthZService.return_value.get_groups.return_value = authz_groups
+
+    results = groups_sync()
+    assert len(results) == len(authz_groups)
+    for group in authz_groups:
+        role = current_datastore.find_role_by_id(group["groupIdentifier"])
+        assert role.name == group["displayName"]
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Sync DB session tests."""
+
+import gc
+from functools import partial
+from unittest.mock import patch
+
+import pytest
+from invenio_accounts.models import User
+from invenio_oauthclient.models import RemoteAccount, UserIdentity
+from sqlalchemy import event, insert
+
+from invenio_cern_sync.errors import MemoryLimitExceeded
+from invenio_cern_sync.session import SyncSession, get_rss_mb
+from invenio_cern_sync.sso import cern_remote_app_name
+from invenio_cern_sync.users.lookup import BulkLocalUsersLookup
+from invenio_cern_sync.users.sync import _insert_missing, _update_existing, sync
+from invenio_cern_sync.utils import chunked
+
+
+@pytest.fixture()
+def small_chunks():
+    """Commit every 3 users."""
+    update_existing = partial(_update_existing, persist_every=3)
+    with patch("invenio_cern_sync.users.sync._update_existing", update_existing):
+        yield
+
+
+def _changed(cern_identities):
+    """Return the identities with a new e-mail."""
+    return [
+        {**identity, "primaryAccountEmail": f"new{i}@cern.ch"}
+        for i, identity in enumerate(cern_identities)
+    ]
+
+
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_sync_session_bounded(
+    MockAuthZService, MockKeycloakService, app, cern_identities, db, small_chunks
+):
+    """Test that the objects of each chunk are released before the next one."""
+    get_identities = MockAuthZService.return_value.get_identities
+    get_identities.return_value = cern_identities
+    sync()
+    kept = User.query.filter_by(email=cern_identities[0]["primaryAccountEmail"]).one()
+
+    sizes = []
+    release = SyncSession.release
+
+    def _release(self, *args, **kwargs):
+        sizes.append(len(self._session.identity_map))
+        return release(self, *args, **kwargs)
+
+    get_identities.return_value = _changed(cern_identities)
+    with patch.object(SyncSession, "release", _release):
+        sync()
+
+    # the objects of at most one chunk of 3 users, and the checkpoint
+    assert len(sizes) > len(cern_identities) / 3
+    assert max(sizes) <= 3 * 3 + 2
+    # the objects loaded before are kept, and expired
+    session = db.session()
+    assert list(session.identity_map.values()) == [kept]
+    assert kept.email == "new0@cern.ch"
+    assert session.expire_on_commit
+
+
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_sync_memory_limit(
+    MockAuthZService, MockKeycloakService, app, cern_identities, db, small_chunks
+):
+    """Test that a sync exceeding the max memory fails after committing a chunk."""
+    get_identities = MockAuthZService.return_value.get_identities
+    get_identities.return_value = cern_identities
+    sync()
+
+    get_identities.return_value = _changed(cern_identities)
+    # exceeded after the first chunk, also after collecting garbage
+    rss_mb = [512, 2048, 2048]
+    with patch("invenio_cern_sync.session.get_rss_mb", side_effect=rss_mb):
+        with patch.dict(app.config, CERN_SYNC_USERS_MAX_RSS_MB=1024):
+            with pytest.raises(MemoryLimitExceeded):
+                sync()
+
+    # the first chunk is committed
+    assert User.query.filter_by(email="new2@cern.ch").one()
+    assert not User.query.filter_by(email="new3@cern.ch").one_or_none()
+
+
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_sync_session_bounded_many_chunks(
+    MockAuthZService, MockKeycloakService, app, cern_identities, db
+):
+    """Test that the session stays bounded by the chunk size over a large run."""
+    chunk_size, count = 50, 2000
+    identities = [
+        {
+            **cern_identities[0],
+            "upn": f"bounded{i}",
+            "personId": f"bounded-{i}",
+            "primaryAccountEmail": f"bounded{i}@cern.ch",
+        }
+        for i in range(count)
+    ]
+    get_identities = MockAuthZService.return_value.get_identities
+
+    sizes = []
+    release = SyncSession.release
+
+    def _release(self, *args, **kwargs):
+        sizes.append(len(self._session.identity_map))
+        return release(self, *args, **kwargs)
+
+    # keep the loaded users alive: only expunging them bounds the identity map,
+    # that otherwise references clean objects weakly
+    loaded = []
+
+    def _on_load(target, context):
+        loaded.append(target)
+
+    update_existing = partial(_update_existing, persist_every=chunk_size)
+    insert_missing = partial(_insert_missing, persist_every=chunk_size)
+    event.listen(User, "load", _on_load)
+    try:
+        with patch("invenio_cern_sync.users.sync._update_existing", update_existing):
+            with patch("invenio_cern_sync.users.sync._insert_missing", insert_missing):
+                with patch.object(SyncSession, "release", _release):
+                    # all users are inserted, then all of them are updated
+                    get_identities.return_value = identities
+                    sync()
+                    get_identities.return_value = _changed(identities)
+                    sync()
+    finally:
+        event.remove(User, "load", _on_load)
+
+    assert len(loaded) >= count
+    assert User.query.filter(User.email.like("new%@cern.ch")).count() == count
+    # sampled before each chunk is released: at least one per chunk of each phase
+    assert len(sizes) >= 3 * count / chunk_size
+    # the User, UserIdentity and RemoteAccount of each user of one chunk, and the
+    # checkpoint, independently of the number of users
+    assert max(sizes) <= 3 * chunk_size + 2
+    assert len(db.session().identity_map) <= 3 * chunk_size + 2
+
+
+def _insert_large(app, db, ids):
+    """Insert the users with the given ids, with their identity and account."""
+    client_id = app.config["CERN_APP_CREDENTIALS"]["consumer_key"]
+    for chunk in chunked(ids, 10000):
+        users = [
+            dict(
+                id=i,
+                email=f"large{i}@cern.ch",
+                username=f"large{i}",
+                displayname=f"large{i}",
+                domain="cern.ch",
+                active=True,
+                version_id=1,
+            )
+            for i in chunk
+        ]
+        db.session.execute(insert(User.__table__), users)
+        identities = [
+            dict(id=f"large-{i}", method=cern_remote_app_name, id_user=i) for i in chunk
+        ]
+        db.session.execute(insert(UserIdentity.__table__), identities)
+        accounts = [dict(user_id=i, client_id=client_id, extra_data={}) for i in chunk]
+        db.session.execute(insert(RemoteAccount.__table__), accounts)
+    db.session.commit()
+
+
+@pytest.mark.slow
+def test_sync_session_large_stream(app, db):
+    """Test that a stream of 100k users keeps the session and the memory bounded."""
+    count, chunk_size, first_id = 100000, 1000, 1000000
+    ids = range(first_id, first_id + count)
+    _insert_large(app, db, ids)
+    users = (
+        dict(
+            email=f"large{i}@cern.ch",
+            username=f"large{i}",
+            user_identity_id=f"large-{i}",
+        )
+        for i in ids
+    )
+
+    # keep the loaded objects alive while they are in the session: only expunging
+    # them bounds the identity map, that otherwise references clean objects weakly
+    loaded = dict()
+    session = db.session()
+
+    def _on_load(target, context):
+        loaded[id(target)] = target
+
+    def _on_detached(session, instance):
+        loaded.pop(id(instance), None)
+
+    models = [User, UserIdentity, RemoteAccount]
+    for model in models:
+        event.listen(model, "load", _on_load)
+    event.listen(session, "persistent_to_detached", _on_detached)
+    lookup = BulkLocalUsersLookup()
+    sizes = []
+    try:
+        with SyncSession("users-sync") as sync_session:
+            for index, chunk in enumerate(chunked(users, chunk_size)):
+                sync_session.release()
+                if index == 5:
+                    # once the caches of the queries are warm
+                    gc.collect()
+                    rss_mb = get_rss_mb()
+                lookup.prefetch(chunk)
+                for user in chunk:
+                    local_user = lookup.get_user(user["email"], user["username"])
+                    identity = lookup.get_identity(user["user_identity_id"])
+                    assert identity.id_user == local_user.id
+                    assert lookup.get_remote_account(local_user.id)
+                db.session.commit()
+                sizes.append(len(session.identity_map))
+    finally:
+        for model in models:
+            event.remove(model, "load", _on_load)
+        event.remove(session, "persistent_to_detached", _on_detached)
+    gc.collect()
+
+    assert len(sizes) == count / chunk_size
+    # the User, UserIdentity and RemoteAccount of each user of one chunk
+    assert max(sizes) <= 3 * chunk_size
+    # the 300k objects loaded would take hundreds of MB
+    assert get_rss_mb() - rss_mb < 20
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Sync snapshots tests."""
+
+import os
+from unittest.mock import patch
+
+import pytest
+from invenio_accounts.models import User
+
+from invenio_cern_sync.users import sync as users_sync
+from invenio_cern_sync.users.sync import sync
+
+
+@pytest.fixture()
+def snapshots_dir(app, tmp_path, monkeypatch):
+    """Enable the snapshots."""
+    monkeypatch.setitem(app.config, "CERN_SYNC_SNAPSHOTS_DIR", str(tmp_path))
+    return tmp_path
+
+
+@patch("invenio_cern_sync.snapshots.log_info")
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_sync_with_snapshot(
+    MockAuthZService,
+    MockKeycloakService,
+    mock_log_info,
+    app,
+    cern_identities,
+    db,
+    snapshots_dir,
+):
+    """Test that full syncs only reconcile the users changed since the snapshot."""
+    reconciled = []
+
+    def _reconcile_chunk(chunk, *args):
+        reconciled.extend(u["user_identity_id"] for u in chunk)
+        return reconcile_chunk(chunk, *args)
+
+    reconcile_chunk = users_sync._reconcile_chunk
+    get_identities = MockAuthZService.return_value.get_identities
+    get_identities.return_value = cern_identities
+    with patch.object(users_sync, "_reconcile_chunk", _reconcile_chunk):
+        # the new users are inserted, and reconciled again by the next sync
+        sync()
+        sync()
+        assert len(reconciled) == 2 * len(cern_identities)
+        assert os.listdir(snapshots_dir) == ["users-AuthZ.sqlite"]
+
+        reconciled.clear()
+        changed = {**cern_identities[0], "displayName": "New Name"}
+        get_identities.return_value = [changed] + cern_identities[1:-1]
+        sync()
+        assert reconciled == [changed["personId"]]
+        extra = mock_log_info.call_args.args[1]
+        assert extra["unchanged"] == len(cern_identities) - 2
+        assert extra["removed"] == 1
+
+        # delta syncs reconcile all the fetched users
+        reconciled.clear()
+        sync(identities=dict(since="2024-01-01"))
+        assert len(reconciled) == len(cern_identities) - 1
+
+        # the snapshot of a failed run is discarded
+        get_identities.side_effect = Exception("AuthZ is down")
+        with pytest.raises(Exception):
+            sync()
+        assert os.listdir(snapshots_dir) == ["users-AuthZ.sqlite"]
+
+
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_delta_sync_updates_snapshot(
+    MockAuthZService, MockKeycloakService, app, cern_identities, db, snapshots_dir
+):
+    """Test that a change reverted after a delta sync is synced by a full sync."""
+    # the snapshot is still valid when the next full sync is due
+    config = app.config
+    assert config["CERN_SYNC_SNAPSHOT_MAX_AGE"] > config["CERN_SYNC_FULL_SYNC_INTERVAL"]
+    identities = [
+        {
+            **identity,
+            "upn": f"snapshot{i}",
+            "personId": f"snapshot-{i}",
+            "primaryAccountEmail": f"snapshot{i}@cern.ch",
+        }
+        for i, identity in enumerate(cern_identities)
+    ]
+    get_identities = MockAuthZService.return_value.get_identities
+    get_identities.return_value = identities
+    # the new users are inserted, then added to the snapshot
+    sync()
+    sync()
+
+    def _full_name():
+        user = User.query.filter_by(email=identities[0]["primaryAccountEmail"]).one()
+        return user.user_profile["full_name"]
+
+    original = identities[0]["displayName"]
+    get_identities.return_value = [{**identities[0], "displayName": "New Name"}]
+    sync(identities=dict(since="2024-01-01"))
+    assert _full_name() == "New Name"
+
+    # reverted before the next full sync, that compares it with the delta sync
+    get_identities.return_value = identities
+    sync()
+    assert _full_name() == original
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Staging reconciliation tests, on PostgreSQL only."""
+
+import copy
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+import pytest
+from invenio_accounts.models import User
+from invenio_oauthclient.models import RemoteAccount, UserIdentity
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from invenio_cern_sync.models import CERNSyncUserChange
+from invenio_cern_sync.users.changes import UserChanges, get_user_changes
+from invenio_cern_sync.users.staging import UsersStaging
+from invenio_cern_sync.users.sync import sync
+
+
+@pytest.fixture(autouse=True)
+def postgresql_only(db):
+    """Skip the tests on other databases."""
+    if db.engine.dialect.name != "postgresql":
+        pytest.skip("The staging reconciliation requires PostgreSQL.")
+
+
+def _state():
+    """Return the synced user tables, with the changes of each user."""
+    state = []
+    for user in User.query.order_by(User.id):
+        identity = UserIdentity.query.filter_by(id_user=user.id).one()
+        extra_data = RemoteAccount.query.filter_by(user=user).one().extra_data
+        changes = [
+            (change.identity_id, change.action, change.data)
+            for change in get_user_changes(user_id=user.id)
+        ]
+        state.append(
+            (
+                user.email,
+                user.username,
+                user.domain,
+                dict(user.user_profile),
+                dict(user.preferences),
+                identity.id,
+                dict(extra_data),
+                changes,
+            )
+        )
+    return state
+
+
+def _delete_users(db):
+    """Delete all the users, and their changes."""
+    CERNSyncUserChange.query.delete()
+    RemoteAccount.query.delete()
+    UserIdentity.query.delete()
+    User.query.delete()
+    db.session.commit()
+
+
+def _changed(cern_identities):
+    """Return the identities with a changed e-mail, id, profile and a new one."""
+    identities = copy.deepcopy(cern_identities)
+    # e-mail and username changed
+    identities[0]["upn"] = "mrossi"
+    identities[0]["primaryAccountEmail"] = "mrossi@cern.ch"
+    # person id changed
+    identities[1]["personId"] = "99999"
+    # profile changed
+    identities[2]["displayName"] = "Johnny Doe"
+    identities.append(
+        {**identities[5], "upn": "new", "personId": "1", "primaryAccountEmail": "n@c.h"}
+    )
+    return identities
+
+
+def _swapped(cern_identities):
+    """Return the identities with the e-mails and usernames of two users swapped."""
+    identities = copy.deepcopy(cern_identities)
+    for key in ["upn", "primaryAccountEmail"]:
+        identities[3][key], identities[4][key] = identities[4][key], identities[3][key]
+    return identities
+
+
+def _run(app, monkeypatch, staging, steps):
+    """Sync each list of identities, and return the state and the logged changes."""
+    monkeypatch.setitem(app.config, "CERN_SYNC_USERS_STAGING", staging)
+    with patch("invenio_cern_sync.users.sync.AuthZService") as MockAuthZService:
+        with patch("invenio_cern_sync.users.sync.KeycloakService"):
+            with patch("invenio_cern_sync.users.sync.log_warning") as mock_warning:
+                results = []
+                for identities in steps:
+                    get_identities = MockAuthZService.return_value.get_identities
+                    get_identities.return_value = identities
+                    results.append(sorted(sync()))
+    changes = sorted(
+        call.args[1]["msg"]
+        for call in mock_warning.call_args_list
+        if "changed" in call.args[1]["msg"]
+    )
+    return _state(), changes, results
+
+
+@pytest.mark.parametrize("skip_unchanged", [True, False])
+def test_staging_same_as_batches(app, cern_identities, db, monkeypatch, skip_unchanged):
+    """Test that the staging reconciles the users as the batches do."""
+    monkeypatch.setitem(app.config, "CERN_SYNC_USERS_SKIP_UNCHANGED", skip_unchanged)
+    steps = [cern_identities, _changed(cern_identities)]
+    expected = _run(app, monkeypatch, False, steps)
+    _delete_users(db)
+
+    with patch.object(UsersStaging, "spool") as mock_spool:
+        state, changes, results = _run(app, monkeypatch, True, steps)
+    mock_spool.assert_not_called()
+    assert state == expected[0]
+    assert changes == expected[1]
+    assert len(changes) == 2
+    # user ids differ, as users were inserted again
+    assert [len(r) for r in results] == [len(r) for r in expected[2]]
+    # no empty fingerprint is stored when the fingerprints are not staged
+    fingerprints = {extra_data.get("fingerprint") for *_, extra_data, _ in state}
+    assert all(fingerprints) if skip_unchanged else fingerprints == {None}
+
+    # unchanged users are skipped, or compared and not updated
+    with patch("invenio_cern_sync.users.sync.AuthZService") as MockAuthZService:
+        with patch("invenio_cern_sync.users.sync.KeycloakService"):
+            MockAuthZService.return_value.get_identities.return_value = steps[-1]
+            assert sync() == []
+    assert _state() == state
+
+
+def test_staging_fallback(app, cern_identities, db, monkeypatch):
+    """Test that the users matching the same local user are updated in batches."""
+    # a new person id with the e-mail and username of an existing user
+    identities = cern_identities + [{**cern_identities[5], "personId": "99999"}]
+    steps = [cern_identities, identities]
+    expected = _run(app, monkeypatch, False, steps)
+    _delete_users(db)
+
+    spool = UsersStaging.spool
+    with patch.object(UsersStaging, "spool", autospec=True, side_effect=spool) as m:
+        state, changes, results = _run(app, monkeypatch, True, steps)
+    m.assert_called_once()
+    assert state == expected[0]
+    assert changes == expected[1]
+    assert UserIdentity.query.filter_by(id="99999").one()
+
+
+def test_staging_swap(app, cern_identities, db, monkeypatch):
+    """Test that users can swap their e-mails and usernames."""
+    steps = [cern_identities, _swapped(cern_identities)]
+    state, changes, results = _run(app, monkeypatch, True, steps)
+    users = {
+        identity_id: (email, username, changes)
+        for email, username, *_, identity_id, _, changes in state
+    }
+    assert users["12343"][:2] == ("john.doe4@cern.ch", "jdoe4")
+    assert users["12344"][:2] == ("john.doe3@cern.ch", "jdoe3")
+    assert users["12343"][2] == [
+        (
+            "12343",
+            "userdata_changed",
+            dict(
+                previous_username="jdoe3",
+                previous_email="john.doe3@cern.ch",
+                new_username="jdoe4",
+                new_email="john.doe4@cern.ch",
+            ),
+        )
+    ]
+    assert len(changes) == 2
+    assert len(results[-1]) == 2
+
+
+def _recorded_changes():
+    """Return the recorded changes, in order, without the local user ids."""
+    return [
+        (change.identity_id, change.action, change.data)
+        for change in CERNSyncUserChange.query.order_by(CERNSyncUserChange.id)
+    ]
+
+
+def test_staging_changes_same_as_batches(app, cern_identities, db, monkeypatch):
+    """Test that the staging records the changes as the batches do."""
+    steps = [cern_identities, _changed(cern_identities)]
+    _run(app, monkeypatch, False, steps)
+    expected = _recorded_changes()
+    _delete_users(db)
+
+    with patch.object(UsersStaging, "spool") as mock_spool:
+        _run(app, monkeypatch, True, steps)
+    mock_spool.assert_not_called()
+    assert [action for _, action, _ in expected] == [
+        "userdata_changed",
+        "identityId_changed",
+    ]
+    assert _recorded_changes() == expected
+
+
+def test_staging_swap_changes_same_as_batches(app, cern_identities, db, monkeypatch):
+    """Test that the staging records the changes of a swap as the batches would.
+
+    The batches cannot swap e-mails: the changes added before the failed flush are
+    compared.
+    """
+    swapped = _swapped(cern_identities)
+    _run(app, monkeypatch, False, [cern_identities])
+    add = UserChanges.add
+    with patch.object(UserChanges, "add", autospec=True, side_effect=add) as m:
+        with pytest.raises(IntegrityError):
+            _run(app, monkeypatch, False, [swapped])
+    db.session.rollback()
+    expected = [(c.args[2], c.args[1], c.kwargs) for c in m.call_args_list]
+    _delete_users(db)
+
+    _run(app, monkeypatch, True, [cern_identities, swapped])
+    assert len(expected) == 2
+    assert _recorded_changes() == expected
+
+
+def test_staging_invalid(app, cern_identities, db, monkeypatch):
+    """Test that invalid users are updated in batches, with the model validation."""
+    identities = copy.deepcopy(cern_identities)
+    identities[0]["upn"] = "1-invalid"
+    _run(app, monkeypatch, True, [cern_identities])
+
+    spool = UsersStaging.spool
+    with patch.object(UsersStaging, "spool", autospec=True, side_effect=spool) as m:
+        with pytest.raises(ValueError):
+            _run(app, monkeypatch, True, [identities])
+    m.assert_called_once()
+
+
+def test_staging_timestamps(app, cern_identities, db, monkeypatch):
+    """Test that the timestamps are written in UTC, whatever the session zone."""
+    db.session.execute(text("SET TIME ZONE 'Pacific/Auckland'"))
+    try:
+        before = datetime.now(tz=timezone.utc)
+        _run(app, monkeypatch, True, [cern_identities, _changed(cern_identities)])
+        after = datetime.now(tz=timezone.utc)
+        user = User.query.filter_by(email="mrossi@cern.ch").one()
+        identity = UserIdentity.query.filter_by(id="99999").one()
+        for updated in [user.updated, identity.updated]:
+            assert before <= updated <= after
+    finally:
+        db.session.execute(text("SET TIME ZONE 'UTC'"))
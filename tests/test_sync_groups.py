@@ -67,3 +67,58 @@ def test_sync_groups_update(
         role = current_datastore.find_role_by_id(expected_group["groupIdentifier"])
         assert role.name == expected_group["displayName"]
         assert role.description == expected_group["description"]
+
+
+@patch("invenio_cern_sync.groups.sync.KeycloakService")
+@patch("invenio_cern_sync.groups.sync.AuthZService")
+@patch("invenio_cern_sync.groups.sync.log_info")
+def test_sync_groups_bulk_upsert(
+    mock_log_info,
+    MockAuthZService,
+    MockKeycloakService,
+    app,
+    db,
+    monkeypatch,
+):
+    """Test that roles are upserted in chunks, and counted."""
+    current_datastore.create_role(id="managed-role", name="Managed", is_managed=True)
+    current_datastore.create_role(
+        id="bulk-0", name="Bulk 0", description="", is_managed=False
+    )
+    current_datastore.create_role(
+        id="bulk-1", name="Bulk 1", description="Old", is_managed=False
+    )
+    current_datastore.commit()
+
+    groups = [
+        {"groupIdentifier": f"bulk-{i}", "displayName": f"Bulk {i}", "description": ""}
+        for i in range(4)
+    ]
+    # managed roles are never updated
+    groups.append({"groupIdentifier": "managed-role", "displayName": "Managed"})
+    # name conflict: the chunk is synced one by one
+    groups.append({"groupIdentifier": "bulk-4", "displayName": "Bulk 0"})
+    groups.append({"groupIdentifier": "bulk-5", "displayName": "Bulk 5"})
+    MockAuthZService.return_value.get_groups.return_value = groups
+
+    monkeypatch.setitem(app.config, "CERN_SYNC_GROUPS_CHUNK_SIZE", 5)
+    results = sync()
+
+    assert sorted(results) == ["bulk-0", "bulk-1", "bulk-2", "bulk-3", "bulk-5"]
+    assert current_datastore.find_role_by_id("bulk-1").description == ""
+    assert current_datastore.find_role_by_id("bulk-1").version_id == 2
+    assert current_datastore.find_role_by_id("bulk-4") is None
+    mock_log_info.assert_any_call(
+        "groups-sync",
+        dict(
+            action="creating-updating-groups",
+            status="completed",
+            count=5,
+            created=2,
+            updated=1,
+            unchanged=1,
+            skipped=1,
+            synced_one_by_one=1,
+        ),
+        log_uuid=mock.ANY,
+    )
@@ -7,13 +7,23 @@
 
 """Sync users tests."""
 
+import json
+from collections import Counter
 from unittest import mock
 from unittest.mock import patch
 
+import pytest
+from flask import Config
 from invenio_accounts.models import User
 from invenio_oauthclient.models import RemoteAccount, UserIdentity
+from sqlalchemy import event
 
 from invenio_cern_sync.sso import cern_remote_app_name
+from invenio_cern_sync.state import utcnow
+from invenio_cern_sync.users.api import update_existing_user
+from invenio_cern_sync.users.buffer import MissingUsersBuffer
+from invenio_cern_sync.users.changes import get_user_changes
+from invenio_cern_sync.users.lookup import BulkLocalUsersLookup, LocalUsersLookup
 from invenio_cern_sync.users.sync import sync
 from invenio_cern_sync.utils import first_or_default, first_or_raise
 
@@ -35,7 +45,10 @@ def _assert_log_called(mock_log_info):
     mock_log_info.assert_any_call(
         "users-sync",
         dict(
-            action="updating-existing-users", status="completed", updated_count=mock.ANY
+            action="updating-existing-users",
+            status="completed",
+            updated_count=mock.ANY,
+            unchanged_count=mock.ANY,
         ),
         log_uuid=expected_log_uuid,
     )
@@ -116,7 +129,7 @@ def test_sync_authz(
 @patch("invenio_cern_sync.users.sync.log_info")
 def test_sync_ldap(mock_log_info, MockLdapClient, app, ldap_users):
     """Test sync with LDAP."""
-    MockLdapClient.return_value.get_primary_accounts.return_value = ldap_users
+    MockLdapClient.return_value.iter_primary_accounts.return_value = ldap_users
     client_id = app.config["CERN_APP_CREDENTIALS"]["consumer_key"]
 
     results = sync(method="LDAP")
@@ -248,11 +261,13 @@ def test_sync_person_id_change(
     assert user.username == first["upn"]
     user_identity = UserIdentity.query.filter_by(id_user=user.id).one()
     assert user_identity.id == first["personId"]
-    remote_account = RemoteAccount.get(user.id, client_id)
-    ra_change = remote_account.extra_data["changes"][0]
-    assert ra_change["action"] == "identityId_changed"
-    assert ra_change["previous_identity_id"] == previous_person_id
-    assert ra_change["new_identity_id"] == first["personId"]
+    change = get_user_changes(identity_id=first["personId"]).first()
+    assert change.action == "identityId_changed"
+    assert change.user_id == user.id
+    assert change.data == dict(
+        previous_identity_id=previous_person_id, new_identity_id=first["personId"]
+    )
+    assert "changes" not in RemoteAccount.get(user.id, client_id).extra_data
 
     expected_log_msg = f"Identity Id changed for User `{user.username}` `{user.email}`. Previous UserIdentity.id in the local DB: `{previous_person_id}` - New Identity Id from CERN DB: `{first['personId']}`."
     mock_log_warning.assert_any_call(
@@ -332,13 +347,16 @@ def test_sync_username_email_change(
     user = user_identity.user
     assert user.username == first["upn"]
     assert user.email == first["primaryAccountEmail"]
-    remote_account = RemoteAccount.get(user.id, client_id)
-    ra_change = remote_account.extra_data["changes"][0]
-    assert ra_change["action"] == "userdata_changed"
-    assert ra_change["previous_username"] == previous_username
-    assert ra_change["previous_email"] == previous_email
-    assert ra_change["new_username"] == first["upn"]
-    assert ra_change["new_email"] == first["primaryAccountEmail"]
+    change = get_user_changes(user_id=user.id).first()
+    assert change.action == "userdata_changed"
+    assert change.identity_id == first["personId"]
+    assert change.data == dict(
+        previous_username=previous_username,
+        previous_email=previous_email,
+        new_username=first["upn"],
+        new_email=first["primaryAccountEmail"],
+    )
+    assert "changes" not in RemoteAccount.get(user.id, client_id).extra_data
 
     expected_log_msg = f"Username/e-mail changed for UserIdentity.id #{first['personId']}. Local DB username/e-mail: `{previous_username}` `{previous_email}`. New from CERN DB: `{first['upn']}` `{first['primaryAccountEmail']}`."
     mock_log_warning.assert_any_call(
@@ -346,3 +364,354 @@ def test_sync_username_email_change(
         dict(action="updating-existing-users", msg=expected_log_msg),
         log_uuid=mock.ANY,
     )
+
+
+def _count_selects(db, fn):
+    """Return the number of SELECT statements issued while calling `fn`."""
+    statements = []
+
+    def _before_cursor_execute(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", _before_cursor_execute)
+    try:
+        fn()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", _before_cursor_execute)
+    return len(statements)
+
+
+@pytest.mark.parametrize("bulk_lookup", [True, False])
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_sync_bulk_lookup(
+    MockAuthZService,
+    MockKeycloakService,
+    bulk_lookup,
+    app,
+    cern_identities,
+    db,
+    monkeypatch,
+):
+    """Test that the bulk lookup fetches the local users once per batch."""
+    monkeypatch.setitem(app.config, "CERN_SYNC_USERS_BULK_LOOKUP", bulk_lookup)
+    client_id = app.config["CERN_APP_CREDENTIALS"]["consumer_key"]
+    MockAuthZService.return_value.get_identities.return_value = cern_identities
+    sync(method="AuthZ")
+
+    # the first user changes e-mail/username, the second changes personId
+    first, second = cern_identities[0], cern_identities[1]
+    first["upn"] = "mrossi"
+    first["primaryAccountEmail"] = "mrossi@cern.ch"
+    second["personId"] = "99999"
+
+    count = _count_selects(db, lambda: sync(method="AuthZ"))
+    if bulk_lookup:
+        assert count < len(cern_identities)
+    else:
+        assert count >= 3 * len(cern_identities)
+
+    for expected_identity in cern_identities:
+        _assert_cern_identity(expected_identity, client_id)
+
+
+@pytest.mark.parametrize("bulk_lookup", [True, False])
+@patch("invenio_cern_sync.users.sync.LdapClient")
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_sync_mixed_case_usernames(
+    MockAuthZService,
+    MockKeycloakService,
+    MockLdapClient,
+    bulk_lookup,
+    app,
+    cern_identities,
+    ldap_users,
+    db,
+    monkeypatch,
+):
+    """Test that the bulk and per-user lookups match mixed-case usernames alike."""
+    monkeypatch.setitem(app.config, "CERN_SYNC_USERS_BULK_LOOKUP", bulk_lookup)
+    prefix = "Bulk" if bulk_lookup else "Single"
+    new_identities = [
+        {
+            **identity,
+            "upn": f"{prefix}Case{i}",
+            "personId": f"{prefix.lower()}-case-{i}",
+            "primaryAccountEmail": f"{prefix}.Case{i}@cern.ch",
+        }
+        for i, identity in enumerate(cern_identities)
+    ]
+    MockAuthZService.return_value.get_identities.return_value = new_identities
+    sync(method="AuthZ")
+
+    # the same users, returned by LDAP with the same mixed-case usernames
+    new_ldap_users = [
+        {
+            **ldap_user,
+            "cn": [identity["upn"].encode("utf-8")],
+            "employeeID": [identity["personId"].encode("utf-8")],
+            "mail": [identity["primaryAccountEmail"].encode("utf-8")],
+        }
+        for ldap_user, identity in zip(ldap_users, new_identities)
+    ]
+    MockLdapClient.return_value.iter_primary_accounts.return_value = new_ldap_users
+    sync(method="LDAP")
+
+    bulk_lookup = BulkLocalUsersLookup()
+    bulk_lookup.prefetch(
+        [
+            dict(
+                email=identity["primaryAccountEmail"].lower(),
+                user_identity_id=identity["personId"],
+            )
+            for identity in new_identities
+        ]
+    )
+    lookup = LocalUsersLookup()
+    for identity in new_identities:
+        email = identity["primaryAccountEmail"].lower()
+        user = User.query.filter_by(email=email).one()
+        assert user.username == identity["upn"].lower()
+        for username in (identity["upn"], identity["upn"].lower()):
+            assert lookup.get_user(email, username) == user
+            assert bulk_lookup.get_user(email, username) == user
+    assert User.query.filter(User.email.like(f"{prefix.lower()}.case%")).count() == (
+        len(new_identities)
+    )
+
+
+class _CountingConfig(Config):
+    """App config counting the reads of each key."""
+
+    def __init__(self, *args, **kwargs):
+        """Constructor."""
+        super().__init__(*args, **kwargs)
+        self.reads = Counter()
+
+    def __getitem__(self, key):
+        """Count the read and return the value."""
+        self.reads[key] += 1
+        return super().__getitem__(key)
+
+
+@pytest.mark.parametrize("method", ["AuthZ", "LDAP"])
+@patch("invenio_cern_sync.users.sync.LdapClient")
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_sync_mappers_read_once(
+    MockAuthZService,
+    MockKeycloakService,
+    MockLdapClient,
+    method,
+    app,
+    cern_identities,
+    ldap_users,
+    db,
+    monkeypatch,
+):
+    """Test that the mappers are read from the config once per sync."""
+    MockAuthZService.return_value.get_identities.return_value = cern_identities
+    MockLdapClient.return_value.iter_primary_accounts.return_value = ldap_users
+    config = _CountingConfig(app.root_path, app.config)
+    monkeypatch.setattr(app, "config", config)
+
+    sync(method=method)
+
+    prefix = "CERN_SYNC_AUTHZ" if method == "AuthZ" else "CERN_SYNC_LDAP"
+    assert config.reads[f"{prefix}_USERPROFILE_MAPPER"] == 1
+    assert config.reads[f"{prefix}_USER_EXTRADATA_MAPPER"] == 1
+
+
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_sync_skip_unchanged(
+    MockAuthZService,
+    MockKeycloakService,
+    app,
+    cern_identities,
+    db,
+):
+    """Test that users with the same fingerprint are not compared."""
+    client_id = app.config["CERN_APP_CREDENTIALS"]["consumer_key"]
+    MockAuthZService.return_value.get_identities.return_value = cern_identities
+    sync(method="AuthZ")
+
+    first = cern_identities[0]
+    first["cernGroup"] = "AA"
+
+    with patch(
+        "invenio_cern_sync.users.sync.update_existing_user",
+        wraps=update_existing_user,
+    ) as mock_update:
+        results = sync(method="AuthZ")
+
+    # only the changed user is compared and updated
+    assert mock_update.call_count == 1
+    user = User.query.filter_by(email=first["primaryAccountEmail"]).one()
+    assert results == [user.id]
+    for expected_identity in cern_identities:
+        _assert_cern_identity(expected_identity, client_id)
+
+
+@pytest.mark.parametrize("bulk_insert", [True, False])
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_sync_bulk_insert(
+    MockAuthZService,
+    MockKeycloakService,
+    bulk_insert,
+    app,
+    cern_identities,
+    db,
+    monkeypatch,
+):
+    """Test that new users are created, skipping the invalid ones."""
+    monkeypatch.setitem(app.config, "CERN_SYNC_USERS_BULK_INSERT", bulk_insert)
+    client_id = app.config["CERN_APP_CREDENTIALS"]["consumer_key"]
+    prefix = "bulk" if bulk_insert else "single"
+    new_identities = []
+    for i, identity in enumerate(cern_identities):
+        new_identities.append(
+            {
+                **identity,
+                "upn": f"new-{prefix}-{i}",
+                "personId": f"new-{prefix}-{i}",
+                "primaryAccountEmail": f"new-{prefix}-{i}@cern.ch",
+            }
+        )
+    # same e-mail as the first one: the whole batch fails
+    duplicated = {
+        **new_identities[0],
+        "upn": f"duplicated-{prefix}",
+        "personId": f"duplicated-{prefix}",
+    }
+    MockAuthZService.return_value.get_identities.return_value = new_identities + [
+        duplicated
+    ]
+
+    results = sync(method="AuthZ")
+
+    assert len(results) == len(new_identities)
+    for expected_identity in new_identities:
+        _assert_cern_identity(expected_identity, client_id)
+        user = User.query.filter_by(
+            email=expected_identity["primaryAccountEmail"]
+        ).one()
+        assert user.confirmed_at
+        assert user.id in results
+    assert not UserIdentity.query.filter_by(id=duplicated["personId"]).one_or_none()
+
+
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_sync_deactivate_departed(
+    MockAuthZService, MockKeycloakService, app, cern_identities, db, monkeypatch
+):
+    """Test that the users not returned by a full sync are deactivated."""
+    new_identities = [
+        {
+            **identity,
+            "upn": f"departed-{i}",
+            "personId": f"departed-{i}",
+            "primaryAccountEmail": f"departed-{i}@cern.ch",
+        }
+        for i, identity in enumerate(cern_identities)
+    ]
+    MockAuthZService.return_value.get_identities.return_value = new_identities
+    sync(method="AuthZ")
+
+    monkeypatch.setitem(app.config, "CERN_SYNC_USERS_DEACTIVATE_DEPARTED", True)
+    stayed, departed = new_identities[:1], new_identities[1:]
+    MockAuthZService.return_value.get_identities.return_value = stayed
+
+    def _active(identities):
+        return [
+            User.query.filter_by(email=identity["primaryAccountEmail"]).one().active
+            for identity in identities
+        ]
+
+    # delta syncs never deactivate users
+    sync(method="AuthZ", identities=dict(since="2024-01-01"))
+    assert all(_active(new_identities))
+
+    # too many users would be deactivated
+    monkeypatch.setitem(app.config, "CERN_SYNC_USERS_DEPARTED_MAX_RATIO", 0.01)
+    sync(method="AuthZ")
+    assert all(_active(new_identities))
+
+    monkeypatch.setitem(app.config, "CERN_SYNC_USERS_DEPARTED_MAX_RATIO", 1)
+    started = utcnow()
+    results = sync(method="AuthZ")
+    assert all(_active(stayed))
+    assert not any(_active(departed))
+    departed_users = [
+        User.query.filter_by(email=identity["primaryAccountEmail"]).one()
+        for identity in departed
+    ]
+    assert {user.id for user in departed_users} <= set(results)
+    # stored as naive UTC, as the ORM does
+    for user in departed_users:
+        db.session.refresh(user)
+        assert started <= user.updated.replace(tzinfo=None) <= utcnow()
+
+    # reactivate all users, for the other tests
+    User.query.update(dict(active=True))
+    db.session.commit()
+
+
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_sync_missing_users_spilled(
+    MockAuthZService, MockKeycloakService, app, cern_identities, db, monkeypatch
+):
+    """Test that new users are inserted from the buffer spilled to disk."""
+    monkeypatch.setitem(app.config, "CERN_SYNC_USERS_MISSING_MAX_MEMORY", 1)
+    new_identities = [
+        {
+            **identity,
+            "upn": f"spilled{i}",
+            "personId": f"spilled-{i}",
+            "primaryAccountEmail": f"spilled-{i}@cern.ch",
+        }
+        for i, identity in enumerate(cern_identities)
+    ]
+    # fetched twice, and with the username of another new user
+    duplicated = {**new_identities[1], "primaryAccountEmail": "other@cern.ch"}
+    taken = {**new_identities[2], "personId": "spilled-taken"}
+    MockAuthZService.return_value.get_identities.return_value = new_identities + [
+        duplicated,
+        taken,
+    ]
+
+    spilled = []
+    close = MissingUsersBuffer.close
+
+    def _close(self):
+        spilled.append(self.spilled)
+        close(self)
+
+    with patch.object(MissingUsersBuffer, "close", _close):
+        results = sync(method="AuthZ")
+    assert spilled == [True]
+    assert len(results) == len(new_identities)
+    assert User.query.filter(User.email.like("spilled-%")).count() == len(
+        new_identities
+    )
+    assert not User.query.filter_by(email="other@cern.ch").one_or_none()
+
+
+def test_missing_users_buffer_spilled(app):
+    """Test that the buffer tracks when the written users exceed its memory."""
+    users = [
+        dict(user_identity_id=f"buffered-{i}", username=f"buffered{i}")
+        for i in range(3)
+    ]
+    size = len(json.dumps(users[0])) + 1
+    with MissingUsersBuffer(max_memory=2 * size) as buffer:
+        buffer.extend(users[:2])
+        assert not buffer.spilled
+        buffer.add(users[2])
+        assert buffer.spilled
+        assert list(buffer) == users
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Sync tasks tests."""
+
+from datetime import timedelta
+from unittest.mock import patch
+
+import pytest
+from invenio_accounts.models import User
+
+from invenio_cern_sync.authz.client import PERSON_ID_SHARDS
+from invenio_cern_sync.ldap.client import PRIMARY_ACCOUNTS_FILTER
+from invenio_cern_sync.locks import acquire_or_raise
+from invenio_cern_sync.state import DBSyncStateStore, get_since, utcnow
+from invenio_cern_sync.tasks import (
+    sync_groups,
+    sync_users,
+    sync_users_shard,
+    sync_users_sharded,
+)
+from invenio_cern_sync.users.sync import sync_shard
+
+
+@pytest.fixture()
+def no_debug(app, monkeypatch):
+    """Enable the sync tasks."""
+    monkeypatch.setitem(app.config, "DEBUG", False)
+
+
+def test_get_since(app, db):
+    """Test the choice between full and delta syncs."""
+    store = DBSyncStateStore()
+    assert get_since("kind", store=store) is None
+
+    watermark = utcnow() - timedelta(hours=1)
+    store.save("kind", watermark, full=True)
+    assert get_since("kind", store=store) == watermark.isoformat()
+    assert get_since("kind", full=True, store=store) is None
+
+    # the last full sync is older than the interval
+    store.save("kind", watermark - timedelta(days=8), full=True)
+    store.save("kind", watermark)
+    assert get_since("kind", store=store) is None
+    assert get_since("kind", full=False, store=store) == watermark.isoformat()
+
+
+@patch("invenio_cern_sync.tasks.users_sync")
+def test_sync_users_since_last_run(mock_sync, app, db, no_debug):
+    """Test that the users sync task fetches only the modified users."""
+    sync_users()
+    mock_sync.assert_called_once_with()
+    watermark, last_full_sync = DBSyncStateStore().get("users-AuthZ")
+    assert watermark == last_full_sync
+
+    sync_users(identities=dict(limit=10))
+    mock_sync.assert_called_with(identities=dict(limit=10, since=watermark.isoformat()))
+    new_watermark, new_last_full_sync = DBSyncStateStore().get("users-AuthZ")
+    assert new_watermark > watermark
+    assert new_last_full_sync == last_full_sync
+
+    # the given date is used, and the watermark does not move
+    sync_users(identities=dict(since="2024-01-01"))
+    mock_sync.assert_called_with(identities=dict(since="2024-01-01"))
+    assert DBSyncStateStore().get("users-AuthZ")[0] == new_watermark
+
+
+@patch("invenio_cern_sync.tasks.users_sync")
+def test_sync_users_failed_run(mock_sync, app, db, no_debug):
+    """Test that the watermark is not moved when the sync fails."""
+    mock_sync.side_effect = Exception("AuthZ is down")
+    sync_users(method="LDAP")
+    assert DBSyncStateStore().get("users-LDAP") == (None, None)
+
+
+@patch("invenio_cern_sync.tasks.users_sync")
+def test_sync_users_ldap_incremental(mock_sync, app, db, no_debug, monkeypatch):
+    """Test that LDAP users are fetched incrementally, when enabled."""
+    sync_users(method="LDAP")
+    mock_sync.assert_called_with(method="LDAP")
+
+    monkeypatch.setitem(app.config, "CERN_SYNC_LDAP_INCREMENTAL", True)
+    sync_users(method="LDAP", full=True)
+    watermark, _ = DBSyncStateStore().get("users-LDAP")
+    sync_users(method="LDAP")
+    mock_sync.assert_called_with(
+        method="LDAP", accounts=dict(since=watermark.isoformat())
+    )
+
+
+@patch("invenio_cern_sync.tasks.groups_sync")
+def test_sync_groups_full(mock_sync, app, db, no_debug):
+    """Test that a full groups sync can be forced."""
+    previous_watermark = utcnow() - timedelta(hours=1)
+    DBSyncStateStore().save("groups", previous_watermark, full=True)
+
+    sync_groups(full=True)
+
+    mock_sync.assert_called_once_with()
+    watermark, last_full_sync = DBSyncStateStore().get("groups")
+    assert watermark == last_full_sync
+    assert watermark > previous_watermark
+
+
+def _get_identities(identities):
+    """Return a fake `get_identities`, applying the `personId:endswith` filters."""
+
+    def _get(filters=None, **kwargs):
+        suffixes = [f.split(":")[-1] for f in filters or []]
+        return [
+            identity
+            for identity in identities
+            if all(identity["personId"].endswith(suffix) for suffix in suffixes)
+        ]
+
+    return _get
+
+
+@patch("invenio_cern_sync.tasks.sync_users_shard.s", wraps=sync_users_shard.s)
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_sync_users_sharded(
+    MockAuthZService,
+    MockKeycloakService,
+    mock_signature,
+    app,
+    cern_identities,
+    db,
+    no_debug,
+):
+    """Test the sharded sync, with an e-mail moving across shards."""
+    identities = [
+        {
+            **identity,
+            "upn": f"sharded{i}",
+            "personId": f"sharded-{i}",
+            "primaryAccountEmail": f"sharded{i}@cern.ch",
+        }
+        for i, identity in enumerate(cern_identities)
+    ]
+    get_identities = MockAuthZService.return_value.get_identities
+    get_identities.side_effect = _get_identities(identities)
+    result = sync_users_sharded(full=True)
+    ids = result.get()
+    assert len(ids) == len(identities)
+    watermark, last_full_sync = DBSyncStateStore().get("users-AuthZ")
+    assert watermark == last_full_sync
+
+    # each shard fetches its own users: only the filters are sent to the workers
+    assert mock_signature.call_count == len(PERSON_ID_SHARDS)
+    for call in mock_signature.call_args_list:
+        assert call.args[0] == "AuthZ"
+        assert call.args[1] in PERSON_ID_SHARDS
+    # each shard emits its own metrics
+    parts = [call.kwargs["part"] for call in mock_signature.call_args_list]
+    assert parts == [f"shard-{i}" for i in range(len(PERSON_ID_SHARDS))]
+    fetched_filters = [call.kwargs["filters"] for call in get_identities.call_args_list]
+    assert sorted(fetched_filters) == sorted(PERSON_ID_SHARDS)
+
+    # the first identity takes the e-mail of the second one, in a later shard
+    first, second = identities[0], identities[1]
+    first_email = first["primaryAccountEmail"]
+    second_email = second["primaryAccountEmail"]
+    first["primaryAccountEmail"] = second_email
+    second["primaryAccountEmail"] = "new." + second_email
+
+    with patch("invenio_cern_sync.users.sync.log_warning") as mock_log_warning:
+        sync_users_sharded(full=True).get()
+    assert any(
+        "Deferring" in call.args[1].get("msg", "")
+        for call in mock_log_warning.call_args_list
+    )
+
+    assert not User.query.filter_by(email=first_email).one_or_none()
+    user = User.query.filter_by(email=second_email).one()
+    assert user.username == first["upn"]
+    user = User.query.filter_by(email="new." + second_email).one()
+    assert user.username == second["upn"]
+
+
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_sync_users_shard_not_filtered(
+    MockAuthZService, MockKeycloakService, app, cern_identities, db
+):
+    """Test that a shard fails when AuthZ does not apply its filters."""
+    get_identities = MockAuthZService.return_value.get_identities
+    get_identities.return_value = cern_identities
+    with pytest.raises(ValueError):
+        sync_shard("AuthZ", PERSON_ID_SHARDS[0])
+
+
+@patch("invenio_cern_sync.tasks.chord", side_effect=ConnectionError("broker down"))
+def test_sync_users_sharded_dispatch_failed(mock_chord, app, db, no_debug):
+    """Test that the lock is released when the shards cannot be dispatched."""
+    assert sync_users_sharded(full=True) is None
+    mock_chord.assert_called_once()
+    acquire_or_raise("users").release()
+
+
+@patch("invenio_cern_sync.users.sync.LdapClient")
+def test_sync_users_sharded_ldap(MockLdapClient, app, db, no_debug):
+    """Test that each LDAP shard searches the users of its own partition."""
+    MockLdapClient.return_value.iter_primary_accounts.return_value = []
+    shards = ["(!(cn>=m))", "(cn>=m)"]
+    sync_users_sharded(method="LDAP", shards=shards).get()
+
+    filters = [
+        call.kwargs["filter"]
+        for call in MockLdapClient.return_value.iter_primary_accounts.call_args_list
+    ]
+    assert sorted(filters) == sorted(
+        f"(&{PRIMARY_ACCOUNTS_FILTER}{shard})" for shard in shards
+    )
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 CERN.
+#
+# Invenio-CERN-sync is free software; you can redistribute it and/or modify it
+# under the terms of the MIT License; see LICENSE file for more details.
+
+"""Users changes history tests."""
+
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from invenio_accounts.models import User
+from invenio_oauthclient.models import RemoteAccount
+
+from invenio_cern_sync.models import CERNSyncUserChange
+from invenio_cern_sync.users.changes import (
+    IDENTITY_ID_CHANGED,
+    UserChanges,
+    get_user_changes,
+    migrate_extra_data_changes,
+    prune_user_changes,
+)
+from invenio_cern_sync.users.sync import sync
+
+
+def test_user_changes(app, db):
+    """Test that the changes are inserted on flush, and discarded on clear."""
+    changes = UserChanges(log_uuid="run-1")
+    changes.add(IDENTITY_ID_CHANGED, 1, 10, previous_identity_id="0")
+    changes.clear()
+    changes.add(IDENTITY_ID_CHANGED, 2, 20, previous_identity_id="1")
+    changes.flush()
+    changes.flush()
+
+    change = get_user_changes(user_id=20).one()
+    assert change.identity_id == "2"
+    assert change.log_uuid == "run-1"
+    assert change.data == dict(previous_identity_id="1")
+    assert get_user_changes(identity_id=1).count() == 0
+
+
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_migrate_extra_data_changes(
+    MockAuthZService, MockKeycloakService, app, cern_identities, db
+):
+    """Test that the changes of the remote accounts are moved to the table."""
+    MockAuthZService.return_value.get_identities.return_value = cern_identities
+    sync(method="AuthZ")
+
+    user = User.query.filter_by(username=cern_identities[0]["upn"]).one()
+    remote_account = RemoteAccount.query.filter_by(user_id=user.id).one()
+    remote_account.extra_data = dict(
+        remote_account.extra_data,
+        changes=[
+            dict(
+                datetime="2024-01-01T10:00:00+01:00",
+                action="userdata_changed",
+                previous_username="jdoe",
+                previous_email="jdoe@cern.ch",
+                new_username="jdoe0",
+                new_email="john.doe0@cern.ch",
+            ),
+            dict(
+                datetime="2024-02-01T10:00:00+00:00",
+                action="identityId_changed",
+                previous_identity_id="1",
+                new_identity_id=cern_identities[0]["personId"],
+            ),
+        ],
+    )
+    db.session.commit()
+
+    assert migrate_extra_data_changes(batch_size=3) == 2
+    assert migrate_extra_data_changes() == 0
+    remote_account = RemoteAccount.query.filter_by(user_id=user.id).one()
+    assert "changes" not in remote_account.extra_data
+    assert "keycloak_id" in remote_account.extra_data
+
+    identity_change, user_data_change = get_user_changes(user_id=user.id)
+    assert identity_change.created == datetime(2024, 2, 1, 10)
+    assert identity_change.data == dict(
+        previous_identity_id="1", new_identity_id=cern_identities[0]["personId"]
+    )
+    assert user_data_change.created == datetime(2024, 1, 1, 9)
+    assert user_data_change.identity_id == cern_identities[0]["personId"]
+    assert user_data_change.log_uuid is None
+
+
+@patch("invenio_cern_sync.users.sync.KeycloakService")
+@patch("invenio_cern_sync.users.sync.AuthZService")
+def test_prune_user_changes(
+    MockAuthZService, MockKeycloakService, app, cern_identities, db, monkeypatch
+):
+    """Test that the changes older than the retention are deleted by the sync."""
+    changes = UserChanges()
+    changes.add(IDENTITY_ID_CHANGED, "1", None)
+    changes.add(IDENTITY_ID_CHANGED, "2", None)
+    changes.flush()
+    CERNSyncUserChange.query.filter_by(identity_id="1").update(
+        dict(created=datetime(2020, 1, 1))
+    )
+    assert prune_user_changes() == 0
+
+    monkeypatch.setitem(
+        app.config, "CERN_SYNC_USERS_CHANGES_RETENTION", timedelta(days=365)
+    )
+    MockAuthZService.return_value.get_identities.return_value = cern_identities
+    sync(method="AuthZ")
+    assert get_user_changes(identity_id="1").count() == 0
+    assert get_user_changes(identity_id="2").count() == 1